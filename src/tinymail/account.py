@@ -1,14 +1,29 @@
 import logging
+from collections import deque, OrderedDict
 from monocle import _o, Return
 from blinker import Signal
-from async import AsyncJob, start_worker, SimpleWorkerManager
-from imap_worker import ImapWorker
+from async import AsyncJob, AsyncLock, start_worker, PooledWorkerManager
+from async import PRIORITY_INTERACTIVE, PRIORITY_USER, PRIORITY_BACKGROUND
+from imap_worker import ImapWorker, ImapCommandRejected
+from headers import parse_summary
+from flags import FlagTable
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.INFO)
 
+# re-issue IDLE this often; servers may drop connections idle for 30 minutes
+IDLE_TIMEOUT = 25 * 60
+# seconds between checks for pooled connections past their `idle_timeout`
+POOL_CHECK_INTERVAL = 30
+
+# new messages whose headers are downloaded and stored in one go
+HEADER_BATCH_SIZE = 500
+
 account_opened = Signal()
 account_updated = Signal()
+# an `AccountUpdateJob` started, or finished with `error` (or `None`)
+sync_started = Signal()
+sync_finished = Signal()
 folder_updated = Signal()
 message_updated = Signal()
 
@@ -18,14 +33,37 @@ class Account(object):
         self.config = config
         self._db = db
         self._folders = {}
+        self._flag_table = FlagTable()
         self._load_from_db()
         self._sync_job = None
-        self.worker_manager = SimpleWorkerManager(self._create_worker,
-                                                  self._desotry_worker)
+        self._idle_jobs = {}
+        # ids of journaled copies that have a job running
+        self._copy_jobs = set()
+        self._idle_supported = None
+        # messages whose `raw_full` is kept in memory, least recent first
+        self._loaded_bodies = OrderedDict()
+        self.max_bodies_in_memory = config.get('bodies_in_memory', 50)
+        self.worker_manager = PooledWorkerManager(self._create_worker,
+                                self._desotry_worker, self._ping_worker,
+                                max_workers=config.get('max_connections', 1),
+                                idle_timeout=config.get('idle_timeout', 300),
+                                ping_after=config.get('ping_after', 5))
+
+    def close_idle_connections(self):
+        """
+        Close pooled connections that have been unused for longer than
+        `idle_timeout`. Called on a timer, every `POOL_CHECK_INTERVAL`.
+        """
+        wm = self.worker_manager
+        return wm.close_idle_workers(wm.idle_timeout)
 
     def get_imap_config(self):
-        return dict( (k, self.config[k]) for k in
-                     ('host', 'login_name', 'login_pass') )
+        imap_config = dict( (k, self.config[k]) for k in
+                            ('host', 'login_name', 'login_pass') )
+        for k in ('port', 'ssl', 'max_command_length', 'compress'):
+            if k in self.config:
+                imap_config[k] = self.config[k]
+        return imap_config
 
     def list_folders(self):
         return self._folders.itervalues()
@@ -33,27 +71,99 @@ class Account(object):
     def get_folder(self, name):
         return self._folders[name]
 
+    def search_messages(self, query, offset=0, limit=None):
+        """
+        Messages of all folders that match `query` in the local search
+        index, best matches first, as `(folder, uid)` tuples.
+        """
+        db_account = self._db.get_account(self.name)
+        return [(self._folders[name], uid) for name, uid in
+                db_account.search_messages(query, offset, limit)
+                if name in self._folders]
+
     def _load_from_db(self):
-        # TODO move this into an async job?
+        # messages are loaded later, by each folder, when they are needed
         db_account = self._db.get_account(self.name)
         db_account_folders = list(db_account.list_folders())
         for db_folder in db_account_folders:
             name = db_folder.name
             folder = Folder(self, name)
             folder._uidvalidity = db_folder.get_uidvalidity()
+            folder._highestmodseq = db_folder.get_highestmodseq()
             self._folders[name] = folder
-            for uid, flags, raw_headers in db_folder.list_messages():
-                message = Message(folder, uid, flags, raw_headers)
-                folder._messages[uid] = message
         account_opened.send(self)
 
-    def perform_update(self):
+    def perform_update(self, skip=()):
+        """
+        Sync the folder list and every folder, except those named in
+        `skip`, unless a sync is running already.
+        """
         if self._sync_job is not None:
             return
-        cb = AccountUpdateJob(self).start()
+        cb = AccountUpdateJob(self, skip).start()
         if not hasattr(cb, 'result'):
             self._sync_job = cb
 
+    def update_folder(self, name):
+        """ Update a single folder, e.g. when IDLE says it has changed. """
+        folder = self._folders.get(name)
+        if folder is None:
+            self.perform_update()
+        elif not folder._update_pending:
+            folder._update_pending = True
+            FolderUpdateJob(folder).start()
+
+    def push_folder_names(self):
+        return self.config.get('push_folders', ['INBOX'])
+
+    def start_push(self):
+        """
+        Watch the folders listed in `push_folders` with IMAP IDLE, each on
+        its own connection, and update them as soon as the server reports a
+        change. Does nothing if the server doesn't support IDLE.
+        """
+        if self._idle_supported is False:
+            return
+        for name in self.push_folder_names():
+            if name not in self._idle_jobs:
+                job = self._idle_jobs[name] = FolderIdleJob(self, name)
+                job.start()
+
+    def stop_push(self):
+        for job in self._idle_jobs.values():
+            job.stop()
+
+    def push_active(self):
+        names = self.push_folder_names()
+        return bool(names) and all(name in self._idle_jobs and
+                                   self._idle_jobs[name].idling
+                                   for name in names)
+
+    def watched_folder_names(self):
+        """ Folders that IDLE is keeping up to date right now. """
+        return set(name for name, job in self._idle_jobs.iteritems()
+                   if job.idling)
+
+    def auto_sync(self):
+        """
+        Called periodically. Polls the server for all folders but those
+        IDLE is keeping up to date, and restarts IDLE connections that were
+        dropped.
+        """
+        self.perform_update(skip=self.watched_folder_names())
+        self.start_push()
+
+    def _body_loaded(self, message):
+        """
+        Keep only the most recently read message bodies in memory; the
+        others can be loaded again from the on-disk cache.
+        """
+        self._loaded_bodies.pop(message, None)
+        self._loaded_bodies[message] = None
+        while len(self._loaded_bodies) > self.max_bodies_in_memory:
+            old_message, _ = self._loaded_bodies.popitem(last=False)
+            old_message.raw_full = None
+
     @_o
     def _create_worker(self):
         worker = _new_imap_worker()
@@ -62,78 +172,350 @@ class Account(object):
 
     @_o
     def _desotry_worker(self, worker):
-        yield worker.disconnect()
-        worker.done()
+        try:
+            yield worker.disconnect()
+        finally:
+            worker.done()
+
+    def _ping_worker(self, worker):
+        return worker.noop()
+
+    def _copy_messages(self, src_folder, op_id, uidvalidity, uid_list,
+                       dst_folder):
+        if op_id not in self._copy_jobs:
+            self._copy_jobs.add(op_id)
+            FolderCopyMessagesJob(src_folder, uid_list, dst_folder,
+                                  op_id, uidvalidity).start()
+
+    def replay_copies(self):
+        """ Retry journaled copies, e.g. ones cut short by a restart. """
+        db_account = self._db.get_account(self.name)
+        for name in db_account.list_folders_with_operations('copy'):
+            db_folder = db_account.get_folder(name)
+            for op_id, uidvalidity, uid_list, operation, dst_name in \
+                    db_folder.list_operations('copy'):
+                src_folder = self._folders.get(name)
+                dst_folder = self._folders.get(dst_name)
+                if dst_folder is None:
+                    log.warning("Dropping copy of messages %r from %r to "
+                                "%r: no such folder", uid_list, name, dst_name)
+                    with self._db.transaction():
+                        db_folder.del_operations([op_id])
+                    continue
+                self._copy_messages(src_folder, op_id, uidvalidity,
+                                    uid_list, dst_folder)
 
 class Folder(object):
     def __init__(self, account, name):
         self.account = account
         self.name = name
-        self._messages = {}
+        # Message objects loaded so far, by uid; `_all_loaded` is set once
+        # it holds every message in the folder.
+        self._message_cache = {}
+        self._all_loaded = False
         self._uidvalidity = None
+        self._highestmodseq = None
+        self._update_pending = False
+        # the job that will send journaled flag changes to the server
+        self._replay_job = None
+        # jobs that change the folder's data hold this lock, so they see
+        # each other's changes in the order they were started.
+        self._lock = AsyncLock()
+
+    def _get_messages(self):
+        if not self._all_loaded:
+            self._load_messages()
+        return self._message_cache
+
+    def _set_messages(self, messages):
+        self._message_cache = messages
+        self._all_loaded = True
+
+    _messages = property(_get_messages, _set_messages)
+
+    def _get_db_folder(self):
+        db_account = self.account._db.get_account(self.account.name)
+        return db_account.get_folder(self.name)
+
+    def _cached_message(self, uid, flags, raw_headers, summary=None):
+        message = self._message_cache.get(uid)
+        if message is None:
+            message = Message(self, uid, flags, raw_headers, summary)
+            self._message_cache[uid] = message
+        return message
+
+    def _load_messages(self):
+        log.debug("Loading messages of folder %r", self.name)
+        for row in self._get_db_folder().list_messages(summary=True):
+            self._cached_message(*row)
+        self._all_loaded = True
+
+    def _get_message_flags(self, uid_list=None):
+        """ Flags by uid, without loading the messages themselves. """
+        if self._all_loaded:
+            messages = self._message_cache
+            if uid_list is None:
+                uid_list = messages
+            return dict((uid, messages[uid].flags) for uid in uid_list)
+        return self._get_db_folder().get_message_flags(uid_list)
 
     def list_messages(self):
         return self._messages.itervalues()
 
+    def list_uids(self):
+        """ Sorted uids of all messages, without loading the messages. """
+        if self._all_loaded:
+            return sorted(self._message_cache)
+        return self._get_db_folder().list_uids()
+
+    def count_messages(self):
+        if self._all_loaded:
+            return len(self._message_cache)
+        return self._get_db_folder().count_messages()
+
+    def list_messages_page(self, offset, limit):
+        """ Return `limit` messages, sorted by uid, starting at `offset`. """
+        if self._all_loaded:
+            uids = sorted(self._message_cache)[offset:offset+limit]
+            return [self._message_cache[uid] for uid in uids]
+        rows = self._get_db_folder().list_messages(offset, limit,
+                                                   summary=True)
+        return [self._cached_message(*row) for row in rows]
+
+    def list_threads(self, offset=0, limit=None):
+        """
+        Return `limit` threads, newest first, starting at `offset`. Each is
+        a list of `(message, depth)` tuples, replies after their parent.
+        """
+        threads = self._get_db_folder().list_threads(offset, limit)
+        return [[(self.get_message(uid), depth) for uid, depth in thread]
+                for thread in threads]
+
+    def _get_cached_body(self, uid):
+        db = self.account._db
+        with db.transaction():
+            return self._get_db_folder().get_message_body(uid)
+
     def get_message(self, uid):
-        return self._messages[uid]
+        message = self._message_cache.get(uid)
+        if message is None:
+            if self._all_loaded:
+                raise KeyError(uid)
+            row = self._get_db_folder().get_message(uid, summary=True)
+            message = self._cached_message(*row)
+        return message
+
+    def search_messages(self, query, offset=0, limit=None):
+        """
+        Uids of messages that have all the words of `query` in their
+        headers or cached body, best matches first. Only the local search
+        index is used; see `search`.
+        """
+        return self._get_db_folder().search_messages(query, offset, limit)
+
+    @_o
+    def search(self, query, offset=0, limit=None):
+        """
+        Like `search_messages`, followed by the messages that only the
+        server finds, newest first, if some bodies are not cached. Without
+        a connection to the server, only the local matches are returned.
+        """
+        if isinstance(query, str):
+            query = query.decode('utf-8')
+        words = query.split()
+        db_folder = self._get_db_folder()
+        uids = db_folder.search_messages(query)
+
+        fully_indexed = (self.account._db.search_enabled and
+                         db_folder.count_message_bodies() ==
+                         db_folder.count_messages())
+        if words and not fully_indexed:
+            job = FolderSearchJob(self, words)
+            yield job.start()
+            if job.uids is not None:
+                found = set(uids)
+                known = set(self.list_uids())
+                uids += [uid for uid in reversed(job.uids)
+                         if uid not in found and uid in known]
+
+        end = None if limit is None else offset + limit
+        yield Return(uids[offset:end])
 
     def change_flag(self, uid_list, operation, flag):
-        FolderChangeFlagJob(self, uid_list, operation, flag).start()
+        """
+        Change a flag of messages locally, right away, and journal the
+        change; a `FolderReplayJob` sends it to the server.
+        """
+        if operation not in ('add', 'del'):
+            raise ValueError('Unknown operation %r' % operation)
+        uid_list = sorted(uid_list)
+
+        db = self.account._db
+        with db.transaction():
+            db_folder = self._get_db_folder()
+            uid_to_flags = self._get_message_flags(uid_list)
+            _apply_flag_change(uid_to_flags, uid_list, operation, flag)
+            db_folder.bulk_set_message_flags(uid_to_flags)
+            db_folder.add_operation('flag', uid_list, operation, flag)
+
+        for uid, flags in uid_to_flags.iteritems():
+            message = self._message_cache.get(uid)
+            if message is not None:
+                message.flags = flags
+        folder_updated.send(self, added=[], removed=[],
+                            flags_changed=sorted(uid_to_flags))
+
+        self.replay_changes()
+
+    def replay_changes(self):
+        """ Send journaled flag changes to the server, unless under way. """
+        if self._replay_job is None:
+            self._replay_job = FolderReplayJob(self)
+            self._replay_job.start()
 
     def copy_messages(self, uid_list, dst_folder):
         if dst_folder.account is not self.account:
             raise NotImplementedError("Copying messages accross accounts "
                                       "is not implemented yet.")
 
-        FolderCopyMessagesJob(self, uid_list, dst_folder).start()
+        if not uid_list:
+            return
+
+        # the copies show up in `dst_folder` once the server has made them
+        # and told us their uids; until then they wait in the journal
+        uid_list = sorted(uid_list)
+        db = self.account._db
+        with db.transaction():
+            op_id = self._get_db_folder().add_operation(
+                        'copy', uid_list, None, dst_folder.name)
+        self.account._copy_messages(self, op_id, self._uidvalidity,
+                                    uid_list, dst_folder)
 
 class Message(object):
-    def __init__(self, folder, uid, flags, raw_headers):
+    """
+    A message, as small as we can make it, since a folder may have
+    millions: its flags are bits in the account's `FlagTable` and its raw
+    headers stay in the database until they are asked for.
+    """
+
+    __slots__ = ('folder', 'uid', '_flag_bits', 'subject', 'sender', 'date',
+                 'raw_full', '_load_job')
+
+    def __init__(self, folder, uid, flags, raw_headers, summary=None):
         self.folder = folder
         self.uid = uid
         self.flags = flags
-        self.raw_headers = raw_headers
+        if summary is None:
+            summary = parse_summary(raw_headers)
+        # decoded headers, for display
+        self.subject, self.sender, self.date = summary
         self.raw_full = None
         self._load_job = None
 
+    def _get_flags(self):
+        return self.folder.account._flag_table.flags_for(self._flag_bits)
+
+    def _set_flags(self, flags):
+        self._flag_bits = self.folder.account._flag_table.bits_for(flags)
+
+    flags = property(_get_flags, _set_flags)
+
+    @property
+    def raw_headers(self):
+        return self.folder._get_db_folder().get_message(self.uid)[2]
+
     @_o
     def load_full(self):
         if self._load_job is not None:
             yield self._load_job
 
         elif self.raw_full is None:
-            cb = MessageLoadFullJob(self).start()
-            if not hasattr(cb, 'result'):
-                self._load_job = cb
-            yield cb
-
+            self.raw_full = self.folder._get_cached_body(self.uid)
+            if self.raw_full is None:
+                cb = MessageLoadFullJob(self).start()
+                if not hasattr(cb, 'result'):
+                    self._load_job = cb
+                yield cb
+
+        if self.raw_full is not None:
+            self.folder.account._body_loaded(self)
         yield Return(self.raw_full)
 
 def _new_imap_worker():
     return start_worker(ImapWorker())
 
+def _apply_flag_change(uid_to_flags, uid_list, operation, flag):
+    """ Add or remove `flag` in the flags of `uid_list` in `uid_to_flags`. """
+    for uid in uid_list:
+        if uid not in uid_to_flags:
+            continue
+        if operation == 'add':
+            uid_to_flags[uid] = set(uid_to_flags[uid]) | set([flag])
+        else:
+            uid_to_flags[uid] = set(uid_to_flags[uid]) - set([flag])
+
+def _merge_flag_changes(changes):
+    """
+    Reduce a list of `(uid_list, operation, flag)` changes to the fewest
+    equivalent ones. The last change to a flag of a message wins, so the
+    result doesn't depend on the order the changes are applied in.
+    """
+    final = {}
+    for uid_list, operation, flag in changes:
+        for uid in uid_list:
+            final[uid, flag] = operation
+    grouped = {}
+    for (uid, flag), operation in final.iteritems():
+        grouped.setdefault((operation, flag), []).append(uid)
+    return sorted((sorted(uid_list), operation, flag)
+                  for (operation, flag), uid_list in grouped.iteritems())
+
+def _pop_unlocked_folder(queue):
+    """ Take the first folder that's not locked; failing that, the first. """
+    for folder in queue:
+        if not folder._lock.locked:
+            queue.remove(folder)
+            return folder
+    return queue.popleft()
+
 class AccountUpdateJob(AsyncJob):
-    def __init__(self, account):
+    """
+    Synchronize the list of folders, then each folder but those named in
+    `skip`. Folders are spread over up to `max_connections` workers; each
+    folder is updated while holding its lock.
+    """
+
+    def __init__(self, account, skip=()):
         self.account = account
+        self.skip = skip
 
     @_o
     def do_stuff(self):
-        wm = self.account.worker_manager
-        worker = yield wm.get_worker()
-
+        sync_started.send(self.account)
+        error = None
         try:
-            yield self.update_account(worker)
+            yield self.update_account()
+
+        except Exception, e:
+            error = e
+            raise
 
         finally:
             self.account._sync_job = None
-            yield wm.hand_back_worker(worker)
+            sync_finished.send(self.account, error=error)
 
     @_o
-    def update_account(self, worker):
+    def update_account(self):
         log.debug("Begin update of account %r", self.account.name)
 
-        mailbox_names = yield worker.get_mailbox_names()
+        wm = self.account.worker_manager
+        worker = yield wm.get_worker()
+        try:
+            mailbox_names = yield worker.get_mailbox_names()
+        except Exception, e:
+            # a bare `raise` after the yield would lose the exception
+            yield wm.hand_back_worker(worker)
+            raise e
 
         new_mailbox_names = set(mailbox_names) - set(self.account._folders)
         removed_mailbox_names = set(self.account._folders) - set(mailbox_names)
@@ -145,7 +527,9 @@ class AccountUpdateJob(AsyncJob):
                 for name in new_mailbox_names:
                     log.info("New folder %r", name)
                     db_account.add_folder(name)
-                    self.account._folders[name] = Folder(self.account, name)
+                    folder = Folder(self.account, name)
+                    folder._messages = {} # nothing to load from the db
+                    self.account._folders[name] = folder
 
         if removed_mailbox_names:
             db = self.account._db
@@ -158,71 +542,213 @@ class AccountUpdateJob(AsyncJob):
 
         account_updated.send(self.account)
 
-        for name in mailbox_names:
-            yield self.update_folder(worker, self.account._folders[name])
+        queue = deque(self.account._folders[name] for name in mailbox_names
+                      if name not in self.skip)
+        n_lanes = max(1, min(wm.max_workers, len(queue)))
+        lanes = [self.update_folders(queue, worker)]
+        lanes += [self.update_folders(queue) for c in range(n_lanes - 1)]
+        errors = []
+        for lane in lanes:
+            try:
+                yield lane
+            except Exception, e:
+                errors.append(e)
+        if errors:
+            raise errors[0]
+
+        self.account.replay_copies()
 
         log.info("Update finished for account %r", self.account.name)
 
     @_o
-    def update_folder(self, worker, folder):
+    def update_folders(self, queue, worker=None):
+        """
+        Update folders from `queue` until it's empty. Several of these run
+        in parallel, sharing the queue, each with its own worker.
+        """
+        wm = self.account.worker_manager
+        if worker is None and queue:
+            worker = yield wm.get_worker()
+
+        try:
+            while queue:
+                folder = _pop_unlocked_folder(queue)
+                if not folder._lock.try_acquire():
+                    # don't hold on to a worker while we wait
+                    if worker is not None:
+                        yield wm.hand_back_worker(worker)
+                        worker = None
+                    yield folder._lock.acquire()
+                try:
+                    if worker is None:
+                        worker = yield wm.get_worker()
+                    yield FolderUpdateJob(folder).update_folder(worker)
+                finally:
+                    folder._lock.release()
+
+                if (worker is not None and queue and
+                        wm.has_waiting_clients(PRIORITY_BACKGROUND)):
+                    # let a more urgent job have the worker; we'll queue up
+                    # for one again before the next folder
+                    log.debug("Pausing account update for a waiting job")
+                    yield wm.hand_back_worker(worker)
+                    worker = None
+
+        finally:
+            if worker is not None:
+                yield wm.hand_back_worker(worker)
+
+
+class FolderUpdateJob(AsyncJob):
+    """
+    Synchronize the messages of one folder. `AccountUpdateJob` calls
+    `update_folder` for each folder; on its own, the job takes the folder's
+    lock and a worker, e.g. to react to IDLE notifications.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    @_o
+    def do_stuff(self):
+        wm = self.folder.account.worker_manager
+        yield self.folder._lock.acquire()
+        # changes reported from now on need another update
+        self.folder._update_pending = False
+        try:
+            worker = yield wm.get_worker(self.priority)
+
+            try:
+                yield self.update_folder(worker)
+
+            finally:
+                yield wm.hand_back_worker(worker)
+
+        finally:
+            self.folder._lock.release()
+
+    @_o
+    def update_folder(self, worker):
+        folder = self.folder
         log.debug("Updating folder %r", folder.name)
-        db = self.account._db
-        db_folder = db.get_account(self.account.name).get_folder(folder.name)
-        mbox_status = yield worker.select_mailbox(folder.name)
-        message_flags = yield worker.get_message_flags()
-        assert mbox_status['MESSAGES'] == len(message_flags)
+        db = folder.account._db
+        db_account = db.get_account(folder.account.name)
+        db_folder = db_account.get_folder(folder.name)
+        # send local changes first, so we don't undo them below
+        yield FolderReplayJob(folder).replay(worker)
+        # one round trip: the flags are fetched along with the SELECT
+        mbox_status, changes = \
+            yield worker.select_and_get_flags(folder.name,
+                                              folder._highestmodseq)
+
+        event_data = {'added': [], 'removed': [], 'flags_changed': []}
 
         if mbox_status['UIDVALIDITY'] != folder._uidvalidity:
             if folder._uidvalidity is not None:
                 log.info("Folder %r UIDVALIDITY has changed", folder.name)
-                folder._messages.clear()
+                # the old uids are meaningless now; report them as removed
+                event_data['removed'].extend(folder.list_uids())
+                folder._message_cache.clear()
             folder._uidvalidity = mbox_status['UIDVALIDITY']
+            folder._highestmodseq = None
             with db.transaction():
                 db_folder.del_all_messages()
                 db_folder.set_uidvalidity(folder._uidvalidity)
-
-        server_message_ids = set(message_flags)
-        our_message_ids = set(folder._messages)
+                db_folder.set_highestmodseq(None)
+            # before anything else goes to the network, so listeners don't
+            # look up the messages we just deleted
+            if event_data['removed']:
+                folder_updated.send(folder, **event_data)
+                event_data = {'added': [], 'removed': [], 'flags_changed': []}
+
+        our_flags = folder._get_message_flags()
+        our_message_ids = set(our_flags)
+        highestmodseq = mbox_status.get('HIGHESTMODSEQ')
+
+        if (changes['since'] is not None and
+                not (highestmodseq and folder._highestmodseq)):
+            # changes since a HIGHESTMODSEQ we just forgot, e.g. because
+            # UIDVALIDITY changed; we need all the flags after all
+            message_flags = yield worker.get_message_flags()
+            changes = {'flags': message_flags, 'vanished': None,
+                       'since': None}
+
+        if changes['since'] is not None:
+            # CONDSTORE: we only got changes since the last update
+            message_flags, removed_message_ids = \
+                yield self.get_changes(worker, mbox_status, our_message_ids,
+                                       changes)
+        else:
+            message_flags = changes['flags']
+            assert mbox_status['MESSAGES'] == len(message_flags)
+            removed_message_ids = our_message_ids - set(message_flags)
+
+        # changes journaled since the replay above win over the server's
+        for op_id, uidvalidity, uid_list, operation, flag in \
+                db_folder.list_operations('flag'):
+            _apply_flag_change(message_flags, uid_list, operation, flag)
+
+        server_message_ids = set(message_flags) - removed_message_ids
         new_message_ids = server_message_ids - our_message_ids
-        removed_message_ids = our_message_ids - server_message_ids
-
-        event_data = {'added': [], 'removed': [], 'flags_changed': []}
-
-        # messages added on server; add them locally too
-        if new_message_ids:
-            headers_by_uid = yield worker.get_message_headers(new_message_ids)
-            with db.transaction():
-                sql_msgs = []
-                for uid, raw_headers in headers_by_uid.iteritems():
-                    flags = set(message_flags[uid])
-                    sql_msgs.append((uid, flags, raw_headers))
-                    message = Message(folder, uid, flags, raw_headers)
-                    folder._messages[uid] = message
-                    event_data['added'].append(uid)
-                db_folder.bulk_add_messages(sql_msgs)
 
         # messages removed on server; remove them locally too
         if removed_message_ids:
             with db.transaction():
                 for uid in removed_message_ids:
-                    del folder._messages[uid]
+                    folder._message_cache.pop(uid, None)
                     event_data['removed'].append(uid)
                 db_folder.bulk_del_messages(removed_message_ids)
 
         # for existing messages, update their flags
-        flags_changed = 0
-        with db.transaction():
-            for uid in our_message_ids & server_message_ids:
-                message = folder._messages[uid]
-                new_flags = set(message_flags[uid])
-                if message.flags != new_flags:
+        changed_flags = {}
+        for uid in our_message_ids & server_message_ids:
+            new_flags = set(message_flags[uid])
+            if our_flags[uid] != new_flags:
+                message = folder._message_cache.get(uid)
+                if message is not None:
                     message.flags = new_flags
-                    db_folder.set_message_flags(uid, new_flags)
-                    flags_changed += 1
-                    event_data['flags_changed'].append(uid)
+                changed_flags[uid] = new_flags
+                event_data['flags_changed'].append(uid)
+        flags_changed = len(changed_flags)
+        if changed_flags:
+            with db.transaction():
+                db_folder.bulk_set_message_flags(changed_flags)
 
-        if new_message_ids or removed_message_ids or flags_changed:
+        # report removals and flag changes now; new headers take a while
+        if any(event_data.itervalues()):
             folder_updated.send(folder, **event_data)
+            event_data = {'added': [], 'removed': [], 'flags_changed': []}
+
+        # messages added on server; add them locally too, newest first and
+        # a batch at a time, so the folder fills in as they arrive
+        new_uids = sorted(new_message_ids, reverse=True)
+        batch_size = folder.account.config.get('header_batch_size',
+                                               HEADER_BATCH_SIZE)
+        for start in xrange(0, len(new_uids), batch_size):
+            batch = new_uids[start:start+batch_size]
+            headers_by_uid = yield worker.get_message_headers(batch)
+            with db.transaction():
+                sql_msgs = []
+                for uid in batch:
+                    if uid not in headers_by_uid:
+                        continue # expunged since we fetched the flags
+                    flags = set(message_flags[uid])
+                    raw_headers = headers_by_uid[uid]
+                    sql_msgs.append((uid, flags, raw_headers))
+                    if folder._all_loaded:
+                        message = Message(folder, uid, flags, raw_headers)
+                        folder._message_cache[uid] = message
+                    event_data['added'].append(uid)
+                db_folder.bulk_add_messages(sql_msgs)
+            if event_data['added']:
+                folder_updated.send(folder, **event_data)
+            event_data = {'added': [], 'removed': [], 'flags_changed': []}
+
+        # only now is the folder up to date with `highestmodseq`
+        if highestmodseq != folder._highestmodseq:
+            folder._highestmodseq = highestmodseq
+            with db.transaction():
+                db_folder.set_highestmodseq(highestmodseq)
 
         log.info("Finished updating folder %r: %d messages "
                  "(%d new, %d del, %d flags)",
@@ -231,21 +757,117 @@ class AccountUpdateJob(AsyncJob):
 
         yield worker.close_mailbox()
 
+    @_o
+    def get_changes(self, worker, mbox_status, our_message_ids, changes):
+        """
+        Find out what changed in `folder` since its last known HIGHESTMODSEQ,
+        given the `changes` the worker fetched since then. Returns flags of
+        new and changed messages, and the set of removed messages.
+        """
+        message_flags = changes['flags']
+
+        if changes['vanished'] is not None:
+            # QRESYNC: the server told us what was expunged
+            removed_message_ids = our_message_ids & set(changes['vanished'])
+
+        else:
+            new_count = len(set(message_flags) - our_message_ids)
+            if len(our_message_ids) + new_count == mbox_status['MESSAGES']:
+                removed_message_ids = set()
+            else:
+                server_message_ids = yield worker.get_message_uids()
+                removed_message_ids = our_message_ids - set(server_message_ids)
+
+        yield Return(message_flags, removed_message_ids)
+
+
+class FolderIdleJob(AsyncJob):
+    """
+    Keep a dedicated connection in IDLE on one folder, and update the folder
+    each time the server tells us it has changed. The job ends if the server
+    doesn't support IDLE, if the connection fails, or when `stop` is called.
+    """
+
+    def __init__(self, account, folder_name):
+        self.account = account
+        self.folder_name = folder_name
+        self.worker = None
+        self.idling = False
+        self.stopped = False
+
+    def stop(self):
+        self.stopped = True
+        if self.worker is not None:
+            self.worker.interrupt()
+
+    @_o
+    def do_stuff(self):
+        try:
+            yield self.watch_folder()
+
+        except Exception:
+            if not self.stopped:
+                raise
+
+        finally:
+            self.idling = False
+            if self.account._idle_jobs.get(self.folder_name) is self:
+                del self.account._idle_jobs[self.folder_name]
+
+    @_o
+    def watch_folder(self):
+        worker = yield self.account._create_worker()
+        self.worker = worker
+        try:
+            if not (yield worker.has_idle()):
+                log.info("Server for account %r does not support IDLE, "
+                         "polling instead", self.account.name)
+                self.account._idle_supported = False
+                return
+
+            self.account._idle_supported = True
+            if self.stopped:
+                return
+            yield worker.select_mailbox(self.folder_name)
+            self.idling = True
+            log.debug("Watching folder %r with IDLE", self.folder_name)
+
+            while not self.stopped:
+                notifications = yield worker.idle(IDLE_TIMEOUT)
+                if notifications and not self.stopped:
+                    log.debug("Folder %r changed: %r",
+                              self.folder_name, notifications)
+                    self.account.update_folder(self.folder_name)
+
+        finally:
+            self.worker = None
+            try:
+                yield self.account._desotry_worker(worker)
+            except Exception, e:
+                log.debug("Error closing IDLE connection: %r", e)
+
 
 class MessageLoadFullJob(AsyncJob):
+    priority = PRIORITY_INTERACTIVE
+
     def __init__(self, message):
         self.message = message
 
     @_o
     def do_stuff(self):
         wm = self.message.folder.account.worker_manager
-        worker = yield wm.get_worker()
-
         try:
-            yield self.load_full_message(worker)
+            worker = yield wm.get_worker(self.priority)
+
+            try:
+                yield self.load_full_message(worker)
+
+            finally:
+                yield wm.hand_back_worker(worker)
 
         finally:
-            yield wm.hand_back_worker(worker)
+            # callers of `load_full` share the job while it runs
+            self.message._load_job = None
 
     @_o
     def load_full_message(self, worker):
@@ -257,110 +879,239 @@ class MessageLoadFullJob(AsyncJob):
         body = yield worker.get_message_body(message.uid)
         message.raw_full = body
 
-        message_updated.send(message)
+        db = message.folder.account._db
+        with db.transaction():
+            message.folder._get_db_folder().set_message_body(message.uid, body)
 
-        self.message._load_job = None
+        message_updated.send(message)
 
         yield worker.close_mailbox()
 
 
-class FolderChangeFlagJob(AsyncJob):
-    def __init__(self, folder, uid_list, operation, flag):
+class FolderSearchJob(AsyncJob):
+    """
+    Ask the server which messages of a folder have each of `words`. Their
+    uids end up in `uids`, which stays `None` if the search fails.
+    """
+
+    priority = PRIORITY_INTERACTIVE
+
+    def __init__(self, folder, words):
         self.folder = folder
-        self.uid_list = uid_list
-        self.operation = operation
-        self.flag = flag
+        self.words = words
+        self.uids = None
 
     @_o
     def do_stuff(self):
         wm = self.folder.account.worker_manager
-        worker = yield wm.get_worker()
+        worker = yield wm.get_worker(self.priority)
 
         try:
-            yield self.change_messages_flag(worker)
+            mbox_status = yield worker.select_mailbox(self.folder.name)
+            if mbox_status['UIDVALIDITY'] == self.folder._uidvalidity:
+                self.uids = yield worker.search_text(self.words)
+            yield worker.close_mailbox()
 
         finally:
             yield wm.hand_back_worker(worker)
 
+class FolderReplayJob(AsyncJob):
+    """
+    Send the flag changes journaled for a folder to the server. Changes
+    journaled until the job has the folder's lock and a worker are merged,
+    so a burst of clicks costs one SELECT and as few STORE commands as
+    possible. Changes that can't be sent, e.g. while offline, stay in the
+    journal; the next job, or the next update of the folder, sends them.
+    Changes the server rejects are undone locally and dropped.
+    """
+
+    priority = PRIORITY_USER
+
+    def __init__(self, folder):
+        self.folder = folder
+
     @_o
-    def change_messages_flag(self, worker):
-        log.debug("Changing flags in folder %r, messages %r: %r %r",
-                  self.folder, self.uid_list, self.operation, self.flag)
+    def do_stuff(self):
+        wm = self.folder.account.worker_manager
+        try:
+            yield self.folder._lock.acquire()
+            try:
+                worker = yield wm.get_worker(self.priority)
+
+                try:
+                    # changes journaled from now on need another job
+                    self.folder._replay_job = None
+                    if (yield self.replay(worker)):
+                        yield worker.close_mailbox()
+
+                finally:
+                    yield wm.hand_back_worker(worker)
 
-        yield worker.select_mailbox(self.folder.name, readonly=False)
-        yield worker.change_flag(self.uid_list, self.operation, self.flag)
+            finally:
+                self.folder._lock.release()
 
-        db = self.folder.account._db
+        finally:
+            if self.folder._replay_job is self:
+                self.folder._replay_job = None
+
+    @_o
+    def replay(self, worker):
+        """
+        Send the journaled changes; returns whether there were any. Changes
+        made before the folder's UIDVALIDITY changed are dropped, since
+        their uids now mean other messages.
+        """
+        folder = self.folder
+        db = folder.account._db
+        db_folder = folder._get_db_folder()
+        operations = list(db_folder.list_operations('flag'))
+        if not operations:
+            yield Return(False)
+
+        mbox_status = yield worker.select_mailbox(folder.name, readonly=False)
+        changes = []
+        for op_id, uidvalidity, uid_list, operation, flag in operations:
+            if uidvalidity == mbox_status['UIDVALIDITY']:
+                changes.append((uid_list, operation, flag))
+            else:
+                log.warning("Dropping change to folder %r from before its "
+                            "UIDVALIDITY changed: %r %r %r",
+                            folder.name, uid_list, operation, flag)
+
+        rejected = []
+        for uid_list, operation, flag in _merge_flag_changes(changes):
+            log.debug("Changing flags in folder %r, messages %r: %r %r",
+                      folder.name, uid_list, operation, flag)
+            try:
+                yield worker.change_flag(uid_list, operation, flag)
+            except ImapCommandRejected, e:
+                # e.g. a read-only folder; sending it again won't help
+                log.warning("Server rejected change to folder %r, undoing "
+                            "it: %r %r %r (%s)", folder.name, uid_list,
+                            operation, flag, e)
+                rejected.append((uid_list, operation, flag))
+
+        uids = sorted(set(uid for uid_list, _, _ in rejected
+                          for uid in uid_list))
         with db.transaction():
-            db_account = db.get_account(self.folder.account.name)
-            db_folder = db_account.get_folder(self.folder.name)
-            for uid in self.uid_list:
-                message = self.folder._messages[uid]
-                if self.operation == 'add':
-                    message.flags.add(self.flag)
-                elif self.operation == 'del':
-                    message.flags.discard(self.flag)
-                else:
-                    raise ValueError('Unknown operation %r' % self.operation)
-                db_folder.set_message_flags(uid, message.flags)
+            if rejected:
+                uid_to_flags = folder._get_message_flags(uids)
+                for uid_list, operation, flag in rejected:
+                    undo = 'del' if operation == 'add' else 'add'
+                    _apply_flag_change(uid_to_flags, uid_list, undo, flag)
+                db_folder.bulk_set_message_flags(uid_to_flags)
+            db_folder.del_operations([op[0] for op in operations])
 
-        event_data = {
-            'added': [],
-            'removed': [],
-            'flags_changed': self.uid_list,
-        }
-        folder_updated.send(self.folder, **event_data)
+        if rejected:
+            for uid, flags in uid_to_flags.iteritems():
+                message = folder._message_cache.get(uid)
+                if message is not None:
+                    message.flags = flags
+            folder_updated.send(folder, added=[], removed=[],
+                                flags_changed=sorted(uid_to_flags))
 
-        yield worker.close_mailbox()
+        yield Return(True)
 
 
 class FolderCopyMessagesJob(AsyncJob):
-    def __init__(self, src_folder, src_uids, dst_folder):
+    """
+    Make a journaled copy of messages on the server, then add the copies
+    to the destination folder and take the copy out of the journal.
+    """
+
+    priority = PRIORITY_USER
+
+    def __init__(self, src_folder, src_uids, dst_folder, op_id, uidvalidity):
         self.src_folder = src_folder
         self.src_uids = src_uids
         self.dst_folder = dst_folder
+        self.op_id = op_id
+        self.uidvalidity = uidvalidity
 
     @_o
     def do_stuff(self):
         wm = self.src_folder.account.worker_manager
-        worker = yield wm.get_worker()
-
         try:
-            yield self.copy_messages(worker)
+            yield self.dst_folder._lock.acquire()
+            try:
+                worker = yield wm.get_worker(self.priority)
+
+                try:
+                    yield self.copy_messages(worker)
+
+                finally:
+                    yield wm.hand_back_worker(worker)
+
+            finally:
+                self.dst_folder._lock.release()
 
         finally:
-            yield wm.hand_back_worker(worker)
+            self.src_folder.account._copy_jobs.discard(self.op_id)
 
     @_o
     def copy_messages(self, worker):
         log.debug("Copying messages %r from %r to %r",
                   self.src_uids, self.src_folder, self.dst_folder)
 
-        yield worker.select_mailbox(self.src_folder.name)
+        db = self.dst_folder.account._db
+        src_db_folder = self.src_folder._get_db_folder()
+
+        if not self.src_uids:
+            with db.transaction():
+                src_db_folder.del_operations([self.op_id])
+            return
+
+        mbox_status = yield worker.select_mailbox(self.src_folder.name)
+        if mbox_status['UIDVALIDITY'] != self.uidvalidity:
+            log.warning("Dropping copy of messages %r from %r to %r: "
+                        "UIDVALIDITY has changed", self.src_uids,
+                        self.src_folder.name, self.dst_folder.name)
+            with db.transaction():
+                src_db_folder.del_operations([self.op_id])
+            return
+
         result = yield worker.copy_messages(self.src_uids,
                                               self.dst_folder.name)
-        assert set(result['uid_map']) == set(self.src_uids)
-        # TODO check UIDVALIDITY
+        assert set(result['uid_map']) <= set(self.src_uids)
 
-        db = self.dst_folder.account._db
+        if (not result['uid_map'] or
+                result['UIDVALIDITY'] != self.dst_folder._uidvalidity):
+            # the server made the copies without telling us their uids (no
+            # UIDPLUS), or with uids that don't match what we have of
+            # `dst_folder`; an update of `dst_folder` will find them
+            with db.transaction():
+                src_db_folder.del_operations([self.op_id])
+            self.dst_folder.account.update_folder(self.dst_folder.name)
+            yield worker.close_mailbox()
+            return
+
+        added = []
         with db.transaction():
-            db_account = db.get_account(self.dst_folder.account.name)
-            dst_db_folder = db_account.get_folder(self.dst_folder.name)
+            dst_db_folder = self.dst_folder._get_db_folder()
 
             sql_msgs = []
             for src_uid, dst_uid in result['uid_map'].iteritems():
-                src_message = self.src_folder.get_message(src_uid)
+                try:
+                    src_message = self.src_folder.get_message(src_uid)
+                except KeyError:
+                    # removed meanwhile; the next update of `dst_folder`
+                    # will find the copy
+                    continue
                 flags = set(src_message.flags)
                 raw_headers = src_message.raw_headers
 
                 sql_msgs.append((dst_uid, flags, raw_headers))
+                summary = (src_message.subject, src_message.sender,
+                           src_message.date)
                 dst_message = Message(self.dst_folder, dst_uid,
-                                      flags, raw_headers)
-                self.dst_folder._messages[dst_uid] = dst_message
+                                      flags, raw_headers, summary)
+                self.dst_folder._message_cache[dst_uid] = dst_message
+                added.append(dst_uid)
             dst_db_folder.bulk_add_messages(sql_msgs)
+            src_db_folder.del_operations([self.op_id])
 
         event_data = {
-            'added': sorted(result['uid_map'].values()),
+            'added': sorted(added),
             'removed': [],
             'flags_changed': [],
         }
@@ -1,19 +1,21 @@
 import Queue
 import threading
 import logging
+import time
+import heapq
 from collections import deque
 import monocle
 
-try:
-    from async_cocoa import call_on_main_thread
-except ImportError:
-    def call_on_main_thread(callback, *args, **kwargs):
-        raise NotImplementedError
-
 log = logging.getLogger(__name__)
 
+# priority classes of clients waiting for a worker; lower values go first
+PRIORITY_INTERACTIVE = 0 # the user is waiting, e.g. to read a message
+PRIORITY_USER = 1 # actions the user asked for, e.g. changing flags
+PRIORITY_BACKGROUND = 2 # synchronization
+
 class AsyncJob(object):
     failure = None
+    priority = PRIORITY_BACKGROUND
 
     @monocle.o
     def start(self):
@@ -31,7 +33,165 @@ class AsyncJob(object):
     def do_stuff(self):
         pass
 
-def worker_loop(in_queue, worker):
+class AsyncLock(object):
+    """
+    A mutex for o-routines. Clients waiting in `acquire` get the lock in the
+    order they asked for it.
+    """
+
+    def __init__(self):
+        self.locked = False
+        self._waiting = deque()
+
+    def acquire(self):
+        """ Returns a Callback that fires once the lock is ours. """
+        cb = monocle.callback.Callback()
+        if self.locked:
+            self._waiting.append(cb)
+        else:
+            self.locked = True
+            cb(None)
+        return cb
+
+    def try_acquire(self):
+        """ Take the lock if it's free; never wait. """
+        if self.locked:
+            return False
+        self.locked = True
+        return True
+
+    def release(self):
+        assert self.locked, "Lock is not held"
+        if self._waiting:
+            self._waiting.popleft()(None)
+        else:
+            self.locked = False
+
+class ClientQueue(object):
+    """
+    Clients waiting for a worker, served by priority and then in the order
+    they arrived. `wait_stats` holds `(count, total, max)` of the seconds
+    clients of each priority spent in the queue.
+    """
+
+    def __init__(self, clock=time.time):
+        self._clock = clock
+        self._heap = []
+        self._counter = 0
+        self.wait_stats = {}
+
+    def __len__(self):
+        return len(self._heap)
+
+    def append(self, cb, priority=PRIORITY_BACKGROUND):
+        self._counter += 1
+        heapq.heappush(self._heap,
+                       (priority, self._counter, self._clock(), cb))
+
+    def popleft(self):
+        priority, counter, queued_at, cb = heapq.heappop(self._heap)
+        wait = self._clock() - queued_at
+        count, total, longest = self.wait_stats.get(priority, (0, 0, 0))
+        self.wait_stats[priority] = (count + 1, total + wait,
+                                     max(longest, wait))
+        log.debug("Client with priority %d waited %.3f seconds for a worker",
+                  priority, wait)
+        return cb
+
+    def has_waiting(self, priority):
+        """ Is a client more urgent than `priority` waiting? """
+        return bool(self._heap) and self._heap[0][0] < priority
+
+class Dispatcher(object):
+    """
+    Hands worker results to the main thread. Results that arrive while
+    earlier ones are still waiting for the main thread are delivered with
+    them, so a busy sync wakes up the main loop once per tick rather than
+    once per IMAP command. Subclasses say how to wake up the main thread;
+    there is none here.
+    """
+
+    clock = staticmethod(time.time)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = []
+        self._wake_up_pending = False
+        self.wakeups = 0
+        self.delivered = 0
+        self.max_depth = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    @property
+    def queue_depth(self):
+        """ Results waiting for the main thread. """
+        return len(self._pending)
+
+    def post(self, callback, *args):
+        """ Call `callback(*args)` on the main thread; from any thread. """
+        with self._lock:
+            self._pending.append((self.clock(), callback, args))
+            self.max_depth = max(self.max_depth, len(self._pending))
+            wake_up = not self._wake_up_pending
+            self._wake_up_pending = True
+        if wake_up:
+            self._wake_up()
+
+    def deliver(self):
+        """ Run the waiting callbacks; on the main thread. """
+        with self._lock:
+            pending = self._pending
+            self._pending = []
+            self._wake_up_pending = False
+        if not pending:
+            return
+        self.wakeups += 1
+
+        now = self.clock()
+        for posted, callback, args in pending:
+            latency = now - posted
+            self.delivered += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            try:
+                callback(*args)
+            except Exception:
+                log.exception("Error in callback on main thread")
+        log.debug("Delivered %d worker results, %.3f seconds after the "
+                  "first was posted", len(pending), now - pending[0][0])
+
+    def _wake_up(self):
+        raise NotImplementedError
+
+class LoopDispatcher(Dispatcher):
+    """
+    Delivers results from a main loop's thread-safe `call_soon(func)`,
+    e.g. `AppHelper.callAfter` or `async_thread.MainLoop`.
+    """
+
+    def __init__(self, call_soon):
+        super(LoopDispatcher, self).__init__()
+        self._call_soon = call_soon
+
+    def _wake_up(self):
+        self._call_soon(self.deliver)
+
+class SyncDispatcher(Dispatcher):
+    """ Delivers each result right away, in the worker's thread; for tests. """
+
+    def _wake_up(self):
+        self.deliver()
+
+try:
+    from async_cocoa import call_on_main_thread
+except ImportError:
+    # no Cocoa; `async_thread.MainLoop.installed` provides a dispatcher
+    dispatcher = None
+else:
+    dispatcher = LoopDispatcher(call_on_main_thread)
+
+def worker_loop(in_queue, worker, dispatcher):
     while True:
         msg = in_queue.get()
         if msg is None:
@@ -39,15 +199,16 @@ def worker_loop(in_queue, worker):
         try:
             callback, method, args, kwargs = msg
             result = getattr(worker, method)(*args, **kwargs)
-            call_on_main_thread(callback, result)
+            dispatcher.post(callback, result)
         except Exception, e:
             monocle.core._add_monocle_tb(e)
-            call_on_main_thread(callback, e)
+            dispatcher.post(callback, e)
 
 class AsyncWorkerProxy(object):
-    def __init__(self, in_queue, thread):
+    def __init__(self, in_queue, thread, worker):
         self._in_queue = in_queue
         self._thread = thread
+        self._worker = worker
 
     def __getattr__(self, name):
         @monocle.o
@@ -57,15 +218,31 @@ class AsyncWorkerProxy(object):
             return callback
         return method_proxy
 
+    def interrupt(self):
+        """
+        Call the worker's `interrupt` method right away, from this thread,
+        to abort whatever call the worker thread is blocked in.
+        """
+        self._worker.interrupt()
+
     def done(self):
         self._in_queue.put(None)
         self._thread.join()
 
 def start_worker(worker):
+    if dispatcher is None:
+        # the worker's results would have nowhere to go
+        raise RuntimeError("No main loop to deliver worker results to; run "
+                           "workers within `MainLoop.installed()`")
     in_queue = Queue.Queue()
-    thread = threading.Thread(target=worker_loop, args=(in_queue, worker))
+    # results go to the main loop the worker was started in, even if its
+    # last ones arrive after another one is installed
+    thread = threading.Thread(target=worker_loop,
+                              args=(in_queue, worker, dispatcher))
+    # don't keep a headless process alive for a connection that's stuck
+    thread.daemon = True
     thread.start()
-    return AsyncWorkerProxy(in_queue, thread)
+    return AsyncWorkerProxy(in_queue, thread, worker)
 
 class SimpleWorkerManager(object):
     """
@@ -78,18 +255,22 @@ class SimpleWorkerManager(object):
         self._create_worker = create_worker
         self._desotry_worker = destroy_worker
         self._worker_busy = None
-        self._client_queue = deque()
+        self._client_queue = ClientQueue()
 
-    def get_worker(self):
+    def get_worker(self, priority=PRIORITY_BACKGROUND):
         """
         Get a worker. This is called by o-routines and they expect a Callback
         in return.
         """
         cb = monocle.callback.Callback()
-        self._client_queue.append(cb)
+        self._client_queue.append(cb, priority)
         self._dispatch_workers()
         return cb
 
+    def has_waiting_clients(self, priority):
+        """ Is a client more urgent than `priority` waiting for a worker? """
+        return self._client_queue.has_waiting(priority)
+
     def _dispatch_workers(self):
         # Create new workers if we can. Actually, since we can only have one
         # worker, the logic is quite simple.
@@ -114,3 +295,127 @@ class SimpleWorkerManager(object):
         self._worker_busy = False
         self._dispatch_workers()
         return destroy_worker_cb
+
+
+class PooledWorkerManager(object):
+    """
+    A worker manager that keeps workers connected between clients. At most
+    `max_workers` workers exist at any time. Workers idle for `ping_after`
+    seconds or more are health-checked with `ping_worker` before being
+    handed out again, and replaced transparently if the check fails.
+    Workers that stay idle for longer than `idle_timeout` seconds are
+    destroyed when the next client comes along, or when the application
+    calls `close_idle_workers` from a timer.
+    """
+
+    def __init__(self, create_worker, destroy_worker, ping_worker,
+                 max_workers=1, idle_timeout=300, ping_after=5,
+                 clock=time.time):
+        self._create_worker = create_worker
+        self._destroy_worker = destroy_worker
+        self._ping_worker = ping_worker
+        self.max_workers = max_workers
+        self.idle_timeout = idle_timeout
+        self.ping_after = ping_after
+        self._clock = clock
+        self._n_workers = 0 # busy, idle, or being created
+        self._idle_workers = [] # (worker, time handed back), oldest first
+        self._client_queue = ClientQueue(clock)
+
+    def get_worker(self, priority=PRIORITY_BACKGROUND):
+        """
+        Get a worker. This is called by o-routines and they expect a Callback
+        in return. Clients with a lower `priority` value are served first.
+        """
+        cb = monocle.callback.Callback()
+        self._client_queue.append(cb, priority)
+        self._dispatch_workers()
+        return cb
+
+    def has_waiting_clients(self, priority):
+        """
+        Is a client more urgent than `priority` waiting for a worker? Long
+        running clients check this to hand their worker back early.
+        """
+        return self._client_queue.has_waiting(priority)
+
+    @property
+    def wait_stats(self):
+        return self._client_queue.wait_stats
+
+    def hand_back_worker(self, worker):
+        """
+        The client is done with the worker; keep it around for the next one.
+        """
+        self._idle_workers.append((worker, self._clock()))
+        self._dispatch_workers()
+        return monocle.callback.defer(None)
+
+    @monocle.o
+    def close_idle_workers(self, max_idle=None):
+        """
+        Destroy workers that have been idle for more than `max_idle` seconds.
+        Called with no arguments it closes all idle workers.
+        """
+        now = self._clock()
+        keep = []
+        destroyed = []
+        for worker, idle_since in self._idle_workers:
+            if max_idle is None or now - idle_since > max_idle:
+                destroyed.append(self._discard_worker(worker))
+            else:
+                keep.append((worker, idle_since))
+        self._idle_workers[:] = keep
+
+        for cb in destroyed:
+            yield cb
+
+    def _dispatch_workers(self):
+        self.close_idle_workers(self.idle_timeout)
+
+        while self._client_queue:
+            if self._idle_workers:
+                # most recently used worker first, the others may time out
+                worker, idle_since = self._idle_workers.pop()
+                # a worker handed back moments ago is most likely still
+                # connected; skip the round trip
+                ping = self._clock() - idle_since >= self.ping_after
+            elif self._n_workers < self.max_workers:
+                self._n_workers += 1
+                worker = None
+                ping = False
+            else:
+                return
+
+            self._hand_out(self._client_queue.popleft(), worker, ping)
+
+    @monocle.o
+    def _hand_out(self, cb, worker, ping):
+        if ping:
+            try:
+                yield self._ping_worker(worker)
+            except Exception, e:
+                log.info("Idle worker failed health check (%r), "
+                         "reconnecting", e)
+                self._discard_worker(worker)
+                self._n_workers += 1 # the replacement takes over its slot
+                worker = None
+
+        if worker is None:
+            try:
+                worker = yield self._create_worker()
+            except Exception, e:
+                self._n_workers -= 1
+                cb(e)
+                self._dispatch_workers()
+                return
+
+        cb(worker)
+
+    @monocle.o
+    def _discard_worker(self, worker):
+        self._n_workers -= 1
+        try:
+            yield self._destroy_worker(worker)
+        except Exception, e:
+            log.warning("Error while destroying worker: %r", e)
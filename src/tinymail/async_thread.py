@@ -0,0 +1,91 @@
+import Queue
+import heapq
+import itertools
+import logging
+import time
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+# longest wait for a callback in one go; Queue.get can't be interrupted by
+# KeyboardInterrupt while it blocks
+MAX_WAIT = 1.0
+
+class MainLoop(object):
+    """
+    Stands in for the Cocoa run loop where there is no GUI: runs callbacks
+    posted by worker threads, and timers, in the thread that calls `run`.
+    """
+
+    clock = staticmethod(time.time)
+
+    def __init__(self):
+        self._queue = Queue.Queue()
+        self._timers = []
+        self._timer_ids = itertools.count()
+        self._stopped = False
+
+    def call_on_main_thread(self, callback, *args, **kwargs):
+        self._queue.put((callback, args, kwargs))
+
+    def call_later(self, delay, callback, *args, **kwargs):
+        when = self.clock() + delay
+        heapq.heappush(self._timers, (when, next(self._timer_ids),
+                                      callback, args, kwargs))
+
+    def timer_with_callback(self, duration, repeats, callback, *args,
+                            **kwargs):
+        """ Like `async_cocoa.timer_with_callback`. """
+        def fire():
+            if repeats:
+                self.call_later(duration, fire)
+            callback(*args, **kwargs)
+        self.call_later(duration, fire)
+
+    def _call(self, callback, args, kwargs):
+        try:
+            callback(*args, **kwargs)
+        except Exception:
+            log.exception("Error in callback on main thread")
+
+    def run_once(self, timeout=MAX_WAIT):
+        """ Run the timers that are due, then at most one callback. """
+        while self._timers and self._timers[0][0] <= self.clock():
+            _, _, callback, args, kwargs = heapq.heappop(self._timers)
+            self._call(callback, args, kwargs)
+
+        if self._timers:
+            timeout = min(timeout, max(0, self._timers[0][0] - self.clock()))
+        try:
+            callback, args, kwargs = self._queue.get(timeout=timeout)
+        except Queue.Empty:
+            return
+        self._call(callback, args, kwargs)
+
+    def run_until(self, cb):
+        """ Run callbacks until the monocle Callback `cb` fires. """
+        while not hasattr(cb, 'result'):
+            self.run_once()
+        if isinstance(cb.result, Exception):
+            raise cb.result
+        return cb.result
+
+    def run(self):
+        """ Run callbacks and timers until `stop` is called. """
+        self._stopped = False
+        while not self._stopped:
+            self.run_once()
+
+    def stop(self):
+        self._stopped = True
+
+    @contextmanager
+    def installed(self):
+        """ Have `tinymail.async` deliver worker results in this loop. """
+        from tinymail import async
+        orig = async.dispatcher
+        async.dispatcher = async.LoopDispatcher(self.call_on_main_thread)
+        try:
+            yield self
+        finally:
+            async.dispatcher = orig
@@ -0,0 +1,16 @@
+"""
+Benchmarks for tinymail. They run the real job code against a local
+`fake_imap.FakeImapServer`, driving worker callbacks from an
+`async_thread.MainLoop` instead of the Cocoa run loop. Run them as
+scripts, e.g.::
+
+    python -m tinymail.bench.pool
+"""
+
+import time
+from tinymail.async_thread import MainLoop
+
+def timed(func, *args, **kwargs):
+    t0 = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - t0, result
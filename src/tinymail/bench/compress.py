@@ -0,0 +1,63 @@
+"""
+Bytes on the wire and seconds for the first sync of a large folder from a
+fake IMAP server, with and without COMPRESS=DEFLATE. Give `--bandwidth`
+to see what the bytes saved are worth on a slow link.
+"""
+
+import argparse
+import logging
+import monocle
+from tinymail.bench import MainLoop, timed
+from tinymail.bench.fake_imap import single_mailbox_server
+
+CAPABILITIES = ('IMAP4rev1', 'UIDPLUS', 'IDLE', 'UNSELECT',
+                'COMPRESS=DEFLATE')
+
+@monocle.o
+def sync(account):
+    from tinymail.account import AccountUpdateJob
+    yield AccountUpdateJob(account).start()
+
+def cold_sync(server, compress, loop):
+    from tinymail.localdata import open_local_db
+    from tinymail.account import Account
+    config = {'name': 'bench', 'host': '127.0.0.1', 'port': server.port,
+              'ssl': False, 'login_name': 'bench', 'login_pass': 'bench',
+              'compress': compress}
+    account = Account(config, open_local_db(':memory:'))
+    before = dict(server.stats)
+    duration, _ = timed(loop.run_until, sync(account))
+    loop.run_until(account.worker_manager.close_idle_workers())
+    n_messages = len(list(account.get_folder('INBOX').list_messages()))
+    return (duration, n_messages,
+            server.stats['bytes_sent'] - before['bytes_sent'],
+            server.stats['bytes_received'] - before['bytes_received'])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--bandwidth', type=float,
+                        help="server's sending rate, in kB/s")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="seconds per round trip")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    bandwidth = args.bandwidth * 1000 if args.bandwidth else None
+    server = single_mailbox_server(args.messages, latency=args.latency,
+                                   bandwidth=bandwidth,
+                                   capabilities=CAPABILITIES).start()
+    loop = MainLoop()
+    try:
+        with loop.installed():
+            for name, compress in [('plain', False), ('deflate', True)]:
+                duration, n_messages, sent, received = \
+                    cold_sync(server, compress, loop)
+                assert n_messages == args.messages
+                print ("%-8s %7.1f s %10d bytes down %8d bytes up"
+                       % (name, duration, sent, received))
+    finally:
+        server.stop()
+
+if __name__ == '__main__':
+    main()
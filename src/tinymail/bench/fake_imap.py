@@ -0,0 +1,366 @@
+"""
+A small in-memory IMAP server, good enough to drive `ImapWorker` in
+benchmarks. It speaks plain TCP (no TLS), with COMPRESS=DEFLATE if asked
+to, and implements just the commands that tinymail uses.
+"""
+
+import re
+import time
+import socket
+import select
+import threading
+import SocketServer
+import logging
+
+log = logging.getLogger(__name__)
+
+CRLF = '\r\n'
+
+token_pattern = re.compile(r'"((?:[^"\\]|\\.)*)"|\(([^)]*)\)|(\S+)')
+
+def parse_args(line):
+    args = []
+    for m in token_pattern.finditer(line):
+        quoted, parenthesized, atom = m.groups()
+        if quoted is not None:
+            args.append(quoted.replace('\\"', '"').replace('\\\\', '\\'))
+        elif parenthesized is not None:
+            args.append(parenthesized.split())
+        else:
+            args.append(atom)
+    return args
+
+def parse_sequence_set(seq_set, max_value):
+    values = set()
+    for chunk in seq_set.split(','):
+        if ':' in chunk:
+            start, end = chunk.split(':')
+            start = max_value if start == '*' else int(start)
+            end = max_value if end == '*' else int(end)
+            if start > end:
+                start, end = end, start
+            values.update(xrange(start, end + 1))
+        else:
+            values.add(max_value if chunk == '*' else int(chunk))
+    return values
+
+def make_message(uid, subject="Test message", body_size=1024):
+    headers = ('From: sender%d@example.com\r\n'
+               'To: someone@example.com\r\n'
+               'Subject: %s %d\r\n'
+               'Date: Mon, 14 Mar 2011 10:00:00 +0000\r\n'
+               'Message-ID: <%d@example.com>\r\n'
+               '\r\n' % (uid, subject, uid, uid))
+    return headers + ('x' * 76 + '\r\n') * (body_size // 78)
+
+class ConnectionClosed(Exception):
+    pass
+
+class FakeMailbox(object):
+    def __init__(self, uidvalidity=1234):
+        self.uidvalidity = uidvalidity
+        self.messages = [] # [uid, flags, raw], ordered by uid
+        self.uidnext = 1
+
+    def add_message(self, raw, flags=()):
+        self.messages.append([self.uidnext, set(flags), raw])
+        self.uidnext += 1
+
+class MeteredSocket(object):
+    """
+    Counts the bytes that go through `sock` in `stats`; with `bandwidth`
+    (bytes per second), sending takes as long as on a link that slow.
+    """
+
+    def __init__(self, sock, stats, bandwidth=None):
+        self.sock = sock
+        self.stats = stats
+        self.bandwidth = bandwidth
+
+    def recv(self, size):
+        data = self.sock.recv(size)
+        self.stats['bytes_received'] += len(data)
+        return data
+
+    def sendall(self, data):
+        self.stats['bytes_sent'] += len(data)
+        if self.bandwidth:
+            time.sleep(len(data) / float(self.bandwidth))
+        self.sock.sendall(data)
+
+class ImapHandler(SocketServer.StreamRequestHandler):
+    wbufsize = -1 # buffer output, flushed after each tagged response
+
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.wire = MeteredSocket(self.connection, self.server.stats,
+                                  self.server.bandwidth)
+        self._open_files(self.wire)
+
+    def _open_files(self, sock):
+        self.rfile = socket._fileobject(sock, 'rb', self.rbufsize)
+        self.wfile = socket._fileobject(sock, 'wb', self.wbufsize)
+
+    def handle(self):
+        self.selected = None
+        self.readonly = True
+        self.start_deflate = False
+        server = self.server
+        if server.connect_delay:
+            time.sleep(server.connect_delay)
+        self.respond('* OK fake IMAP server ready')
+        self.wfile.flush()
+
+        while True:
+            # a command that's here already was sent without waiting for
+            # the reply before it; it costs no round trip
+            pipelined = self._input_pending()
+            line = self.rfile.readline()
+            if not line:
+                return
+            line = line.rstrip(CRLF)
+            tag, _, rest = line.partition(' ')
+            name, _, arg_line = rest.partition(' ')
+            name = name.upper()
+            if not pipelined:
+                server.stats['round_trips'] += 1
+                if server.latency:
+                    time.sleep(server.latency)
+            server.stats['commands'] += 1
+
+            handler = getattr(self, 'cmd_' + name, None)
+            if handler is None:
+                self.respond('%s BAD unknown command %s' % (tag, name))
+                self.wfile.flush()
+                continue
+
+            try:
+                result = handler(arg_line)
+            except ConnectionClosed:
+                return
+            except Exception, e:
+                log.exception("Error handling %r", line)
+                self.respond('%s BAD %s' % (tag, e))
+                self.wfile.flush()
+                continue
+
+            if result is None:
+                result = '%s completed' % name
+            self.respond('%s OK %s' % (tag, result))
+            self.wfile.flush()
+            if name == 'LOGOUT':
+                return
+            if self.start_deflate:
+                from tinymail.imap_worker import DeflateSocket
+                self._open_files(DeflateSocket(self.wire))
+                self.start_deflate = False
+
+    def _input_pending(self):
+        if self.rfile._rbuf.tell():
+            return True
+        readable, _, _ = select.select([self.connection], [], [], 0)
+        return bool(readable)
+
+    def respond(self, line, literal=None):
+        if literal is not None:
+            data = '%s {%d}%s%s' % (line, len(literal), CRLF, literal)
+        else:
+            data = line + CRLF
+        self.wfile.write(data)
+
+    def _mailbox(self):
+        return self.server.mailboxes[self.selected]
+
+    def cmd_CAPABILITY(self, arg_line):
+        self.respond('* CAPABILITY ' + ' '.join(self.server.capabilities))
+
+    def cmd_LOGIN(self, arg_line):
+        pass
+
+    def cmd_NOOP(self, arg_line):
+        pass
+
+    def cmd_LOGOUT(self, arg_line):
+        self.respond('* BYE logging out')
+
+    def cmd_COMPRESS(self, arg_line):
+        assert 'COMPRESS=DEFLATE' in self.server.capabilities
+        assert arg_line.upper() == 'DEFLATE', 'only DEFLATE is supported'
+        self.start_deflate = True
+        return 'DEFLATE active'
+
+    def cmd_LIST(self, arg_line):
+        for name in sorted(self.server.mailboxes):
+            self.respond('* LIST (\\HasNoChildren) "." "%s"' % name)
+
+    def cmd_SELECT(self, arg_line, readonly=False):
+        [name] = parse_args(arg_line)
+        mbox = self.server.mailboxes[name]
+        self.selected = name
+        self.readonly = readonly
+        self.respond('* FLAGS (\\Answered \\Flagged \\Deleted \\Seen)')
+        self.respond('* %d EXISTS' % len(mbox.messages))
+        self.respond('* 0 RECENT')
+        self.respond('* OK [UIDVALIDITY %d]' % mbox.uidvalidity)
+        self.respond('* OK [UIDNEXT %d]' % mbox.uidnext)
+        return '[READ-%s] selected' % ('ONLY' if readonly else 'WRITE')
+
+    def cmd_EXAMINE(self, arg_line):
+        return self.cmd_SELECT(arg_line, readonly=True)
+
+    def cmd_STATUS(self, arg_line):
+        name, items = parse_args(arg_line)
+        mbox = self.server.mailboxes[name]
+        values = {'MESSAGES': len(mbox.messages), 'RECENT': 0,
+                  'UIDNEXT': mbox.uidnext, 'UIDVALIDITY': mbox.uidvalidity,
+                  'UNSEEN': sum(1 for m in mbox.messages
+                                if '\\Seen' not in m[1])}
+        status = ' '.join('%s %d' % (item, values[item]) for item in items)
+        self.respond('* STATUS "%s" (%s)' % (name, status))
+
+    def cmd_IDLE(self, arg_line):
+        # report new messages until the client says DONE
+        mbox = self._mailbox()
+        seen = len(mbox.messages)
+        self.respond('+ idling')
+        self.wfile.flush()
+        while True:
+            readable, _, _ = select.select([self.connection], [], [], .05)
+            if readable:
+                line = self.rfile.readline()
+                if not line:
+                    raise ConnectionClosed
+                assert line.rstrip(CRLF).upper() == 'DONE'
+                return 'IDLE terminated'
+            if len(mbox.messages) != seen:
+                seen = len(mbox.messages)
+                self.respond('* %d EXISTS' % seen)
+                self.wfile.flush()
+
+    def cmd_CLOSE(self, arg_line):
+        self.selected = None
+
+    def cmd_UNSELECT(self, arg_line):
+        self.selected = None
+
+    def _select_messages(self, seq_set, by_uid):
+        messages = self._mailbox().messages
+        if not messages:
+            return []
+        if by_uid:
+            wanted = parse_sequence_set(seq_set, messages[-1][0])
+            return [(i + 1, m) for i, m in enumerate(messages)
+                    if m[0] in wanted]
+        else:
+            wanted = parse_sequence_set(seq_set, len(messages))
+            return [(i, messages[i - 1]) for i in sorted(wanted)
+                    if 0 < i <= len(messages)]
+
+    def cmd_FETCH(self, arg_line, by_uid=False):
+        seq_set, item_line = arg_line.split(' ', 1)
+        items = item_line.strip('()').upper().split()
+        if by_uid and 'UID' not in items:
+            items.insert(0, 'UID')
+        for index, (uid, flags, raw) in self._select_messages(seq_set, by_uid):
+            parts = []
+            literal = None
+            for item in items:
+                if item == 'UID':
+                    parts.append('UID %d' % uid)
+                elif item == 'FLAGS':
+                    parts.append('FLAGS (%s)' % ' '.join(sorted(flags)))
+                elif item in ('BODY.PEEK[HEADER]', 'BODY[HEADER]'):
+                    literal = raw[:raw.index('\r\n\r\n') + 4]
+                    literal_name = 'BODY[HEADER]'
+                elif item in ('RFC822', 'BODY.PEEK[]', 'BODY[]'):
+                    literal = raw
+                    literal_name = 'RFC822' if item == 'RFC822' else 'BODY[]'
+            if literal is None:
+                self.respond('* %d FETCH (%s)' % (index, ' '.join(parts)))
+            else:
+                prefix = ' '.join(parts + [literal_name])
+                self.respond('* %d FETCH (%s' % (index, prefix), literal)
+                self.respond(')')
+
+    def cmd_SEARCH(self, arg_line, by_uid=False):
+        assert arg_line.upper() == 'ALL', 'only SEARCH ALL is supported'
+        found = [str(uid if by_uid else index) for index, (uid, flags, raw)
+                 in enumerate(self._mailbox().messages, 1)]
+        self.respond(' '.join(['* SEARCH'] + found))
+
+    def cmd_STORE(self, arg_line, by_uid=False):
+        seq_set, operation, flag_line = arg_line.split(' ', 2)
+        new_flags = set(flag_line.strip('()').split())
+        for index, message in self._select_messages(seq_set, by_uid):
+            if operation.upper().startswith('+'):
+                message[1] |= new_flags
+            elif operation.upper().startswith('-'):
+                message[1] -= new_flags
+            else:
+                message[1] = set(new_flags)
+            self.respond('* %d FETCH (FLAGS (%s))' %
+                         (index, ' '.join(sorted(message[1]))))
+
+    def cmd_COPY(self, arg_line, by_uid=False):
+        seq_set, target_line = arg_line.split(' ', 1)
+        [target_name] = parse_args(target_line)
+        target = self.server.mailboxes[target_name]
+        src_uids, dst_uids = [], []
+        for index, (uid, flags, raw) in self._select_messages(seq_set, by_uid):
+            src_uids.append(str(uid))
+            dst_uids.append(str(target.uidnext))
+            target.add_message(raw, flags)
+        return '[COPYUID %d %s %s] Copy completed.' % (
+            target.uidvalidity, ','.join(src_uids), ','.join(dst_uids))
+
+    def cmd_UID(self, arg_line):
+        name, rest = arg_line.split(' ', 1)
+        handler = getattr(self, 'cmd_' + name.upper())
+        return handler(rest, by_uid=True)
+
+class FakeImapServer(SocketServer.ThreadingTCPServer):
+    """
+    Serve `mailboxes` (a dict of `FakeMailbox` objects, by name) on a local
+    port. `connect_delay` is slept before the greeting, to mimic a TLS
+    handshake; `latency` is slept before handling each command that the
+    client sent after reading the reply to the one before, i.e. once per
+    round trip, and `bandwidth` (bytes per second) limits how fast
+    responses are sent. `stats` counts commands, round trips and bytes on
+    the wire.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, mailboxes, connect_delay=0, latency=0, bandwidth=None,
+                 capabilities=('IMAP4rev1', 'UIDPLUS', 'IDLE', 'UNSELECT')):
+        SocketServer.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0),
+                                                 ImapHandler)
+        self.mailboxes = mailboxes
+        self.connect_delay = connect_delay
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.capabilities = list(capabilities)
+        self.stats = {'commands': 0, 'round_trips': 0,
+                      'bytes_sent': 0, 'bytes_received': 0}
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+def single_mailbox_server(n_messages, name='INBOX', **kwargs):
+    mbox = FakeMailbox()
+    for i in xrange(n_messages):
+        mbox.add_message(make_message(mbox.uidnext))
+    return FakeImapServer({name: mbox}, **kwargs)
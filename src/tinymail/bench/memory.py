@@ -0,0 +1,88 @@
+"""
+Bytes per loaded message, with `Message` as it is and with the plain
+object it used to be: a `__dict__`, a set of flags and the raw headers
+for each message.
+"""
+
+import argparse
+import random
+import sys
+
+FLAG_CHOICES = [set(), set([r'\Seen']), set([r'\Seen', r'\Answered']),
+                set([r'\Seen', r'\Flagged']), set(['$Junk'])]
+
+class DictMessage(object):
+    """ The old `Message`, without its methods. """
+
+    def __init__(self, folder, uid, flags, raw_headers, summary):
+        self.folder = folder
+        self.uid = uid
+        self.flags = flags
+        self.raw_headers = raw_headers
+        self.subject, self.sender, self.date = summary
+        self.raw_full = None
+        self._load_job = None
+
+def deep_size(objects, skip=()):
+    """ Bytes used by `objects` and all they refer to, each counted once. """
+    seen = set(id(obj) for obj in skip)
+    total = 0
+    stack = list(objects)
+    while stack:
+        obj = stack.pop()
+        if obj is None or id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.iterkeys())
+            stack.extend(obj.itervalues())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        if hasattr(obj, '__dict__'):
+            stack.append(obj.__dict__)
+        for name in getattr(type(obj), '__slots__', ()):
+            stack.append(getattr(obj, name, None))
+    return total
+
+def fill_folder(db, n_messages):
+    rand = random.Random(0)
+    with db.transaction():
+        db_folder = db.get_account('bench').add_folder('INBOX')
+        db_folder.bulk_add_messages([
+            (uid, rand.choice(FLAG_CHOICES),
+             "From: user%d@example.com\r\n"
+             "To: bench@example.com\r\n"
+             "Message-ID: <%d@example.com>\r\n"
+             "Date: Mon, 14 Mar 2011 10:00:00 +0000\r\n"
+             "Subject: message number %d\r\n\r\n" % (uid % 500, uid, uid))
+            for uid in xrange(1, n_messages + 1)])
+    return db_folder
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=100000)
+    args = parser.parse_args()
+
+    from tinymail.localdata import open_local_db
+    from tinymail.account import Account
+    db = open_local_db(':memory:')
+    db_folder = fill_folder(db, args.messages)
+    config = {'name': 'bench', 'host': '127.0.0.1',
+              'login_name': 'bench', 'login_pass': 'bench'}
+    account = Account(config, db)
+    folder = account.get_folder('INBOX')
+
+    old = [DictMessage(folder, *row)
+           for row in db_folder.list_messages(summary=True)]
+    old_size = deep_size(old, skip=[folder, old])
+    del old
+
+    new = list(folder.list_messages())
+    new_size = deep_size(new, skip=[folder, new])
+
+    for name, size in [('dict', old_size), ('slots', new_size)]:
+        print "%-6s %6.0f bytes/message" % (name, size / args.messages)
+
+if __name__ == '__main__':
+    main()
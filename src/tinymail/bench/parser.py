@@ -0,0 +1,84 @@
+"""
+Seconds to read and parse the response to a FETCH FLAGS of every message
+in a large mailbox: as it used to be, with imaplib's response assembly
+and regular expressions, and with `ImapWorker.get_message_flags` reading
+the responses with `imap_parser`. The server's replies are canned, so
+that only the client is measured.
+"""
+
+import argparse
+import imaplib
+import random
+import re
+from cStringIO import StringIO
+from tinymail.bench import timed
+
+FLAG_CHOICES = ['', r'\Seen', r'\Seen \Answered', r'\Seen \Flagged', '$Junk']
+
+fetch_uid_pattern = re.compile(r'\bUID (?P<uid>\d+)')
+
+fetch_flags_pattern = re.compile(r'\bFLAGS \((?P<flags>[^\)]*)\)')
+
+class CannedIMAP4(imaplib.IMAP4):
+    """ Answers every command but CAPABILITY with `untagged` and an OK. """
+
+    def __init__(self, untagged):
+        self.untagged = untagged
+        imaplib.IMAP4.__init__(self)
+
+    def open(self, host='', port=imaplib.IMAP4_PORT):
+        self.file = StringIO('* PREAUTH ready\r\n')
+
+    def send(self, data):
+        tag, command = data.split()[:2]
+        if command == 'CAPABILITY':
+            untagged = '* CAPABILITY IMAP4rev1\r\n'
+        else:
+            untagged = self.untagged
+        self.file = StringIO('%s%s OK done\r\n' % (untagged, tag))
+
+    def shutdown(self):
+        pass
+
+def fetch_flags_response(n_messages):
+    rand = random.Random(0)
+    return ''.join('* %d FETCH (UID %d FLAGS (%s))\r\n'
+                   % (seq, seq * 2, rand.choice(FLAG_CHOICES))
+                   for seq in xrange(1, n_messages + 1))
+
+def regex_flags(conn):
+    flags = {}
+    for item in conn.uid('FETCH', '1:*', '(FLAGS)')[1]:
+        uid = int(fetch_uid_pattern.search(item).group('uid'))
+        m = fetch_flags_pattern.search(item)
+        flags[uid] = m.group('flags').split()
+    return flags
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    from tinymail.imap_worker import ImapWorker, ConnectionErrorWrapper
+    conn = CannedIMAP4(fetch_flags_response(args.messages))
+    conn.state = 'SELECTED'
+    worker = ImapWorker()
+    worker.conn = ConnectionErrorWrapper(conn)
+    worker.message_count = args.messages
+
+    paths = [('regex', lambda: regex_flags(conn)),
+             ('parser', worker.get_message_flags)]
+    durations = dict((name, []) for name, func in paths)
+    results = {}
+    for run in xrange(args.runs):
+        # take turns, so that both see the same load on the machine
+        for name, func in paths:
+            duration, results[name] = timed(func)
+            durations[name].append(duration)
+    assert results['regex'] == results['parser']
+    for name, func in paths:
+        print "%-8s %6.3f s" % (name, min(durations[name]))
+
+if __name__ == '__main__':
+    main()
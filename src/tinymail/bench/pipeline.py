@@ -0,0 +1,88 @@
+"""
+Round trips and seconds for syncing many small folders from a fake IMAP
+server with some `--latency`: once with SELECT, STATUS and the flags FETCH
+of each folder pipelined, once with each command waiting for its reply.
+"""
+
+import argparse
+import logging
+import monocle
+from tinymail.bench import MainLoop, timed
+from tinymail.bench.fake_imap import FakeImapServer, FakeMailbox
+from tinymail.bench.fake_imap import make_message
+from tinymail.imap_parser import StatusRecord
+
+def select_then_get_flags(self, name, modseq=None):
+    """
+    `ImapWorker.select_and_get_flags` without pipelining, for a cold sync:
+    one round trip for each command.
+    """
+    name = name.encode('ascii')
+    self.conn.select(name, readonly=True)
+    self.selected_mailbox = name
+    self.selected_readonly = True
+    [record] = self._records(StatusRecord, 'STATUS', name,
+                             '(MESSAGES UIDNEXT UIDVALIDITY)')
+    mailbox_status = record.items
+    self.message_count = mailbox_status['MESSAGES']
+    changes = {'flags': self.get_message_flags(), 'vanished': None,
+               'since': None}
+    return mailbox_status, changes
+
+def fake_server(n_folders, n_messages, latency):
+    mailboxes = {}
+    for i in xrange(n_folders):
+        mbox = mailboxes['folder%03d' % i] = FakeMailbox()
+        for j in xrange(n_messages):
+            mbox.add_message(make_message(mbox.uidnext, body_size=200))
+    return FakeImapServer(mailboxes, latency=latency)
+
+@monocle.o
+def sync(account):
+    from tinymail.account import AccountUpdateJob
+    yield AccountUpdateJob(account).start()
+
+def cold_sync(server, loop):
+    from tinymail.localdata import open_local_db
+    from tinymail.account import Account
+    config = {'name': 'bench', 'host': '127.0.0.1', 'port': server.port,
+              'ssl': False, 'login_name': 'bench', 'login_pass': 'bench'}
+    account = Account(config, open_local_db(':memory:'))
+    before = dict(server.stats)
+    duration, _ = timed(loop.run_until, sync(account))
+    loop.run_until(account.worker_manager.close_idle_workers())
+    n_messages = sum(len(list(folder.list_messages()))
+                     for folder in account.list_folders())
+    return (duration, n_messages,
+            server.stats['round_trips'] - before['round_trips'],
+            server.stats['commands'] - before['commands'])
+
+def main():
+    from tinymail.imap_worker import ImapWorker
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--folders', type=int, default=50)
+    parser.add_argument('--messages', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help="seconds per round trip")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    server = fake_server(args.folders, args.messages, args.latency).start()
+    loop = MainLoop()
+    pipelined = ImapWorker.select_and_get_flags
+    try:
+        with loop.installed():
+            for name, method in [('serial', select_then_get_flags),
+                                 ('pipelined', pipelined)]:
+                ImapWorker.select_and_get_flags = method
+                duration, n_messages, round_trips, commands = \
+                    cold_sync(server, loop)
+                assert n_messages == args.folders * args.messages
+                print ("%-10s %6.2f s %5d round trips %5d commands"
+                       % (name, duration, round_trips, commands))
+    finally:
+        ImapWorker.select_and_get_flags = pipelined
+        server.stop()
+
+if __name__ == '__main__':
+    main()
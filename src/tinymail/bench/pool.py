@@ -0,0 +1,82 @@
+"""
+Jobs per second with connect-per-job (`SimpleWorkerManager`) versus pooled
+connections (`PooledWorkerManager`), loading message bodies from a fake IMAP
+server.
+"""
+
+import argparse
+import logging
+import monocle
+from tinymail import async
+from tinymail.bench import MainLoop, timed
+from tinymail.bench.fake_imap import single_mailbox_server
+
+def account_for_server(server, max_connections):
+    from tinymail.localdata import open_local_db
+    from tinymail.account import Account
+    config = {'name': 'bench', 'host': '127.0.0.1', 'port': server.port,
+              'ssl': False, 'login_name': 'bench', 'login_pass': 'bench',
+              'max_connections': max_connections}
+    return Account(config, open_local_db(':memory:'))
+
+@monocle.o
+def sync(account):
+    from tinymail.account import AccountUpdateJob
+    yield AccountUpdateJob(account).start()
+
+@monocle.o
+def load_bodies(account, n_jobs):
+    from tinymail.account import MessageLoadFullJob
+    messages = sorted(account.get_folder('INBOX').list_messages(),
+                      key=lambda m: m.uid)
+    jobs = [MessageLoadFullJob(messages[i % len(messages)]).start()
+            for i in xrange(n_jobs)]
+    for cb in jobs:
+        yield cb
+
+def run(manager, n_jobs, max_connections, server, loop):
+    from tinymail.async import SimpleWorkerManager
+    account = account_for_server(server, max_connections)
+    loop.run_until(sync(account))
+    pool = account.worker_manager
+    loop.run_until(pool.close_idle_workers())
+    if manager == 'simple':
+        account.worker_manager = SimpleWorkerManager(account._create_worker,
+                                                     account._desotry_worker)
+    duration, _ = timed(loop.run_until, load_bodies(account, n_jobs))
+    loop.run_until(pool.close_idle_workers())
+    return n_jobs / duration
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--jobs', type=int, default=200)
+    parser.add_argument('--messages', type=int, default=50)
+    parser.add_argument('--connect-delay', type=float, default=0.02,
+                        help="seconds slept before greeting (TLS stand-in)")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="seconds per round trip")
+    parser.add_argument('--max-connections', type=int, default=1)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    server = single_mailbox_server(args.messages,
+                                   connect_delay=args.connect_delay,
+                                   latency=args.latency).start()
+    loop = MainLoop()
+    try:
+        with loop.installed():
+            for manager in ('simple', 'pooled'):
+                rate = run(manager, args.jobs, args.max_connections,
+                           server, loop)
+                print "%-8s %8.1f jobs/s" % (manager, rate)
+            dispatcher = async.dispatcher
+            print ("%d worker results in %d main loop wakeups, "
+                   "at most %d queued, %.2f ms mean latency"
+                   % (dispatcher.delivered, dispatcher.wakeups,
+                      dispatcher.max_depth, 1000 * dispatcher.total_latency
+                      / max(1, dispatcher.delivered)))
+    finally:
+        server.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+Milliseconds per query of the local search index, in a folder of generated
+messages, some of them with a cached body.
+"""
+
+import argparse
+import random
+from tinymail.bench import timed
+
+WORDS = ("lunch meeting report invoice travel budget minutes draft review "
+         "release party weekend project server backup holiday contract "
+         "schedule agenda notes").split()
+
+QUERIES = [u"lunch", u"budget review", u"rel", u"holiday contract notes"]
+
+def fill_folder(db, n_messages, n_bodies):
+    rand = random.Random(0)
+    with db.transaction():
+        db_folder = db.get_account('bench').add_folder('INBOX')
+        messages = []
+        for uid in xrange(1, n_messages + 1):
+            subject = ' '.join(rand.sample(WORDS, 4))
+            raw_headers = ("From: user%d@example.com\r\n"
+                           "To: bench@example.com\r\n"
+                           "Subject: %s\r\n\r\n"
+                           % (rand.randrange(500), subject))
+            messages.append((uid, set(), raw_headers))
+        db_folder.bulk_add_messages(messages)
+        for uid in rand.sample(xrange(1, n_messages + 1), n_bodies):
+            body = ' '.join(rand.choice(WORDS) for i in xrange(200))
+            db_folder.set_message_body(uid, "\r\n" + body)
+    return db_folder
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--bodies', type=int, default=2000)
+    parser.add_argument('--limit', type=int, default=50)
+    parser.add_argument('--db', default=':memory:')
+    args = parser.parse_args()
+
+    from tinymail.localdata import open_local_db
+    db = open_local_db(args.db)
+    duration, db_folder = timed(fill_folder, db, args.messages, args.bodies)
+    print "indexed %d messages in %.1f s" % (args.messages, duration)
+
+    for query in QUERIES:
+        duration, uids = timed(db_folder.search_messages, query,
+                               limit=args.limit)
+        print "%-24s %8.1f ms" % (query, duration * 1000)
+
+if __name__ == '__main__':
+    main()
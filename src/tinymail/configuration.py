@@ -0,0 +1,18 @@
+import os.path
+import json
+
+class Configuration(object):
+    def __init__(self, home):
+        self.home = home
+        cfg_path = os.path.join(self.home, 'account.json')
+        with open(cfg_path, 'rb') as f:
+            self.settings = json.loads(f.read())
+
+def open_db(configuration):
+    from tinymail.localdata import open_local_db
+    db_path = os.path.join(configuration.home, 'db.sqlite3')
+    kwargs = {}
+    if 'body_cache_mb' in configuration.settings:
+        kwargs['body_cache_size'] = (configuration.settings['body_cache_mb']
+                                     * 1024 * 1024)
+    return open_local_db(db_path, **kwargs)
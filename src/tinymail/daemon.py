@@ -0,0 +1,157 @@
+"""
+Keep the accounts of a tinymail home directory in sync with their servers,
+without the GUI. The same jobs as in the app run from an
+`async_thread.MainLoop`, in this thread, instead of the Cocoa run loop.
+"""
+
+import argparse
+import logging
+import os.path
+import signal
+import time
+from tinymail.account import Account, folder_updated, POOL_CHECK_INTERVAL
+from tinymail.account import sync_started, sync_finished
+from tinymail.async_thread import MainLoop
+from tinymail.configuration import Configuration, open_db
+
+log = logging.getLogger(__name__)
+
+# minutes between polls, unless the configuration has `auto_sync`
+DEFAULT_SYNC_INTERVAL = 10
+
+# seconds to wait for running jobs to finish when shutting down
+SHUTDOWN_TIMEOUT = 30
+
+class SyncDaemon(object):
+    """
+    Sync every account of `configuration` now and then every `interval`
+    minutes, keeping folders in `push_folders` up to date with IDLE; the
+    scheduled syncs cover all other folders, see `Account.auto_sync`.
+    `progress` has the state of each account's sync, by account name.
+    """
+
+    clock = staticmethod(time.time)
+
+    def __init__(self, configuration, db, loop, interval=None):
+        settings = configuration.settings
+        if interval is None:
+            interval = settings.get('auto_sync', DEFAULT_SYNC_INTERVAL)
+        self.interval = interval
+        self.loop = loop
+        self.accounts = {}
+        self.progress = {}
+        sync_started.connect(self._sync_started)
+        sync_finished.connect(self._sync_finished)
+        folder_updated.connect(self._folder_updated)
+        for account_config in settings['accounts']:
+            account = Account(account_config, db)
+            self.accounts[account.name] = account
+            self.progress[account.name] = {
+                'state': 'idle', 'started': None, 'finished': None,
+                'error': None, 'added': 0, 'removed': 0,
+            }
+
+    def _progress_for(self, account):
+        if self.accounts.get(account.name) is account:
+            return self.progress[account.name]
+        return None
+
+    def _sync_started(self, account):
+        progress = self._progress_for(account)
+        if progress is not None:
+            progress.update(state='syncing', started=self.clock(),
+                            error=None, added=0, removed=0)
+
+    def _sync_finished(self, account, error):
+        progress = self._progress_for(account)
+        if progress is None:
+            return
+        progress.update(state='failed' if error else 'idle',
+                        finished=self.clock(), error=error)
+        if error:
+            log.warning("Sync of account %r failed: %s", account.name, error)
+        else:
+            log.info("Synced account %r in %.1f s, %d new messages, "
+                     "%d removed", account.name,
+                     progress['finished'] - progress['started'],
+                     progress['added'], progress['removed'])
+
+    def _folder_updated(self, folder, added, removed, flags_changed):
+        progress = self._progress_for(folder.account)
+        if progress is not None:
+            progress['added'] += len(added)
+            progress['removed'] += len(removed)
+
+    def is_syncing(self):
+        return any(progress['state'] == 'syncing'
+                   for progress in self.progress.itervalues())
+
+    def start(self, push=True):
+        for account in self.accounts.itervalues():
+            account.perform_update()
+            if push:
+                account.start_push()
+        if push:
+            self.loop.timer_with_callback(self.interval * 60, True,
+                                          self.auto_sync)
+            self.loop.timer_with_callback(POOL_CHECK_INTERVAL, True,
+                                          self.close_idle_connections)
+
+    def auto_sync(self):
+        for account in self.accounts.itervalues():
+            account.auto_sync()
+
+    def close_idle_connections(self):
+        for account in self.accounts.itervalues():
+            account.close_idle_connections()
+
+    def sync_once(self):
+        """ Sync every account once, and return when they are done. """
+        self.start(push=False)
+        while self.is_syncing():
+            self.loop.run_once()
+
+    def shutdown(self):
+        """ Stop IDLE, wait a bit for running jobs, close connections. """
+        for account in self.accounts.itervalues():
+            account.stop_push()
+        deadline = self.clock() + SHUTDOWN_TIMEOUT
+        while self.clock() < deadline and (self.is_syncing() or
+                any(account._idle_jobs
+                    for account in self.accounts.itervalues())):
+            self.loop.run_once()
+        for account in self.accounts.itervalues():
+            self.loop.run_until(account.worker_manager.close_idle_workers())
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('home', nargs='?',
+                        default=os.path.expanduser('~/.tinymail'))
+    parser.add_argument('--once', action='store_true',
+                        help="sync every account once, then exit")
+    parser.add_argument('--interval', type=float,
+                        help="minutes between syncs (default: auto_sync "
+                             "from the configuration, or %d)"
+                             % DEFAULT_SYNC_INTERVAL)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    configuration = Configuration(args.home)
+    db = open_db(configuration)
+    loop = MainLoop()
+    try:
+        with loop.installed():
+            daemon = SyncDaemon(configuration, db, loop, args.interval)
+            if args.once:
+                daemon.sync_once()
+            else:
+                for signum in (signal.SIGINT, signal.SIGTERM):
+                    signal.signal(signum, lambda *args: loop.stop())
+                daemon.start()
+                loop.run()
+            daemon.shutdown()
+    finally:
+        db.close()
+
+if __name__ == '__main__':
+    main()
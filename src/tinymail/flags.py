@@ -0,0 +1,30 @@
+class FlagTable(object):
+    """
+    The flags seen in an account, each given a bit the first time it shows
+    up, so that a message can keep its flags in one int. Each combination
+    of flags is turned into a set once, and shared by the messages that
+    have it.
+    """
+
+    def __init__(self):
+        self._bits = {}
+        self._flags = []
+        self._flag_sets = {0: frozenset()}
+
+    def bits_for(self, flags):
+        bits = 0
+        for flag in flags:
+            bit = self._bits.get(flag)
+            if bit is None:
+                bit = self._bits[flag] = 1 << len(self._flags)
+                self._flags.append(flag)
+            bits |= bit
+        return bits
+
+    def flags_for(self, bits):
+        flag_set = self._flag_sets.get(bits)
+        if flag_set is None:
+            flag_set = frozenset(flag for i, flag in enumerate(self._flags)
+                                 if bits & (1 << i))
+            self._flag_sets[bits] = flag_set
+        return flag_set
@@ -0,0 +1,100 @@
+import re
+import email
+import email.parser
+import email.header
+import email.errors
+
+_header_parser = email.parser.HeaderParser()
+
+_html_tag_pattern = re.compile(r'<[^>]*>')
+
+_message_id_pattern = re.compile(r'<[^<>\s]+>')
+
+# a message is threaded by the last few message ids it references; long
+# References headers are trimmed like this by mail clients anyway
+MAX_REFERENCES = 50
+
+def decode_header_value(value):
+    """ Decode RFC 2047 encoded-words and unfold `value` into unicode. """
+    if value is None:
+        return u''
+    try:
+        decoded = unicode(email.header.make_header(
+                            email.header.decode_header(value)))
+    except (LookupError, UnicodeError, email.errors.HeaderParseError):
+        # unknown charset, or raw 8-bit bytes; show them as they are
+        decoded = value.decode('latin-1')
+    return u' '.join(decoded.split())
+
+def parse_summary(raw_headers):
+    """
+    Return the `(subject, sender, date)` of a message, decoded to unicode,
+    for display in message lists.
+    """
+    headers = _header_parser.parsestr(raw_headers)
+    return (decode_header_value(headers['Subject']),
+            decode_header_value(headers['From']),
+            decode_header_value(headers['Date']))
+
+def _search_fields(headers):
+    recipients = [decode_header_value(value) for value in
+                  headers.get_all('To', []) + headers.get_all('Cc', [])]
+    return (decode_header_value(headers['Subject']),
+            decode_header_value(headers['From']),
+            u' '.join(recipients),
+            decode_header_value(headers['Date']))
+
+def parse_search_fields(raw_headers):
+    """
+    Return the `(subject, sender, recipients, date)` of a message, decoded
+    to unicode, for the search index. `recipients` has both To and Cc.
+    """
+    return _search_fields(_header_parser.parsestr(raw_headers))
+
+def _message_ids(value):
+    return _message_id_pattern.findall((value or '').decode('latin-1'))
+
+def _thread_fields(headers):
+    message_ids = _message_ids(headers['Message-ID'])
+    references = _message_ids(headers['References'])
+    for message_id in _message_ids(headers['In-Reply-To'])[:1]:
+        if message_id not in references:
+            references.append(message_id)
+    return ((message_ids[0] if message_ids else None),
+            references[-MAX_REFERENCES:])
+
+def parse_thread_fields(raw_headers):
+    """
+    Return the `(message_id, references)` of a message, for threading:
+    its Message-ID, or `None`, and the ids it refers to, oldest first,
+    from References and In-Reply-To.
+    """
+    return _thread_fields(_header_parser.parsestr(raw_headers))
+
+def parse_index_fields(raw_headers):
+    """ `parse_search_fields` and `parse_thread_fields` in one go. """
+    headers = _header_parser.parsestr(raw_headers)
+    return _search_fields(headers), _thread_fields(headers)
+
+def _decode_part(part):
+    payload = part.get_payload(decode=True) or ''
+    charset = part.get_content_charset() or 'latin-1'
+    try:
+        return payload.decode(charset, 'replace')
+    except LookupError:
+        return payload.decode('latin-1')
+
+def body_text(raw_full):
+    """
+    Return the text of a full message, decoded to unicode, for the search
+    index: its text/plain parts, or else its text/html parts without tags.
+    """
+    message = email.message_from_string(raw_full)
+    parts = {'text/plain': [], 'text/html': []}
+    for part in message.walk():
+        if part.get_content_type() in parts:
+            parts[part.get_content_type()].append(_decode_part(part))
+    if parts['text/plain']:
+        return u'\n'.join(parts['text/plain'])
+    return u'\n'.join(_html_tag_pattern.sub(u' ', html)
+                      for html in parts['text/html'])
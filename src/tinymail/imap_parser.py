@@ -0,0 +1,240 @@
+"""
+Read IMAP responses one at a time and parse them into records: FETCH,
+LIST and STATUS responses get their own record types, other untagged
+responses are kept as `Untagged`, like imaplib would, with their text.
+"""
+
+import re
+from collections import namedtuple
+
+CRLF = '\r\n'
+
+_literal_pattern = re.compile(r'\{(\d+)\}$')
+
+# an atom may end with a section and a partial range, e.g.
+# BODY[HEADER.FIELDS (SUBJECT)]<0>, which is read as one token
+_token_pattern = re.compile(r'[()]|"(?:[^"\\]|\\.)*"|'
+                            r'[^\s()"\[]+(?:\[[^\]]*\](?:<\d+>)?)?')
+
+_quoted_pair_pattern = re.compile(r'\\(.)')
+
+# most FETCH responses are one line with a flat list of attributes, e.g.
+# * 3 FETCH (UID 6 FLAGS (\Seen)), which is parsed with two regular
+# expressions, skipping the general parser
+_fetch_attr = (r'([A-Z][A-Z0-9.]*(?:\[[^\]]*\](?:<\d+>)?)?) '
+               r'(\d+|\([^()"]*\)|"(?:[^"\\]|\\.)*"|NIL)')
+_flat_fetch_pattern = re.compile(r'\* (\d+) FETCH '
+                                 r'(\((?:%s(?: %s)*)?\))\r?$'
+                                 % (_fetch_attr, _fetch_attr))
+_fetch_attr_pattern = re.compile(_fetch_attr)
+
+_flat_fetch_converters = {
+    'UID': int,
+    'RFC822.SIZE': int,
+    'MODSEQ': lambda value: int(value[1:-1]),
+}
+
+class ImapParseError(Exception):
+    """ A response we can't read. """
+
+class Tagged(namedtuple('Tagged', 'tag status text')):
+    """ The end of a command; `status` is OK, NO or BAD. """
+    __slots__ = ()
+
+class Continuation(namedtuple('Continuation', 'text')):
+    __slots__ = ()
+
+class Untagged(namedtuple('Untagged', 'name text')):
+    """
+    Any other untagged response. For `* 3 EXISTS`, `name` is EXISTS and
+    `text` is 3, as in imaplib's `untagged_responses`.
+    """
+    __slots__ = ()
+
+class FetchRecord(namedtuple('FetchRecord', 'seq attrs')):
+    """
+    An untagged FETCH response: the message's sequence number and its
+    attributes by name. Literals, e.g. BODY[HEADER], are kept as read.
+    """
+    __slots__ = ()
+
+    @property
+    def uid(self):
+        return self.attrs.get('UID')
+
+    @property
+    def flags(self):
+        return self.attrs.get('FLAGS')
+
+    @property
+    def modseq(self):
+        return self.attrs.get('MODSEQ')
+
+class ListRecord(namedtuple('ListRecord', 'flags delimiter name')):
+    __slots__ = ()
+
+class StatusRecord(namedtuple('StatusRecord', 'name items')):
+    """ A STATUS response; `items` are the numbers by name. """
+    __slots__ = ()
+
+def _unquote(token):
+    return _quoted_pair_pattern.sub(r'\1', token[1:-1])
+
+def parse_values(parts, literals=()):
+    """
+    Parse the text of a response into a list of values: strings, `None`
+    for NIL, and lists for parenthesized lists. `parts` are the pieces of
+    text around `literals`, which are taken as values as they are.
+    """
+    values = []
+    stack = []
+    for i, part in enumerate(parts):
+        for token in _token_pattern.findall(part):
+            if token == '(':
+                stack.append(values)
+                values.append([])
+                values = values[-1]
+            elif token == ')':
+                if not stack:
+                    raise ImapParseError("Unbalanced ')' in %r" % part)
+                values = stack.pop()
+            elif token[0] == '"':
+                values.append(_unquote(token))
+            elif token == 'NIL':
+                values.append(None)
+            else:
+                values.append(token)
+        if i < len(literals):
+            values.append(literals[i])
+    if stack:
+        raise ImapParseError("Unbalanced '(' in %r" % (parts,))
+    return values
+
+def _flat_fetch_attrs(line, pos):
+    attrs = {}
+    for name, value in _fetch_attr_pattern.findall(line, pos):
+        convert = _flat_fetch_converters.get(name)
+        if convert is not None:
+            try:
+                value = convert(value)
+            except ValueError:
+                raise ImapParseError("Bad FETCH response %r" % line)
+        elif value[0] == '(':
+            value = value[1:-1].split()
+        elif value[0] == '"':
+            value = _unquote(value)
+        elif value == 'NIL':
+            value = None
+        attrs[name] = value
+    return attrs
+
+def parse_fetch(seq, parts, literals=()):
+    """
+    Parse the attributes of `* <seq> FETCH`; `parts` start after FETCH.
+    UID, RFC822.SIZE and MODSEQ values are turned into ints.
+    """
+    values = parse_values(parts, literals)
+    if len(values) != 1 or not isinstance(values[0], list):
+        raise ImapParseError("Bad FETCH response %r" % (parts,))
+    items = values[0]
+    attrs = dict(zip(items[0::2], items[1::2]))
+    try:
+        if 'UID' in attrs:
+            attrs['UID'] = int(attrs['UID'])
+        if 'RFC822.SIZE' in attrs:
+            attrs['RFC822.SIZE'] = int(attrs['RFC822.SIZE'])
+        if 'MODSEQ' in attrs:
+            [attrs['MODSEQ']] = map(int, attrs['MODSEQ'])
+    except (TypeError, ValueError):
+        raise ImapParseError("Bad FETCH response %r" % (parts,))
+    return FetchRecord(seq, attrs)
+
+def parse_list(parts, literals=()):
+    values = parse_values(parts, literals)
+    if len(values) != 3 or not isinstance(values[0], list):
+        raise ImapParseError("Bad LIST response %r" % (parts,))
+    return ListRecord(*values)
+
+def parse_status(parts, literals=()):
+    values = parse_values(parts, literals)
+    if len(values) != 2 or not isinstance(values[1], list):
+        raise ImapParseError("Bad STATUS response %r" % (parts,))
+    name, items = values
+    try:
+        numbers = map(int, items[1::2])
+    except (TypeError, ValueError):
+        raise ImapParseError("Bad STATUS response %r" % (parts,))
+    return StatusRecord(name, dict(zip(items[0::2], numbers)))
+
+_parsers = {
+    'LIST': parse_list,
+    'LSUB': parse_list,
+    'STATUS': parse_status,
+}
+
+def parse_response(parts, literals=()):
+    """
+    Parse one response. `parts` are its lines, without CRLF and with the
+    `{n}` of each literal cut off, and `literals` the literals between
+    them.
+    """
+    first = parts[0]
+    if first[:2] == '* ':
+        word, _, rest = first[2:].partition(' ')
+        if word.isdigit():
+            name, _, rest = rest.partition(' ')
+            name = name.upper()
+            if name == 'FETCH':
+                return parse_fetch(int(word), [rest] + parts[1:], literals)
+            return Untagged(name, word)
+        name = word.upper()
+        parser = _parsers.get(name)
+        if parser is not None:
+            return parser([rest] + parts[1:], literals)
+        return Untagged(name, rest)
+    if first[:1] == '+':
+        return Continuation(first[2:])
+    bits = first.split(' ', 2)
+    if len(bits) < 2:
+        raise ImapParseError("Bad response %r" % first)
+    tag, status = bits[0], bits[1].upper()
+    return Tagged(tag, status, bits[2] if len(bits) > 2 else '')
+
+class ResponseReader(object):
+    """
+    Read responses from `readline` and `read`, e.g. those of an
+    `imaplib.IMAP4`, as they come in. Each literal is read with one call
+    to `read` and kept as it is.
+    """
+
+    def __init__(self, readline, read):
+        self.readline = readline
+        self.read = read
+
+    def read_response(self):
+        line = self.readline()
+        m = _flat_fetch_pattern.match(line)
+        if m is not None:
+            return FetchRecord(int(m.group(1)),
+                               _flat_fetch_attrs(line, m.start(2)))
+
+        parts = []
+        literals = []
+        while True:
+            if not line:
+                raise ImapParseError("Connection closed by server")
+            if line[-2:] == CRLF:
+                line = line[:-2]
+            elif line[-1:] == '\n':
+                line = line[:-1]
+            m = _literal_pattern.search(line) if line[-1:] == '}' else None
+            if m is None:
+                parts.append(line)
+                return parse_response(parts, literals)
+            size = int(m.group(1))
+            literal = self.read(size)
+            if len(literal) != size:
+                raise ImapParseError("Connection closed by server")
+            parts.append(line[:m.start()])
+            literals.append(literal)
+            line = self.readline()
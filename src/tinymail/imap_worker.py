@@ -1,61 +1,90 @@
 import logging
 import re
+import socket
+import zlib
 import imaplib
+from imap_parser import ResponseReader, Tagged, Untagged
+from imap_parser import FetchRecord, ListRecord, StatusRecord
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.INFO)
 
-list_pattern = re.compile(r'^\((?P<flags>[^\)]*)\) '
-                          r'"(?P<delim>[^"]*)" '
-                          r'(?P<name>.*)$')
+vanished_pattern = re.compile(r'^(?:\(EARLIER\) )?(?P<uids>[\d\:,]+)$')
 
-status_pattern = re.compile(r'^(?P<name>[^(]+)\((?P<status>[\w\d\s]*)\)$')
+copyuid_pattern = re.compile(r'^\[COPYUID (?P<uidvalidity>\d+) '
+                            r'(?P<src_uid>[\d\:,]+) '
+                            r'(?P<dst_uid>[\d\:,]+)\]')
 
-uid_pattern = re.compile(r'(?P<index>\d+)\s+\(UID\s*(?P<uid>\d+)\)$')
+# search words that can be sent as quoted strings; others are sent as
+# literals, in UTF-8
+quotable_pattern = re.compile(r'^[^"\\\x00-\x1f\x7f-\xff]+$')
 
-flags_pattern = re.compile(r'(?P<index>\d+)\s+\(FLAGS\s+'
-                           r'\((?P<flags>[^\)]*)\)\)$')
+# RFC 7162 asks clients to keep command lines under 8192 octets
+MAX_COMMAND_LENGTH = 8000
 
-copyuid_pattern = re.compile(r'^\[COPYUID (?P<uidvalidity>\d+) '
-                            r'(?P<src_uid>[\d\:,]+) '
-                            r'(?P<dst_uid>[\d\:,]+)'
-                            r'\] Copy completed\.$')
+# room for the tag, "UID", spaces and CRLF around a command's arguments
+COMMAND_OVERHEAD = 32
+
+# zlib level for what we send with COMPRESS=DEFLATE; commands are short,
+# so this hardly matters
+DEFLATE_LEVEL = 6
 
 def array_from_imap_str(imap_str):
     out = []
     for chunk in imap_str.split(','):
         if ':' in chunk:
-            start, end = chunk.split(':')
-            out.extend(xrange(int(start), int(end)+1))
+            start, end = sorted(int(n) for n in chunk.split(':'))
+            out.extend(xrange(start, end+1))
         else:
             out.append(int(chunk))
     return out
 
-def imap_str_from_sequence(data_src):
-    out = ''
-    crt = start = None
-
+def _iter_ranges(data_src):
+    """ Yield `(start, end)` ranges of consecutive values in `data_src`. """
+    start = crt = None
     for value in data_src:
-        if value - 1 == crt:
-            crt = value
-        elif value - 1 > crt:
+        if crt is None or value > crt + 1:
             if crt is not None:
-                if crt > start:
-                    out += ':' + str(crt)
-                out += ','
-            start = crt = value
-            out += str(start)
-        else:
+                yield start, crt
+            start = value
+        elif value != crt + 1:
             raise ValueError("Input sequence must be ascending")
-    else:
-        if crt > start:
-            out += ':' + str(crt)
+        crt = value
+    if crt is not None:
+        yield start, crt
 
-    return out
+def _range_str(start, end):
+    if end > start:
+        return '%d:%d' % (start, end)
+    return str(start)
+
+def imap_str_from_sequence(data_src):
+    return ','.join(_range_str(*r) for r in _iter_ranges(data_src))
+
+def split_imap_str(data_src, max_length):
+    """
+    Like `imap_str_from_sequence`, but yield several sequence sets, none
+    of them longer than `max_length`.
+    """
+    chunk = []
+    length = -1
+    for r in _iter_ranges(data_src):
+        part = _range_str(*r)
+        if chunk and length + 1 + len(part) > max_length:
+            yield ','.join(chunk)
+            chunk = []
+            length = -1
+        chunk.append(part)
+        length += 1 + len(part)
+    if chunk:
+        yield ','.join(chunk)
 
 class ImapWorkerError(Exception):
     """ Error encountered while talking to IMAP server. """
 
+class ImapCommandRejected(ImapWorkerError):
+    """ The server answered NO: the command failed, the connection is fine. """
+
 class ConnectionErrorWrapper(object):
     def __init__(self, conn):
         self.conn = conn
@@ -68,11 +97,60 @@ class ConnectionErrorWrapper(object):
             if (status == 'OK') or (status == 'BYE' and name == 'logout'):
                 return data
             elif status == 'NO':
-                raise ImapWorkerError("Error: %r" % data)
+                raise ImapCommandRejected("Error: %r" % data)
             else:
                 raise ImapWorkerError("Unknown status %r" % status)
         return wrapper
 
+def _check_status(record):
+    """ Raise `ImapWorkerError` unless the `Tagged` `record` is an OK. """
+    if record.status == 'NO':
+        raise ImapCommandRejected("Error: %r" % record.text)
+    elif record.status != 'OK':
+        raise ImapWorkerError("Unknown status %r" % record.status)
+
+class DeflateSocket(object):
+    """
+    Stands in for a socket once COMPRESS=DEFLATE (RFC 4978) is on: data
+    given to `sendall` is compressed and flushed right away, data from
+    `recv` is decompressed as it comes in. `pending` is compressed data
+    that was already read from `sock`.
+    """
+
+    def __init__(self, sock, pending=''):
+        self.sock = sock
+        self._compressor = zlib.compressobj(DEFLATE_LEVEL, zlib.DEFLATED,
+                                            -zlib.MAX_WBITS)
+        self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self._input = pending
+        # bytes before compression, and on the wire
+        self.sent = self.sent_compressed = 0
+        self.received = 0
+        self.received_compressed = len(pending)
+
+    def sendall(self, data):
+        if isinstance(data, memoryview):
+            # what socket._fileobject.flush sends
+            data = data.tobytes()
+        self.sent += len(data)
+        data = (self._compressor.compress(data) +
+                self._compressor.flush(zlib.Z_SYNC_FLUSH))
+        self.sent_compressed += len(data)
+        self.sock.sendall(data)
+
+    def recv(self, size):
+        while True:
+            if not self._input:
+                self._input = self.sock.recv(size)
+                if not self._input:
+                    return ''
+                self.received_compressed += len(self._input)
+            data = self._decompressor.decompress(self._input, size)
+            self._input = self._decompressor.unconsumed_tail
+            if data:
+                self.received += len(data)
+                return data
+
 # IMAP4_SSL does not call socket.shutdown() before closing socket
 if not getattr(imaplib.IMAP4_SSL.shutdown, '_patched_by_tinymail', False):
     def shutdown(self):
@@ -89,28 +167,225 @@ if not getattr(imaplib.IMAP4_SSL.shutdown, '_patched_by_tinymail', False):
     imaplib.IMAP4_SSL.shutdown = shutdown
     del shutdown
 
+# commands from IMAP extensions that imaplib doesn't know about
+imaplib.Commands.setdefault('ENABLE', ('AUTH',))
+imaplib.Commands.setdefault('COMPRESS', ('AUTH', 'SELECTED'))
+imaplib.Commands.setdefault('IDLE', ('AUTH', 'SELECTED'))
+imaplib.Commands.setdefault('UNSELECT', ('SELECTED',))
+
+# untagged responses that tell us a mailbox has changed
+IDLE_NOTIFICATIONS = ('EXISTS', 'EXPUNGE', 'FETCH', 'VANISHED')
+
 class ImapWorker(object):
-    def connect(self, host, login_name, login_pass):
+    def __init__(self):
+        self.capabilities = []
+        self.qresync_enabled = False
+        self.message_count = None
+        self.max_command_length = MAX_COMMAND_LENGTH
+        # the mailbox we have selected, if any; it stays selected after
+        # `close_mailbox`, in case the next job wants it again
+        self.selected_mailbox = None
+        self.selected_readonly = None
+        self.selects_saved = 0
+        self.deflate = None
+
+    def connect(self, host, login_name, login_pass, port=None, ssl=True,
+                max_command_length=None, compress=True):
         log.debug("connecting to %r as %r", host, login_name)
-        self.conn = ConnectionErrorWrapper(imaplib.IMAP4_SSL(host))
+        if max_command_length is not None:
+            self.max_command_length = max_command_length
+        imap_cls = imaplib.IMAP4_SSL if ssl else imaplib.IMAP4
+        if port is None:
+            self.conn = ConnectionErrorWrapper(imap_cls(host))
+        else:
+            self.conn = ConnectionErrorWrapper(imap_cls(host, port))
         [caps] = self.conn.capability()
         self.capabilities = caps.split()
         self.conn.login(login_name, login_pass)
+        if compress and 'COMPRESS=DEFLATE' in self.capabilities:
+            self.start_compression()
+        if 'QRESYNC' in self.capabilities:
+            self.conn._simple_command('ENABLE', 'QRESYNC')
+            self.qresync_enabled = True
+
+    def start_compression(self):
+        """
+        Turn on COMPRESS=DEFLATE. imaplib goes on reading lines and
+        literals from its `file`, which now reads through a
+        `DeflateSocket`, and sending commands with `send`.
+        """
+        log.debug("start_compression")
+
+        conn = self.conn.conn
+        self.conn._simple_command('COMPRESS', 'DEFLATE')
+        # imaplib.IMAP4_SSL talks through `sslobj`, IMAP4 through `sock`
+        sock = getattr(conn, 'sslobj', None) or conn.sock
+        # compressed data that the server sent right after its OK may be
+        # in the buffer of imaplib's file already
+        rbuf = getattr(conn.file, '_rbuf', None)
+        pending = rbuf.getvalue() if rbuf is not None else ''
+        self.deflate = DeflateSocket(sock, pending)
+        conn.file = socket._fileobject(self.deflate, 'rb')
+        conn.send = self.deflate.sendall
+
+    def has_condstore(self):
+        return ('CONDSTORE' in self.capabilities or
+                'QRESYNC' in self.capabilities)
+
+    def has_idle(self):
+        return 'IDLE' in self.capabilities
 
     def disconnect(self):
-        log.debug("disconnecting")
+        log.debug("disconnecting; %d mailbox selects saved",
+                  self.selects_saved)
+        if self.deflate is not None:
+            log.debug("received %d bytes compressed to %d",
+                      self.deflate.received,
+                      self.deflate.received_compressed)
         self.conn.logout()
 
+    def noop(self):
+        """ Check that the connection is still alive. """
+        log.debug("noop")
+        self.conn.noop()
+
+    def idle(self, timeout):
+        """
+        Wait in IDLE until the server reports a change in the selected
+        mailbox, or `timeout` seconds pass. Returns a list of
+        `(response, data)` tuples for EXISTS, EXPUNGE, FETCH and VANISHED
+        notifications; the list is empty if nothing happened.
+        """
+
+        log.debug("idle for %r seconds", timeout)
+
+        conn = self.conn.conn
+        for name in IDLE_NOTIFICATIONS:
+            # left over from earlier commands; we already know about them
+            conn.untagged_responses.pop(name, None)
+
+        tag = conn._command('IDLE')
+        while conn._get_response() is not None:
+            # not the continuation we're waiting for
+            if conn.tagged_commands[tag] is not None:
+                status, data = conn.tagged_commands.pop(tag)
+                raise ImapWorkerError("IDLE failed: %s %r" % (status, data))
+
+        conn.sock.settimeout(timeout)
+        try:
+            conn._get_response()
+        except socket.timeout:
+            pass # nothing happened
+        finally:
+            conn.sock.settimeout(None)
+
+        if conn.tagged_commands[tag] is None:
+            conn.send('DONE\r\n')
+        status, data = conn._command_complete('IDLE', tag)
+        if status != 'OK':
+            raise ImapWorkerError("IDLE failed: %s %r" % (status, data))
+
+        notifications = []
+        for name in IDLE_NOTIFICATIONS:
+            for item in conn.untagged_responses.pop(name, []):
+                notifications.append((name, item))
+        return notifications
+
+    def interrupt(self):
+        """
+        Abort a blocking call, e.g. `idle`, by shutting down the socket.
+        This is the only method that's safe to call from another thread;
+        the connection is unusable afterwards.
+        """
+        log.debug("interrupt")
+        conn = getattr(self, 'conn', None)
+        if conn is not None:
+            conn.conn.sock.shutdown(socket.SHUT_RDWR)
+
+    def _uid_command(self, command, uid_list, *args):
+        """
+        Run UID `command` on the messages in `uid_list`, split into as
+        many commands as needed to stay under `max_command_length`.
+        Returns the response data of each command.
+        """
+        return [self.conn.uid(command, uid_set, *args)
+                for uid_set in self._uid_sets(command, uid_list, *args)]
+
+    def _uid_sets(self, command, uid_list, *args):
+        overhead = COMMAND_OVERHEAD + len(command) + len(' '.join(args))
+        max_length = self.max_command_length - overhead
+        return split_imap_str(sorted(uid_list), max_length)
+
+    def _records(self, record_type, name, *args):
+        """
+        Send a command and yield its untagged responses of `record_type`,
+        parsed by `imap_parser`, as they are read; imaplib only sends the
+        command. Other untagged responses, e.g. EXISTS, are passed on to
+        imaplib, as if it had read them.
+        """
+        conn = self.conn.conn
+        tag = conn._command(name, *args)
+        reader = ResponseReader(conn.readline, conn.read)
+        try:
+            while True:
+                record = reader.read_response()
+                if isinstance(record, Tagged):
+                    break
+                self._pass_on(record)
+                if isinstance(record, record_type):
+                    yield record
+        finally:
+            conn.tagged_commands.pop(tag, None)
+
+        if record.tag != tag:
+            raise ImapWorkerError("Unexpected response %r" % (record,))
+        _check_status(record)
+
+    def _replies(self, tags):
+        """
+        Read the replies to several commands, sent one after the other
+        without waiting, as `tags`. Returns, for each command, a list of
+        its untagged responses and its `Tagged` completion. An untagged
+        response belongs to the oldest command that hasn't completed yet.
+        """
+        conn = self.conn.conn
+        reader = ResponseReader(conn.readline, conn.read)
+        records = dict((tag, []) for tag in tags)
+        completed = {}
+        waiting = list(tags)
+        try:
+            while waiting:
+                record = reader.read_response()
+                if isinstance(record, Tagged):
+                    if record.tag not in waiting:
+                        raise ImapWorkerError("Unexpected response %r" %
+                                              (record,))
+                    waiting.remove(record.tag)
+                    completed[record.tag] = record
+                else:
+                    self._pass_on(record)
+                    records[waiting[0]].append(record)
+        finally:
+            for tag in tags:
+                conn.tagged_commands.pop(tag, None)
+
+        return [(records[tag], completed[tag]) for tag in tags]
+
+    def _pass_on(self, record):
+        """ Hand an untagged response to imaplib, as if it had read it. """
+        if isinstance(record, Untagged):
+            if record.name == 'BYE':
+                raise ImapWorkerError("Server said BYE: %r" % record.text)
+            self.conn.conn._append_untagged(record.name, record.text)
+
     def get_mailbox_names(self):
         """ Get a list of all mailbox names in the current account. """
 
         log.debug("get_mailbox_names")
 
         paths = []
-        for entry in self.conn.list():
-            m = list_pattern.match(entry)
-            assert m is not None
-            folder_name = m.group('name').strip('"')
+        for record in self._records(ListRecord, 'LIST', '""', '*'):
+            folder_name = record.name
             try:
                 folder_name.decode('ascii')
             except UnicodeDecodeError:
@@ -122,34 +397,133 @@ class ImapWorker(object):
     def select_mailbox(self, name, readonly=True):
         """
         Select a mailbox and check its status. Returns mailbox status
-        information.
+        information. If the mailbox is still selected from an earlier call,
+        and writable if need be, a NOOP brings it up to date instead.
         """
         name = name.encode('ascii')
 
         log.debug("select_mailbox %r, readonly=%r", name, readonly)
 
-        self.message_index = {}
-        self.message_uid = {}
+        mailbox_status, replies = self._select(name, readonly)
+        return mailbox_status
 
-        count = self.conn.select(name, readonly=readonly)
+    def select_and_get_flags(self, name, modseq=None):
+        """
+        Select mailbox `name` read-only, like `select_mailbox`, and get its
+        message flags in the same round trip: with CONDSTORE and a
+        `modseq`, the changes since `modseq`, like `get_changed_flags`,
+        otherwise the flags of all messages. Returns the mailbox status and
+        a dict like that of `get_changed_flags`, with one more key, `since`:
+        `modseq`, or `None` if the flags are those of all messages.
+        """
+        name = name.encode('ascii')
 
-        data = self.conn.status(name, '(MESSAGES UIDNEXT UIDVALIDITY)')
-        m = status_pattern.match(data[0])
-        assert m is not None
-        assert m.group('name').strip().strip('"') == name
-        bits = m.group('status').strip().split()
-        mailbox_status = dict(zip(bits[0::2], map(int, bits[1::2])))
+        log.debug("select_and_get_flags %r since %r", name, modseq)
 
-        if mailbox_status['MESSAGES']:
-            data = self.conn.fetch('1:*', '(UID)')
-            for item in data:
-                m = uid_pattern.match(item)
-                assert m is not None
-                (uid, index) = (int(m.group('uid')), int(m.group('index')))
-                self.message_index[uid] = index
-                self.message_uid[index] = uid
+        if modseq and self.has_condstore():
+            items = '(FLAGS) (%s)' % self._changedsince(modseq)
+        else:
+            modseq = None
+            items = '(FLAGS)'
+        mailbox_status, [(records, completed)] = \
+            self._select(name, True, ('UID', 'FETCH', '1:*', items))
+
+        if modseq is None:
+            if mailbox_status['MESSAGES']:
+                # an empty mailbox may well have no messages for 1:*
+                _check_status(completed)
+            flags = dict((record.uid, record.flags) for record in records
+                         if isinstance(record, FetchRecord))
+            changes = {'flags': flags, 'vanished': None}
+        elif (completed.status != 'OK' and
+                not mailbox_status.get('HIGHESTMODSEQ')):
+            # the mailbox doesn't keep mod-sequences any more (NOMODSEQ)
+            changes = {'flags': self.get_message_flags(), 'vanished': None}
+            modseq = None
+        else:
+            _check_status(completed)
+            changes = self._flag_changes(records)
 
-        return mailbox_status
+        changes['since'] = modseq
+        return mailbox_status, changes
+
+    def _select(self, name, readonly, *commands):
+        """
+        Select mailbox `name`, or bring it up to date with a NOOP if it's
+        still selected, and ask for its STATUS; `commands` go out right
+        after, before any reply is read, so all of them take one round
+        trip. Returns the mailbox status and the replies to `commands`, as
+        `_replies` returns them.
+        """
+        conn = self.conn.conn
+
+        # sequence numbers are mapped on demand, see `map_sequence_numbers`
+        self.message_index = None
+        self.message_uid = None
+
+        # like SELECT would, drop what the server told us before
+        conn.untagged_responses = {}
+        reuse = (self.selected_mailbox == name and
+                 (readonly or not self.selected_readonly))
+        if reuse:
+            tags = [conn._command('NOOP')]
+        else:
+            self.selected_mailbox = None
+            conn.is_readonly = readonly
+            tags = [conn._command('EXAMINE' if readonly else 'SELECT', name)]
+            # imaplib refuses commands like FETCH outside of this state; we
+            # go back to AUTH below if the SELECT fails
+            conn.state = 'SELECTED'
+
+        status_items = 'MESSAGES UIDNEXT UIDVALIDITY'
+        if self.has_condstore():
+            status_items += ' HIGHESTMODSEQ'
+        tags.append(conn._command('STATUS', name, '(%s)' % status_items))
+        for command in commands:
+            tags.append(conn._command(*command))
+
+        replies = self._replies(tags)
+        (select_records, selected), (status_records, status) = replies[:2]
+
+        if reuse:
+            _check_status(selected)
+            self.selects_saved += 1
+            log.debug("%r is still selected (%d selects saved)",
+                      name, self.selects_saved)
+        else:
+            if selected.status != 'OK':
+                conn.state = 'AUTH'
+            _check_status(selected)
+            self.selected_mailbox = name
+            self.selected_readonly = readonly
+
+        _check_status(status)
+        [record] = [record for record in status_records
+                    if isinstance(record, StatusRecord)]
+        assert record.name == name
+        mailbox_status = record.items
+        self.message_count = mailbox_status['MESSAGES']
+
+        return mailbox_status, replies[2:]
+
+    def map_sequence_numbers(self):
+        """
+        Build the `message_index` (uid to sequence number) and `message_uid`
+        (sequence number to uid) maps for the current mailbox. This costs a
+        FETCH of every message, so only do it when sequence numbers are
+        really needed; all other commands work with UIDs.
+        """
+
+        log.debug("map_sequence_numbers")
+
+        self.message_index = {}
+        self.message_uid = {}
+
+        if self.message_count:
+            for record in self._records(FetchRecord,
+                                        'FETCH', '1:*', '(UID)'):
+                self.message_index[record.uid] = record.seq
+                self.message_uid[record.seq] = record.uid
 
     def get_message_flags(self):
         """ Get flags for all messages in this mailbox. """
@@ -158,83 +532,163 @@ class ImapWorker(object):
 
         flags = {}
 
-        if self.message_uid:
+        if self.message_count:
             # don't FETCH if the mailbox is empty
-            data = self.conn.fetch('1:*', '(FLAGS)')
-            for item in data:
-                m = flags_pattern.match(item)
-                assert m is not None
-                uid = self.message_uid[int(m.group('index'))]
-                flags[uid] = m.group('flags').split()
+            for record in self._records(FetchRecord, 'UID',
+                                        'FETCH', '1:*', '(FLAGS)'):
+                flags[record.uid] = record.flags
 
         return flags
 
-    def get_message_headers(self, uid_list):
-        """ Get headers of specified messagse from current folder. """
+    def get_changed_flags(self, modseq):
+        """
+        Get flags of messages changed since `modseq`, including new
+        messages. Returns a dict with keys `flags` (flags by uid) and
+        `vanished` (uids removed since `modseq`, or `None` if the server
+        can't tell us that).
+        """
 
-        log.debug("get_message_headers for %r", uid_list)
+        log.debug("get_changed_flags since %r", modseq)
 
-        message_indices = [self.message_index[uid] for uid in uid_list]
-        message_indices.sort()
-        message_uid = dict((idx, uid) for uid, idx in self.message_index.items())
+        items = '(FLAGS) (%s)' % self._changedsince(modseq)
+        return self._flag_changes(self._records((FetchRecord, Untagged),
+                                                'UID', 'FETCH', '1:*', items))
 
-        msgs = ','.join(map(str, message_indices))
-        data = self.conn.fetch(msgs, '(FLAGS BODY.PEEK[HEADER])')
+    def _changedsince(self, modseq):
+        modifiers = 'CHANGEDSINCE %d' % modseq
+        if self.qresync_enabled:
+            modifiers += ' VANISHED'
+        return modifiers
 
-        def iter_fragments(data):
-            data = iter(data)
-            while True:
-                fragment = next(data)
-                assert len(fragment) == 2, 'unexpected fragment layout'
-                yield fragment
-                skip = next(data, None)
-                assert skip == ')', 'bad closing'
+    def _flag_changes(self, records):
+        """
+        The result of `get_changed_flags`, from the untagged responses to
+        a UID FETCH with CHANGEDSINCE.
+        """
+        flags = {}
+        vanished = [] if self.qresync_enabled else None
+        for record in records:
+            if isinstance(record, FetchRecord):
+                flags[record.uid] = record.flags
+            elif (vanished is not None and isinstance(record, Untagged) and
+                    record.name == 'VANISHED'):
+                m = vanished_pattern.match(record.text)
+                assert m is not None
+                vanished.extend(array_from_imap_str(m.group('uids')))
+
+        return {'flags': flags, 'vanished': vanished}
+
+    def get_message_uids(self):
+        """ Get UIDs of all messages in this mailbox. """
+
+        log.debug("get_message_uids")
+
+        [data] = self.conn.uid('SEARCH', 'ALL')
+        return map(int, (data or '').split())
+
+    def search_text(self, words):
+        """
+        Get UIDs of messages in this mailbox that have each of `words`
+        (unicode) in their headers or body.
+        """
+
+        log.debug("search_text %r", words)
+
+        quoted = []
+        uids = None
+        for word in words:
+            word = word.encode('utf-8')
+            if quotable_pattern.match(word):
+                quoted.extend(['TEXT', '"%s"' % word])
+                continue
+            # a command can only end with one literal
+            self.conn.conn.literal = word
+            [data] = self.conn.uid('SEARCH', 'CHARSET', 'UTF-8', 'TEXT')
+            found = set(map(int, (data or '').split()))
+            uids = found if uids is None else uids & found
+
+        if quoted or uids is None:
+            [data] = self.conn.uid('SEARCH', *(quoted or ['ALL']))
+            found = set(map(int, (data or '').split()))
+            uids = found if uids is None else uids & found
+        return sorted(uids)
+
+    def get_message_headers(self, uid_list):
+        """ Get headers of specified messagse from current folder. """
+
+        log.debug("get_message_headers for %r", uid_list)
 
         headers_by_uid = {}
-        for fragment in iter_fragments(data):
-            preamble, mime_headers = fragment
-            assert 'BODY[HEADER]' in preamble, 'bad preamble'
-            idx = int(preamble.split(' ', 1)[0])
-            headers_by_uid[message_uid[idx]] = mime_headers
+        items = '(FLAGS BODY.PEEK[HEADER])'
+        for uid_set in self._uid_sets('FETCH', uid_list, items):
+            for record in self._records(FetchRecord, 'UID', 'FETCH',
+                                        uid_set, items):
+                if 'BODY[HEADER]' not in record.attrs:
+                    continue # e.g. a flag change, sent along
+                assert record.uid is not None, 'no UID in response'
+                headers_by_uid[record.uid] = record.attrs['BODY[HEADER]']
 
         return headers_by_uid
 
     def get_message_body(self, uid):
         log.debug("get_message_body for %r", uid)
 
-        data = self.conn.fetch(str(self.message_index[uid]), '(RFC822)')
-        assert len(data) == 2 and data[1] == ')'
-        assert isinstance(data[0], tuple) and len(data[0]) == 2
-        return data[0][1]
+        # PEEK, so a read-write mailbox doesn't mark the message as \Seen
+        [body] = [record.attrs['BODY[]'] for record in
+                  self._records(FetchRecord, 'UID', 'FETCH', str(uid),
+                                '(BODY.PEEK[])')
+                  if 'BODY[]' in record.attrs]
+        return body
 
     def change_flag(self, uid_list, operation, flag):
         log.debug("change_flag %r %r %r", uid_list, operation, flag)
 
         OP_MAP = {'add': '+FLAGS',
                   'del': '-FLAGS'}
-        message_indices = [self.message_index[uid] for uid in uid_list]
-        message_indices.sort()
-        msgs = ','.join(map(str, message_indices))
-        data = self.conn.store(msgs, OP_MAP[operation], flag)
-        # TODO "data" tells us the new flags for all messages
+        # a parenthesized flag list keeps imaplib from quoting the flag
+        self._uid_command('STORE', uid_list, OP_MAP[operation], '(%s)' % flag)
+        # TODO the responses tell us the new flags for all messages
 
     def copy_messages(self, uid_list, target_mailbox_name):
         target_mailbox_name = target_mailbox_name.encode('ascii')
         log.debug("copy_messages %r to %r", uid_list, target_mailbox_name)
 
-        message_indices = [self.message_index[uid] for uid in uid_list]
-        message_indices.sort()
-        msgs = ','.join(map(str, message_indices))
-
-        data = self.conn.copy(msgs, target_mailbox_name)
+        uidvalidity = None
+        uid_map = {}
+        for uid_set in self._uid_sets('COPY', uid_list, target_mailbox_name):
+            # COPYUID comes in the tagged OK, which `conn.uid` drops
+            data = self.conn._simple_command('UID', 'COPY', uid_set,
+                                             target_mailbox_name)
+            m = copyuid_pattern.match(data[0] or '')
+            if m is None:
+                # no UIDPLUS; the copies are found by the next update of
+                # the target mailbox
+                continue
+            uidvalidity = int(m.group('uidvalidity'))
+            uid_map.update(zip(array_from_imap_str(m.group('src_uid')),
+                               array_from_imap_str(m.group('dst_uid'))))
+        return {'UIDVALIDITY': uidvalidity, 'uid_map': uid_map}
+
+    def close_mailbox(self, now=False):
+        """
+        We're done with the selected mailbox. It stays selected, so that
+        selecting it again is cheap; pass `now` to deselect it right away.
+        """
+        log.debug("close_mailbox, now=%r", now)
 
-        m = copyuid_pattern.match(data[0])
-        assert m is not None
-        uid_map = dict(zip(array_from_imap_str(m.group('src_uid')),
-                           array_from_imap_str(m.group('dst_uid'))))
-        return {'UIDVALIDITY': int(m.group('uidvalidity')), 'uid_map': uid_map}
+        if now and self.selected_mailbox is not None:
+            self.unselect_mailbox()
 
-    def close_mailbox(self):
-        log.debug("close_mailbox")
+    def unselect_mailbox(self):
+        """
+        Leave the selected mailbox. UNSELECT, unlike CLOSE, never expunges
+        messages; servers without it get a CLOSE.
+        """
+        log.debug("unselect_mailbox")
 
-        data = self.conn.close()
+        if 'UNSELECT' in self.capabilities:
+            self.conn._simple_command('UNSELECT')
+            self.conn.conn.state = 'AUTH'
+        else:
+            self.conn.close()
+        self.selected_mailbox = None
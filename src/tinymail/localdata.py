@@ -1,5 +1,11 @@
 from contextlib import contextmanager
+import time
 import sqlite3
+from collections import defaultdict
+from headers import parse_summary, parse_index_fields, body_text
+from headers import parse_search_fields, parse_thread_fields
+
+DEFAULT_BODY_CACHE_SIZE = 100 * 1024 * 1024 # bytes
 
 def flatten(flags):
     return ' '.join(sorted(flags))
@@ -10,10 +16,129 @@ def unflatten(flat_flags):
 def single_result(result_set):
     return list(result_set)[0][0]
 
+def _search_rowid(folder_id, uid):
+    # the search index holds a message at a rowid made of its folder's id
+    # and its uid, so the messages of a folder are a range of rowids
+    return (folder_id << 32) | uid
+
+def _search_query(text):
+    """
+    Turn the words of `text` into an FTS5 query for messages that have
+    each of them, as a word or the start of a word.
+    """
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    return u' '.join(u'"%s"*' % word.replace(u'"', u'""')
+                     for word in text.split())
+
+def _add_to_threads(execute, folder_id, messages):
+    """
+    Put new messages, `(uid, message_id, references)` tuples, in threads.
+    A message joins the thread of the messages it references and of those
+    that reference it, merging them if there are several. Each message id
+    seen is kept in `thread_member` with its thread, whether or not the
+    folder has that message (JWZ's empty containers), so threading a new
+    message takes a few lookups and never a pass over the folder. The
+    `thread` table has the newest message of each thread, for sorting.
+    """
+    for uid, message_id, references in messages:
+        if message_id is None:
+            # nothing can refer to it; it only needs a thread id
+            message_id = u'<%d@uid>' % uid
+        ids = list(set([message_id] + references))
+
+        select_query = ("select message_id, thread_id from thread_member "
+                        "where folder_id = ? and message_id in (%s)"
+                        % ','.join('?' * len(ids)))
+        known = dict(execute(select_query, [folder_id] + ids).fetchall())
+        thread_ids = sorted(set(known.values()))
+        if thread_ids:
+            thread_id = thread_ids[0]
+            select_query = ("select max(latest_uid) from thread "
+                            "where folder_id = ? and thread_id in (%s)"
+                            % ','.join(str(t) for t in thread_ids))
+            latest_uid = single_result(execute(select_query, (folder_id,)))
+            if len(thread_ids) > 1:
+                merged = ','.join(str(t) for t in thread_ids[1:])
+                execute("delete from thread where folder_id = ? "
+                        "and thread_id in (%s)" % merged, (folder_id,))
+                for table in ('thread_member', 'message'):
+                    update_query = ("update %s set thread_id = ? "
+                                    "where folder_id = ? and thread_id in (%s)"
+                                    % (table, merged))
+                    execute(update_query, (thread_id, folder_id))
+            update_query = ("update thread set latest_uid = ? "
+                            "where folder_id = ? and thread_id = ?")
+            execute(update_query, (max(latest_uid or 0, uid),
+                                   folder_id, thread_id))
+        else:
+            select_query = ("select coalesce(max(thread_id), 0) + 1 "
+                            "from thread where folder_id = ?")
+            thread_id = single_result(execute(select_query, (folder_id,)))
+            insert_query = ("insert into thread(folder_id, thread_id, "
+                            "latest_uid) values (?, ?, ?)")
+            execute(insert_query, (folder_id, thread_id, uid))
+
+        insert_query = ("insert into thread_member(folder_id, message_id, "
+                        "thread_id) values (?, ?, ?)")
+        for new_id in ids:
+            if new_id not in known:
+                execute(insert_query, (folder_id, new_id, thread_id))
+        update_query = ("update message set thread_id = ? "
+                        "where folder_id = ? and uid = ?")
+        execute(update_query, (thread_id, folder_id, uid))
+
+def _thread_order(messages):
+    """
+    Sort the `(uid, message_id, references)` of a thread's messages so
+    replies follow what they reply to, and return `(uid, depth)` tuples.
+    A message's parent is the last message it references that is in the
+    folder; siblings are sorted by uid.
+    """
+    uid_by_id = {}
+    for uid, message_id, references in sorted(messages, reverse=True):
+        if message_id is not None:
+            uid_by_id[message_id] = uid
+
+    children = defaultdict(list)
+    roots = []
+    for uid, message_id, references in sorted(messages):
+        parents = [uid_by_id[ref] for ref in references
+                   if ref in uid_by_id and uid_by_id[ref] != uid]
+        if parents:
+            children[parents[-1]].append(uid)
+        else:
+            roots.append(uid)
+
+    order = []
+    seen = set()
+    unseen = sorted(uid for uid, message_id, references in messages)
+    while True:
+        stack = [(uid, 0) for uid in reversed(roots)]
+        while stack:
+            uid, depth = stack.pop()
+            if uid in seen:
+                continue
+            seen.add(uid)
+            order.append((uid, depth))
+            stack.extend((child, depth + 1)
+                         for child in reversed(children[uid]))
+        # messages in a reference loop have no root; start from one
+        roots = [uid for uid in unseen if uid not in seen][:1]
+        if not roots:
+            return order
+
+def message_from_row(uid, flat_flags, l1_headers, *summary):
+    message = (uid, unflatten(flat_flags), l1_headers.encode('latin-1'))
+    if summary:
+        message += (summary,)
+    return message
+
 class DBFolder(object):
-    def __init__(self, account, name):
+    def __init__(self, account, name, folder_id):
         self._account = account
         self.name = name
+        self._id = folder_id
 
     def _execute(self, *args, **kwargs):
         return self._account._execute(*args, **kwargs)
@@ -21,82 +146,285 @@ class DBFolder(object):
     def _executemany(self, *args, **kwargs):
         return self._account._executemany(*args, **kwargs)
 
-    def _count_messages(self, uid):
+    def _count_messages(self, uid_list):
         select_query = ("select count(*) from message "
-                        "where account = ? and folder = ? and uid = ?")
-        return single_result(self._execute(select_query,
-                            (self._account.name, self.name, uid)))
+                        "where folder_id = ? and uid in (%s)"
+                        % ','.join(str(uid) for uid in uid_list))
+        return single_result(self._execute(select_query, (self._id,)))
+
+    def _search_rowids(self):
+        return (_search_rowid(self._id, 0),
+                _search_rowid(self._id + 1, 0) - 1)
 
     def get_uidvalidity(self):
-        select_query = ("select uidvalidity from folder "
-                        "where account = ? and name = ?")
-        return single_result(self._execute(select_query,
-                            (self._account.name, self.name)))
+        select_query = "select uidvalidity from folder where id = ?"
+        return single_result(self._execute(select_query, (self._id,)))
 
     def set_uidvalidity(self, uidvalidity):
-        update_query = ("update folder set uidvalidity = ? "
-                        "where account = ? and name = ?")
-        row = (uidvalidity, self._account.name, self.name)
-        self._execute(update_query, row)
+        update_query = "update folder set uidvalidity = ? where id = ?"
+        self._execute(update_query, (uidvalidity, self._id))
 
-    def bulk_add_messages(self, data):
-        check_query = ("select count(*) from message where "
-                       "account = ? and folder = ? and uid in (%s)"
-                       % ','.join(str(row[0]) for row in data))
-        res = self._execute(check_query, (self._account.name, self.name))
-        assert single_result(res) == 0, "Some messages already exist"
+    def get_highestmodseq(self):
+        select_query = "select highestmodseq from folder where id = ?"
+        return single_result(self._execute(select_query, (self._id,)))
 
-        def sql_rows():
-            account_name = self._account.name
-            folder_name = self.name
-            for uid, flags, headers in data:
-                yield (account_name, folder_name,
-                       uid, flatten(flags), headers.decode('latin-1'))
-        insert_query = ("insert into message"
-                        "(account, folder, uid, flags, headers) "
-                        "values (?, ?, ?, ?, ?)")
-        self._executemany(insert_query, sql_rows())
+    def set_highestmodseq(self, highestmodseq):
+        update_query = "update folder set highestmodseq = ? where id = ?"
+        self._execute(update_query, (highestmodseq, self._id))
+
+    def bulk_add_messages(self, data):
+        existing = self._count_messages(row[0] for row in data)
+        assert existing == 0, "Some messages already exist"
+
+        message_rows = []
+        search_rows = []
+        thread_rows = []
+        folder_id = self._id
+        for uid, flags, headers in data:
+            search_fields, thread_fields = parse_index_fields(headers)
+            subject, sender, recipients, date = search_fields
+            message_id, references = thread_fields
+            message_rows.append((folder_id, uid, flatten(flags),
+                                 headers.decode('latin-1'),
+                                 subject, sender, date,
+                                 message_id, ' '.join(references)))
+            search_rows.append((_search_rowid(folder_id, uid),
+                                subject, sender, recipients, date))
+            thread_rows.append((uid,) + thread_fields)
+        insert_query = ("insert into message(folder_id, uid, flags, headers, "
+                                            "subject, sender, date, "
+                                            "message_id, refs) "
+                        "values (?, ?, ?, ?, ?, ?, ?, ?, ?)")
+        self._executemany(insert_query, message_rows)
+        _add_to_threads(self._execute, folder_id, thread_rows)
+
+        if self._account._db.search_enabled:
+            insert_query = ("insert into message_search(rowid, subject, "
+                                "sender, recipients, date) "
+                            "values (?, ?, ?, ?, ?)")
+            self._executemany(insert_query, search_rows)
 
     def add_message(self, uid, flags, headers):
         return self.bulk_add_messages([(uid, flags, headers)])
 
     def bulk_del_messages(self, uids):
-        sql_uids = ','.join(str(uid) for uid in uids)
-        check_query = (
-            "select count(uid) from message where "
-            "account = ? and folder = ? and uid in (%s)" % sql_uids)
-        res = self._execute(check_query, (self._account.name, self.name))
-        assert single_result(res) == len(uids), "Message(s) don't exist"
+        assert self._count_messages(uids) == len(uids), \
+            "Message(s) don't exist"
 
-        delete_query = (
-            "delete from message where "
-            "account = ? and folder = ? and uid in (%s)" % sql_uids)
-        self._execute(delete_query, (self._account.name, self.name))
+        sql_uids = ','.join(str(uid) for uid in uids)
+        select_query = ("select distinct thread_id from message "
+                        "where folder_id = ? and uid in (%s)" % sql_uids)
+        thread_ids = ','.join(str(thread_id) for (thread_id,) in
+                              self._execute(select_query, (self._id,)))
+        for table in ('message', 'body'):
+            delete_query = ("delete from %s where folder_id = ? "
+                            "and uid in (%s)" % (table, sql_uids))
+            self._execute(delete_query, (self._id,))
+
+        # threads keep their message ids; only their newest message changes
+        update_query = ("update thread set latest_uid = "
+                        "(select max(uid) from message "
+                        "where message.folder_id = thread.folder_id "
+                        "and message.thread_id = thread.thread_id) "
+                        "where folder_id = ? and thread_id in (%s)"
+                        % thread_ids)
+        self._execute(update_query, (self._id,))
+
+        if self._account._db.search_enabled:
+            delete_query = ("delete from message_search where rowid in (%s)"
+                            % ','.join(str(_search_rowid(self._id, uid))
+                                       for uid in uids))
+            self._execute(delete_query)
 
     def del_message(self, uid):
         return self.bulk_del_messages([uid])
 
     def del_all_messages(self):
-        delete_query = "delete from message where account = ? and folder = ?"
-        self._execute(delete_query, (self._account.name, self.name))
-
-    def set_message_flags(self, uid, flags):
-        # TODO check arguments
-        if self._count_messages(uid) == 0:
-            msg = ("Folder %r in account %r has no message with uid %r"
-                   % (self._account.name, self.name, uid))
+        self._execute("delete from message where folder_id = ?", (self._id,))
+        self._execute("delete from body where folder_id = ?", (self._id,))
+        for table in ('thread', 'thread_member'):
+            self._execute("delete from %s where folder_id = ?" % table,
+                          (self._id,))
+        if self._account._db.search_enabled:
+            self._execute("delete from message_search "
+                          "where rowid between ? and ?", self._search_rowids())
+
+    def bulk_set_message_flags(self, uid_to_flags):
+        select_query = ("select uid from message "
+                        "where folder_id = ? and uid in (%s)"
+                        % ','.join(str(uid) for uid in uid_to_flags))
+        existing = set(uid for (uid,) in
+                       self._execute(select_query, (self._id,)))
+        missing = set(uid_to_flags) - existing
+        if missing:
+            msg = ("Folder %r in account %r has no messages with uids %r"
+                   % (self.name, self._account.name, sorted(missing)))
             raise KeyError(msg)
+
+        def sql_rows():
+            folder_id = self._id
+            for uid, flags in uid_to_flags.iteritems():
+                yield (flatten(flags), folder_id, uid)
         update_query = ("update message set flags = ? "
-                        "where account = ? and folder = ? and uid = ?")
-        row = (flatten(flags), self._account.name, self.name, uid)
-        self._execute(update_query, row)
+                        "where folder_id = ? and uid = ?")
+        self._executemany(update_query, sql_rows())
 
-    def list_messages(self):
-        select_query = ("select uid, flags, headers from message "
-                        "where account = ? and folder = ?")
-        results = self._execute(select_query, (self._account.name, self.name))
-        for uid, flat_flags, l1_headers in results:
-            yield uid, unflatten(flat_flags), l1_headers.encode('latin-1')
+    def set_message_flags(self, uid, flags):
+        return self.bulk_set_message_flags({uid: flags})
+
+    def count_messages(self):
+        select_query = "select count(*) from message where folder_id = ?"
+        return single_result(self._execute(select_query, (self._id,)))
+
+    def list_uids(self):
+        select_query = ("select uid from message where folder_id = ? "
+                        "order by uid")
+        return [uid for (uid,) in self._execute(select_query, (self._id,))]
+
+    def get_message_flags(self, uid_list=None):
+        """ Flags by uid, for `uid_list` or all messages. """
+        select_query = "select uid, flags from message where folder_id = ?"
+        if uid_list is not None:
+            select_query += (" and uid in (%s)"
+                             % ','.join(str(uid) for uid in uid_list))
+        results = self._execute(select_query, (self._id,))
+        return dict((uid, unflatten(flat_flags))
+                    for uid, flat_flags in results)
+
+    def _message_columns(self, summary):
+        if summary:
+            return "uid, flags, headers, subject, sender, date"
+        return "uid, flags, headers"
+
+    def list_messages(self, offset=0, limit=None, summary=False):
+        """
+        Messages sorted by uid; optionally just a window of them. With
+        `summary`, each message also has a `(subject, sender, date)` tuple,
+        parsed when the message was added.
+        """
+        select_query = ("select %s from message where folder_id = ? "
+                        "order by uid limit ? offset ?"
+                        % self._message_columns(summary))
+        if limit is None:
+            limit = -1
+        results = self._execute(select_query, (self._id, limit, offset))
+        for row in results:
+            yield message_from_row(*row)
+
+    def get_message_body(self, uid):
+        """
+        Return the cached full message, or `None`. Marks the message as
+        recently used, so it must be called within a transaction.
+        """
+        select_query = "select data from body where folder_id = ? and uid = ?"
+        for (data,) in self._execute(select_query, (self._id, uid)):
+            update_query = ("update body set last_access = ? "
+                            "where folder_id = ? and uid = ?")
+            row = (self._account._db.clock(), self._id, uid)
+            self._execute(update_query, row)
+            return str(data)
+        return None
+
+    def set_message_body(self, uid, data):
+        """ Cache the full message; old bodies may be evicted to fit. """
+        insert_query = ("insert or replace into body"
+                        "(folder_id, uid, data, size, last_access) "
+                        "values (?, ?, ?, ?, ?)")
+        row = (self._id, uid, sqlite3.Binary(data), len(data),
+               self._account._db.clock())
+        self._execute(insert_query, row)
+        if self._account._db.search_enabled:
+            update_query = "update message_search set body = ? where rowid = ?"
+            self._execute(update_query, (body_text(data),
+                                         _search_rowid(self._id, uid)))
+        self._account._db.trim_body_cache(len(data))
+
+    def count_message_bodies(self):
+        select_query = "select count(*) from body where folder_id = ?"
+        return single_result(self._execute(select_query, (self._id,)))
+
+    def search_messages(self, query, offset=0, limit=None):
+        """
+        Uids of messages whose headers, or cached body, have all the words
+        of `query`, best matches first; optionally just a window of them.
+        """
+        fts_query = _search_query(query)
+        if not (fts_query and self._account._db.search_enabled):
+            return []
+        select_query = ("select rowid from message_search "
+                        "where message_search match ? "
+                        "and rowid between ? and ? "
+                        "order by rank limit ? offset ?")
+        if limit is None:
+            limit = -1
+        row = (fts_query,) + self._search_rowids() + (limit, offset)
+        return [rowid & 0xffffffff for (rowid,) in
+                self._execute(select_query, row)]
+
+    def add_operation(self, kind, uid_list, operation, argument):
+        """
+        Journal a change to messages of this folder, e.g. `('flag', [4, 15],
+        'add', r'\Seen')` or `('copy', [4], None, 'Archive')`, until it is
+        sent to the server. Returns the operation's id.
+        """
+        insert_query = ("insert into operation(folder_id, uidvalidity, "
+                        "kind, uids, operation, argument) "
+                        "values (?, ?, ?, ?, ?, ?)")
+        row = (self._id, self.get_uidvalidity(), kind,
+               ' '.join(str(uid) for uid in uid_list), operation, argument)
+        return self._execute(insert_query, row).lastrowid
+
+    def list_operations(self, kind):
+        """
+        Journaled operations of `kind`, oldest first, as `(op_id,
+        uidvalidity, uid_list, operation, argument)` tuples.
+        """
+        select_query = ("select id, uidvalidity, uids, operation, argument "
+                        "from operation where folder_id = ? and kind = ? "
+                        "order by id")
+        results = self._execute(select_query, (self._id, kind))
+        return [(op_id, uidvalidity, map(int, uids.split()),
+                 operation, argument)
+                for op_id, uidvalidity, uids, operation, argument in results]
+
+    def del_operations(self, op_ids):
+        delete_query = "delete from operation where id = ?"
+        self._executemany(delete_query, [(op_id,) for op_id in op_ids])
+
+    def list_threads(self, offset=0, limit=None):
+        """
+        Threads of messages, the one with the newest message first;
+        optionally just a window of them. Each thread is a list of `(uid,
+        depth)` tuples, with replies after what they reply to.
+        """
+        select_query = ("select thread_id from thread where folder_id = ? "
+                        "and latest_uid is not null "
+                        "order by latest_uid desc limit ? offset ?")
+        if limit is None:
+            limit = -1
+        thread_ids = [thread_id for (thread_id,) in
+                      self._execute(select_query, (self._id, limit, offset))]
+        if not thread_ids:
+            return []
+
+        messages = defaultdict(list)
+        select_query = ("select thread_id, uid, message_id, refs "
+                        "from message where folder_id = ? "
+                        "and thread_id in (%s)"
+                        % ','.join(str(t) for t in thread_ids))
+        results = self._execute(select_query, (self._id,))
+        for thread_id, uid, message_id, refs in results:
+            messages[thread_id].append((uid, message_id, refs.split()))
+        return [_thread_order(messages[thread_id])
+                for thread_id in thread_ids]
+
+    def get_message(self, uid, summary=False):
+        select_query = ("select %s from message where folder_id = ? "
+                        "and uid = ?" % self._message_columns(summary))
+        for row in self._execute(select_query, (self._id, uid)):
+            return message_from_row(*row)
+        raise KeyError("Folder %r in account %r has no message with uid %r"
+                       % (self.name, self._account.name, uid))
 
 class DBAccount(object):
     def __init__(self, db, name):
@@ -109,43 +437,91 @@ class DBAccount(object):
     def _executemany(self, *args, **kwargs):
         return self._db._executemany(*args, **kwargs)
 
-    def _count_folders(self, name):
-        select_query = ("select count(*) from folder "
-                        "where account = ? and name = ?")
-        return single_result(self._execute(select_query, (self.name, name)))
+    def _get_folder_id(self, name):
+        select_query = "select id from folder where account = ? and name = ?"
+        for (folder_id,) in self._execute(select_query, (self.name, name)):
+            return folder_id
+        return None
 
     def list_folders(self):
-        select_query = "select name from folder where account = ?"
+        select_query = "select id, name from folder where account = ?"
         cursor = self._execute(select_query, (self.name,))
-        for (name,) in cursor:
-            yield DBFolder(self, name)
+        for folder_id, name in cursor:
+            yield DBFolder(self, name, folder_id)
 
     def add_folder(self, name):
         # TODO check arguments
-        if self._count_folders(name) > 0:
+        if self._get_folder_id(name) is not None:
             raise AssertionError("Account %r already has a folder named %r" %
                                  (self.name, name))
         insert_query = "insert into folder(account, name) values (?, ?)"
-        self._execute(insert_query, (self.name, name))
-        return DBFolder(self, name)
+        cursor = self._execute(insert_query, (self.name, name))
+        return DBFolder(self, name, cursor.lastrowid)
+
+    def list_folders_with_operations(self, kind):
+        """ Names of folders with journaled operations of `kind`. """
+        select_query = ("select distinct folder.name from operation "
+                        "join folder on operation.folder_id = folder.id "
+                        "where folder.account = ? and operation.kind = ?")
+        return [name for (name,) in
+                self._execute(select_query, (self.name, kind))]
+
+    def search_messages(self, query, offset=0, limit=None):
+        """
+        Like `DBFolder.search_messages`, in all folders; returns `(folder
+        name, uid)` tuples.
+        """
+        fts_query = _search_query(query)
+        if not (fts_query and self._db.search_enabled):
+            return []
+        select_query = ("select folder.name, message_search.rowid "
+                        "from message_search join folder "
+                        "on folder.id = message_search.rowid >> 32 "
+                        "where message_search match ? and folder.account = ? "
+                        "order by message_search.rank limit ? offset ?")
+        if limit is None:
+            limit = -1
+        row = (fts_query, self.name, limit, offset)
+        return [(name, rowid & 0xffffffff) for name, rowid in
+                self._execute(select_query, row)]
 
     def get_folder(self, name):
-        if self._count_folders(name) == 0:
+        folder_id = self._get_folder_id(name)
+        if folder_id is None:
             raise KeyError("Account %r has no folder named %r" %
                            (self.name, name))
-        return DBFolder(self, name)
+        return DBFolder(self, name, folder_id)
 
     def del_folder(self, name):
-        if self._count_folders(name) == 0:
+        folder_id = self._get_folder_id(name)
+        if folder_id is None:
             raise KeyError("Account %r has no folder named %r" %
                            (self.name, name))
-        delete_query = "delete from folder where account = ? and name = ?"
-        self._execute(delete_query, (self.name, name))
+        for table in ('message', 'body', 'operation',
+                      'thread', 'thread_member'):
+            delete_query = "delete from %s where folder_id = ?" % table
+            self._execute(delete_query, (folder_id,))
+        if self._db.search_enabled:
+            self._execute("delete from message_search "
+                          "where rowid between ? and ?",
+                          DBFolder(self, name, folder_id)._search_rowids())
+        self._execute("delete from folder where id = ?", (folder_id,))
 
 class LocalDataDB(object):
-    def __init__(self, connection):
+    clock = staticmethod(time.time)
+
+    def __init__(self, connection, body_cache_size=DEFAULT_BODY_CACHE_SIZE):
         self._connection = connection
         self._transaction = False
+        self.body_cache_size = body_cache_size
+        # an upper bound on the bytes in the body cache, or `None` if we
+        # don't know; bodies are only counted when this goes over the limit
+        self._body_bytes = None
+        # without FTS5 in sqlite there is no search index, and searches
+        # go to the server
+        select_query = ("select count(*) from sqlite_master "
+                        "where name = 'message_search'")
+        self.search_enabled = bool(single_result(self._execute(select_query)))
 
     def _execute(self, *args, **kwargs):
         modif_statements = ['insert', 'update', 'delete', 'replace']
@@ -160,27 +536,318 @@ class LocalDataDB(object):
     def get_account(self, name):
         return DBAccount(self, name)
 
+    def trim_body_cache(self, added=0):
+        """
+        Evict the least recently used message bodies until the cache fits
+        in `body_cache_size` bytes. `added` is the size of a body that was
+        just cached.
+        """
+        if self._body_bytes is not None:
+            self._body_bytes += added
+            if self._body_bytes <= self.body_cache_size:
+                return
+        select_query = "select coalesce(sum(size), 0) from body"
+        self._body_bytes = single_result(self._execute(select_query))
+        excess = self._body_bytes - self.body_cache_size
+        if excess <= 0:
+            return
+
+        evicted = []
+        select_query = ("select folder_id, uid, size from body "
+                        "order by last_access")
+        for folder_id, uid, size in self._execute(select_query):
+            evicted.append((folder_id, uid))
+            excess -= size
+            self._body_bytes -= size
+            if excess <= 0:
+                break
+        delete_query = "delete from body where folder_id = ? and uid = ?"
+        self._executemany(delete_query, evicted)
+        if self.search_enabled:
+            # the index only has the bodies that are in the cache
+            update_query = ("update message_search set body = null "
+                            "where rowid = ?")
+            self._executemany(update_query, [(_search_rowid(*key),)
+                                             for key in evicted])
+
     @contextmanager
     def transaction(self):
         with self._connection:
             self._transaction = True
             try:
                 yield
+            except:
+                # evictions may be rolled back; count the bodies again
+                self._body_bytes = None
+                raise
             finally:
                 self._transaction = False
 
     def close(self):
         self._connection.close()
 
+SCHEMA_VERSION = 7
+
+schema_v1 = """
+    create table folder (
+        id integer primary key,
+        account varchar not null,
+        name varchar not null,
+        uidvalidity integer,
+        highestmodseq integer,
+        unique (account, name));
+
+    create table message (
+        folder_id integer not null,
+        uid integer not null,
+        flags varchar,
+        headers text,
+        primary key (folder_id, uid));
+
+    -- flag sync reads only uids and flags
+    create index message_flags on message (folder_id, uid, flags);
+"""
+
+def _add_message_summary(connection):
+    # parse the headers of existing messages, a batch at a time
+    message_columns = [row[1] for row in
+                       connection.execute("pragma table_info(message)")]
+    for column in ('subject', 'sender', 'date'):
+        if column not in message_columns:
+            connection.execute("alter table message add column %s text"
+                               % column)
+
+    select_query = ("select rowid, headers from message where rowid > ? "
+                    "order by rowid limit 1000")
+    update_query = ("update message set subject = ?, sender = ?, date = ? "
+                    "where rowid = ?")
+    last_rowid = 0
+    while True:
+        rows = connection.execute(select_query, (last_rowid,)).fetchall()
+        if not rows:
+            break
+        connection.executemany(update_query, [
+            parse_summary(l1_headers.encode('latin-1')) + (rowid,)
+            for rowid, l1_headers in rows])
+        last_rowid = rows[-1][0]
+
+def _add_search_index(connection):
+    try:
+        connection.execute("""
+            create virtual table message_search using fts5(
+                subject, sender, recipients, date, body,
+                tokenize = 'unicode61 remove_diacritics 1')
+        """)
+    except sqlite3.OperationalError:
+        # sqlite was built without FTS5
+        return
+    # rank by bm25, with matches in the subject and addresses worth more
+    connection.execute("insert into message_search(message_search, rank) "
+                       "values ('rank', 'bm25(10.0, 5.0, 5.0, 1.0, 1.0)')")
+
+    # index existing messages and cached bodies, a batch at a time
+    select_query = ("select rowid, folder_id, uid, headers from message "
+                    "where rowid > ? order by rowid limit 1000")
+    insert_query = ("insert into message_search(rowid, subject, sender, "
+                        "recipients, date) values (?, ?, ?, ?, ?)")
+    last_rowid = 0
+    while True:
+        rows = connection.execute(select_query, (last_rowid,)).fetchall()
+        if not rows:
+            break
+        connection.executemany(insert_query, [
+            (_search_rowid(folder_id, uid),) +
+            parse_search_fields(l1_headers.encode('latin-1'))
+            for rowid, folder_id, uid, l1_headers in rows])
+        last_rowid = rows[-1][0]
+
+    select_query = ("select rowid, folder_id, uid, data from body "
+                    "where rowid > ? order by rowid limit 100")
+    update_query = "update message_search set body = ? where rowid = ?"
+    last_rowid = 0
+    while True:
+        rows = connection.execute(select_query, (last_rowid,)).fetchall()
+        if not rows:
+            break
+        connection.executemany(update_query, [
+            (body_text(str(data)), _search_rowid(folder_id, uid))
+            for rowid, folder_id, uid, data in rows])
+        last_rowid = rows[-1][0]
+
+_thread_schema = [
+    # message ids, of messages or just referenced, and their thread
+    """create table if not exists thread_member (
+        folder_id integer not null,
+        message_id text not null,
+        thread_id integer not null,
+        primary key (folder_id, message_id))""",
+    """create index if not exists thread_member_thread on thread_member
+        (folder_id, thread_id)""",
+    # threads and their newest message, or null if they have none
+    """create table if not exists thread (
+        folder_id integer not null,
+        thread_id integer not null,
+        latest_uid integer,
+        primary key (folder_id, thread_id))""",
+    """create index if not exists thread_latest on thread
+        (folder_id, latest_uid)""",
+    """create index if not exists message_thread on message
+        (folder_id, thread_id, uid)""",
+]
+
+def _add_threads(connection):
+    message_columns = [row[1] for row in
+                       connection.execute("pragma table_info(message)")]
+    for column in ('message_id text', 'refs text', 'thread_id integer'):
+        if column.split()[0] not in message_columns:
+            connection.execute("alter table message add column %s" % column)
+    # `if not exists` and the deletes below let an interrupted migration
+    # run again from the start
+    for statement in _thread_schema:
+        connection.execute(statement)
+    connection.execute("delete from thread_member")
+    connection.execute("delete from thread")
+
+    # thread existing messages, a batch at a time
+    select_query = ("select rowid, folder_id, uid, headers from message "
+                    "where rowid > ? order by rowid limit 1000")
+    update_query = ("update message set message_id = ?, refs = ? "
+                    "where rowid = ?")
+    last_rowid = 0
+    while True:
+        rows = connection.execute(select_query, (last_rowid,)).fetchall()
+        if not rows:
+            break
+        by_folder = defaultdict(list)
+        for rowid, folder_id, uid, l1_headers in rows:
+            message_id, references = parse_thread_fields(
+                                        l1_headers.encode('latin-1'))
+            connection.execute(update_query,
+                               (message_id, ' '.join(references), rowid))
+            by_folder[folder_id].append((uid, message_id, references))
+        for folder_id, messages in by_folder.iteritems():
+            _add_to_threads(connection.execute, folder_id, messages)
+        last_rowid = rows[-1][0]
+
+# statements, or functions, that upgrade the schema to each version from
+# the one before
+schema_updates = {
+    2: """
+        create table body (
+            folder_id integer not null,
+            uid integer not null,
+            data blob not null,
+            size integer not null,
+            last_access real not null,
+            primary key (folder_id, uid));
+
+        create index body_lru on body (last_access);
+    """,
+    3: _add_message_summary,
+    4: """
+        -- changes made locally, not yet sent to the server
+        create table operation (
+            id integer primary key,
+            folder_id integer not null,
+            uidvalidity integer,
+            kind varchar not null,
+            uids text not null,
+            operation varchar,
+            argument varchar not null);
+
+        create index operation_folder on operation (folder_id, kind, id);
+    """,
+    5: _add_search_index,
+    6: _add_threads,
+    7: """
+        -- covers the cache size and the LRU scan, so neither of them
+        -- reads through the bodies
+        drop index body_lru;
+        create index body_lru on body (last_access, size, folder_id, uid);
+    """,
+}
+
+def _migrate_unversioned(connection, tables):
+    # databases from before the schema was versioned: no ids, no keys
+    if 'message' not in tables:
+        connection.execute("create table message (account varchar, "
+                           "folder varchar, uid integer, flags varchar, "
+                           "headers text)")
+    folder_columns = [row[1] for row in
+                      connection.execute("pragma table_info(folder)")]
+    if 'highestmodseq' not in folder_columns:
+        connection.execute("alter table folder "
+                           "add column highestmodseq integer")
+
+    connection.executescript("""
+        begin;
+        alter table folder rename to old_folder;
+        alter table message rename to old_message;
+        %s
+        insert or ignore into folder
+            (account, name, uidvalidity, highestmodseq)
+            select account, name, uidvalidity, highestmodseq
+            from old_folder;
+        insert or ignore into message (folder_id, uid, flags, headers)
+            select folder.id, old_message.uid,
+                   old_message.flags, old_message.headers
+            from old_message join folder
+            on old_message.account = folder.account
+            and old_message.folder = folder.name;
+        drop table old_folder;
+        drop table old_message;
+        pragma user_version = 1;
+        commit;
+    """ % schema_v1)
+
+def _run_update(connection, update, version):
+    """
+    Run the `update` function to `version` in one transaction. Left to
+    itself, the sqlite3 module commits before each `create` or `alter`,
+    so we begin and commit ourselves.
+    """
+    isolation_level = connection.isolation_level
+    connection.isolation_level = None
+    try:
+        connection.execute("begin")
+        try:
+            update(connection)
+            connection.execute("pragma user_version = %d" % version)
+        except:
+            connection.execute("rollback")
+            raise
+        connection.execute("commit")
+    finally:
+        connection.isolation_level = isolation_level
+
 def create_db_schema(connection):
-    connection.execute("create table if not exists "
-                       "folder (account varchar, name varchar, "
-                               "uidvalidity integer)")
-    connection.execute("create table if not exists "
-                       "message (account varchar, folder varchar, "
-                                "uid integer, flags varchar, headers text)")
-
-def open_local_db(db_path):
+    """ Create the database schema, or upgrade it to `SCHEMA_VERSION`. """
+    version = single_result(connection.execute("pragma user_version"))
+    if version == SCHEMA_VERSION:
+        return
+    if version > SCHEMA_VERSION:
+        raise ValueError("Database schema version %d is newer than %d"
+                         % (version, SCHEMA_VERSION))
+
+    if version == 0:
+        tables = set(name for (name,) in connection.execute(
+                     "select name from sqlite_master where type = 'table'"))
+        if 'folder' in tables:
+            _migrate_unversioned(connection, tables)
+        else:
+            connection.executescript("begin; %s pragma user_version = 1; "
+                                     "commit;" % schema_v1)
+        version = 1
+
+    for version in range(version + 1, SCHEMA_VERSION + 1):
+        update = schema_updates[version]
+        if callable(update):
+            _run_update(connection, update, version)
+        else:
+            connection.executescript("begin; %s pragma user_version = %d; "
+                                     "commit;" % (update, version))
+
+def open_local_db(db_path, **kwargs):
     connection = sqlite3.connect(db_path)
     create_db_schema(connection)
-    return LocalDataDB(connection)
+    return LocalDataDB(connection, **kwargs)
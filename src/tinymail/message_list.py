@@ -0,0 +1,68 @@
+from bisect import bisect_left
+from collections import namedtuple
+
+class RowChanges(namedtuple('RowChanges', 'removed inserted changed')):
+    """
+    Table rows affected by a folder update. `removed` rows are numbered as
+    before the update; `inserted` and `changed` rows as after it.
+    """
+    __slots__ = ()
+
+class MessageIndex(object):
+    """
+    Sorted uids of the messages in a folder; a message's position in the
+    list is its row in the message table. `apply` turns the `added`,
+    `removed` and `flags_changed` lists of a `folder_updated` event into
+    row changes, with a binary search for each uid; the list itself is
+    changed once per update, not shifted once per uid.
+    """
+
+    def __init__(self, uids=()):
+        self.uids = sorted(uids)
+
+    def __len__(self):
+        return len(self.uids)
+
+    def __getitem__(self, row):
+        return self.uids[row]
+
+    def row_for_uid(self, uid):
+        if uid not in self:
+            raise KeyError(uid)
+        return bisect_left(self.uids, uid)
+
+    def __contains__(self, uid):
+        row = bisect_left(self.uids, uid)
+        return row < len(self.uids) and self.uids[row] == uid
+
+    def _rows(self, uids):
+        return sorted(self.row_for_uid(uid) for uid in uids if uid in self)
+
+    def apply(self, added=(), removed=(), flags_changed=()):
+        """
+        Update the index and return the `RowChanges`. A uid that is both
+        removed and added (e.g. after UIDVALIDITY changed) is a new message
+        and gets a fresh row.
+        """
+        removed = set(removed)
+        removed_rows = self._rows(removed)
+        if removed_rows:
+            self.uids = [uid for uid in self.uids if uid not in removed]
+
+        added = set(uid for uid in added if uid not in self)
+        inserted_rows = []
+        if added:
+            # merge into the stretch of rows the new uids span, usually
+            # none at all: a batch of headers is a run of neighbours
+            new = sorted(added)
+            lo = bisect_left(self.uids, new[0])
+            hi = bisect_left(self.uids, new[-1], lo)
+            # timsort merges the two sorted runs in linear time
+            merged = sorted(self.uids[lo:hi] + new)
+            self.uids[lo:hi] = merged
+            inserted_rows = [lo + i for i, uid in enumerate(merged)
+                             if uid in added]
+
+        changed_rows = self._rows(set(flags_changed) - added)
+
+        return RowChanges(removed_rows, inserted_rows, changed_rows)
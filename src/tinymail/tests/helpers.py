@@ -17,7 +17,8 @@ def listen_for(signal):
 
 @contextmanager
 def mock_worker(**imap_spec):
-    from mock import Mock, patch
+    from mock import Mock, patch, DEFAULT
+    from monocle import _o, Return
     from monocle.callback import defer
     from tinymail.imap_worker import ImapWorker
 
@@ -27,14 +28,19 @@ def mock_worker(**imap_spec):
 
     folders = {}
     for name, mbox_spec in imap_spec.iteritems():
-        folder = folders[name] = {'flags': {}, 'headers': {}, 'index': {}}
+        folder = folders[name] = {'flags': {}, 'headers': {}, 'index': {},
+                                  'modseq': {}}
         folder['uidvalidity'] = mbox_spec.pop('UIDVALIDITY', 123456)
+        # CONDSTORE and QRESYNC
+        folder['highestmodseq'] = mbox_spec.pop('HIGHESTMODSEQ', None)
+        folder['vanished'] = mbox_spec.pop('VANISHED', None)
         for i, (uid, msg_spec) in enumerate(mbox_spec.iteritems()):
             if msg_spec is None:
                 msg_spec = (uid, set(), "PLACEHOLDER HEADER")
             folder['flags'][uid] = msg_spec[1]
             folder['index'][uid] = i
             folder['headers'][i] = msg_spec[2]
+            folder['modseq'][uid] = msg_spec[3] if len(msg_spec) > 3 else 1
 
     worker.connect.return_value = defer(None)
 
@@ -42,11 +48,38 @@ def mock_worker(**imap_spec):
 
     def select_mailbox(name, readonly=True):
         state['name'] = name
-        return defer({'MESSAGES': len(folders[name]['flags']),
-                      'UIDVALIDITY': folders[name]['uidvalidity']})
+        mbox_status = {'MESSAGES': len(folders[name]['flags']),
+                       'UIDVALIDITY': folders[name]['uidvalidity']}
+        if folders[name]['highestmodseq'] is not None:
+            mbox_status['HIGHESTMODSEQ'] = folders[name]['highestmodseq']
+        return defer(mbox_status)
     worker.select_mailbox = select_mailbox
 
-    worker.get_message_flags = lambda: defer(folders[state['name']]['flags'])
+    worker.get_message_flags.side_effect = \
+        lambda: defer(folders[state['name']]['flags'])
+
+    def get_changed_flags(modseq):
+        folder = folders[state['name']]
+        flags = dict((uid, folder['flags'][uid]) for uid in folder['flags']
+                     if folder['modseq'][uid] > modseq)
+        return defer({'flags': flags, 'vanished': folder['vanished']})
+    worker.get_changed_flags.side_effect = get_changed_flags
+
+    @_o
+    def select_and_get_flags(name, modseq=None):
+        # what the real worker does in one round trip, from the pieces above
+        mbox_status = yield worker.select_mailbox(name)
+        if modseq and 'HIGHESTMODSEQ' in mbox_status:
+            changes = yield worker.get_changed_flags(modseq)
+        else:
+            flags = yield worker.get_message_flags()
+            changes = {'flags': flags, 'vanished': None}
+            modseq = None
+        yield Return(mbox_status, dict(changes, since=modseq))
+    worker.select_and_get_flags = select_and_get_flags
+
+    worker.get_message_uids.side_effect = \
+        lambda: defer(list(folders[state['name']]['flags']))
 
     def get_message_headers(uid_list):
         name = state['name']
@@ -74,14 +107,30 @@ def mock_worker(**imap_spec):
                       'uid_map': uid_map})
     worker.copy_messages.side_effect = copy_messages
 
+    def change_flag(uid_list, operation, flag):
+        flags = folders[state['name']]['flags']
+        for uid in uid_list:
+            if operation == 'add':
+                flags[uid] = set(flags[uid]) | set([flag])
+            else:
+                flags[uid] = set(flags[uid]) - set([flag])
+        return DEFAULT # `worker.change_flag.return_value`
+    worker.change_flag.side_effect = change_flag
     worker.change_flag.return_value = defer(None)
     worker.close_mailbox.return_value = defer(None)
     worker.disconnect.return_value = defer(None)
     worker.copy_messages.return_value = defer(None)
+    worker.noop.return_value = defer(None)
+    worker.has_idle.return_value = defer(False)
 
     with patch('tinymail.account._new_imap_worker', Mock(return_value=worker)):
         yield worker
 
+    # the worker may be pooled; make it fail the next health check, so the
+    # next test scenario gets a fresh worker
+    from tinymail.imap_worker import ImapWorkerError
+    worker.noop.return_value = defer(ImapWorkerError("connection closed"))
+
 class AsyncTestCase(unittest2.TestCase):
     def run(self, result=None):
         from nose import SkipTest
@@ -15,6 +15,9 @@ def _account_for_test(config=None, db=None):
         }
     if db is None:
         db = MagicMock()
+    # health-check pooled workers before every reuse, so that each
+    # `mock_worker` scenario gets its own worker
+    config = dict({'ping_after': 0}, **config)
     return Account(config, db)
 
 msg13_data = (13, set([r'\Seen']), "Subject: test message")
@@ -112,7 +115,58 @@ class AccountUpdateTest(unittest.TestCase):
 
         with mock_worker(fol1={6: None, 8: None, 13: None}) as worker:
             account.perform_update()
-            worker.get_message_headers.assert_called_once_with(set([13]))
+            worker.get_message_headers.assert_called_once_with([13])
+
+    def test_get_headers_in_batches(self):
+        from tinymail.account import folder_updated
+        account = _account_for_test(db=mock_db())
+        account.config['header_batch_size'] = 2
+        with mock_worker(fol1={6: None}):
+            account.perform_update()
+
+        imap_fol1 = dict((uid, None) for uid in [3, 4, 7, 8, 9])
+        with mock_worker(fol1=imap_fol1) as worker:
+            with listen_for(folder_updated) as caught_signals:
+                # the removal is reported before any header is fetched
+                get_message_headers = worker.get_message_headers.side_effect
+                def get_headers(uid_list):
+                    if uid_list == [9, 8]:
+                        self.assertEqual(len(caught_signals), 1)
+                    return get_message_headers(uid_list)
+                worker.get_message_headers.side_effect = get_headers
+                account.perform_update()
+
+        self.assertEqual([c[0][0] for c in
+                          worker.get_message_headers.call_args_list],
+                         [[9, 8], [7, 4], [3]])
+        fol1 = account.get_folder('fol1')
+        self.assertEqual(caught_signals, [
+            (fol1, {'added': [], 'removed': [6], 'flags_changed': []}),
+            (fol1, {'added': [9, 8], 'removed': [], 'flags_changed': []}),
+            (fol1, {'added': [7, 4], 'removed': [], 'flags_changed': []}),
+            (fol1, {'added': [3], 'removed': [], 'flags_changed': []}),
+        ])
+        self.assertEqual(fol1.list_uids(), [3, 4, 7, 8, 9])
+
+    def test_message_expunged_before_headers(self):
+        from tinymail.account import folder_updated
+        account = _account_for_test(db=mock_db())
+        with mock_worker(fol1={6: None, 7: None, 8: None}) as worker:
+            # 7 is gone by the time its headers are fetched
+            get_message_headers = worker.get_message_headers.side_effect
+            def get_headers(uid_list):
+                headers = get_message_headers(uid_list).result
+                del headers[7]
+                return defer(headers)
+            worker.get_message_headers.side_effect = get_headers
+            with listen_for(folder_updated) as caught_signals:
+                account.perform_update()
+
+        fol1 = account.get_folder('fol1')
+        self.assertEqual(fol1.list_uids(), [6, 8])
+        self.assertEqual(caught_signals, [
+            (fol1, {'added': [8, 6], 'removed': [], 'flags_changed': []}),
+        ])
 
     def test_empty_folder(self):
         account = _account_for_test()
@@ -124,7 +178,7 @@ class AccountUpdateTest(unittest.TestCase):
 
     def test_load_full_message(self):
         from tinymail.account import message_updated
-        account = _account_for_test()
+        account = _account_for_test(db=mock_db())
         mime_message = "Subject: hi\r\n\r\nHello world!"
 
         with mock_worker(fol1={6: None}) as worker:
@@ -139,6 +193,55 @@ class AccountUpdateTest(unittest.TestCase):
         self.assertEqual(caught_signals, [(message, {})])
         worker.close_mailbox.assert_called_once_with()
 
+    def test_load_full_message_after_failure(self):
+        from tinymail.imap_worker import ImapWorkerError
+        account = _account_for_test(db=mock_db())
+
+        with mock_worker(fol1={6: None}) as worker:
+            account.perform_update()
+            message = account.get_folder('fol1').get_message(6)
+            worker.get_message_body.return_value = \
+                defer(ImapWorkerError("connection lost"))
+            message.load_full()
+            self.assertIsNone(message._load_job)
+
+            worker.get_message_body.return_value = defer("Subject: hi")
+            message.load_full()
+
+        self.assertEqual(message.raw_full, "Subject: hi")
+
+    def test_load_message_during_update(self):
+        account = _account_for_test(db=mock_db())
+        with mock_worker(fol1={6: None}, fol2={}, fol3={}):
+            account.perform_update()
+        message = account.get_folder('fol1').get_message(6)
+
+        imap_data = {'fol1': {6: None, 7: None}, 'fol2': {8: None},
+                     'fol3': {9: None}}
+        with mock_worker(**imap_data) as worker:
+            worker.get_message_body.return_value = defer("Subject: hi")
+            selected = []
+            select_mailbox = worker.select_mailbox
+            def record_select(name, readonly=True):
+                selected.append(name)
+                return select_mailbox(name, readonly)
+            worker.select_mailbox = record_select
+            # the user opens a message while the sync is in progress
+            get_message_headers = worker.get_message_headers.side_effect
+            def get_headers_then_click(uid_list):
+                message.load_full()
+                return get_message_headers(uid_list)
+            worker.get_message_headers.side_effect = get_headers_then_click
+
+            account.perform_update()
+
+        # the message is loaded as soon as the current folder is done
+        self.assertEqual(message.raw_full, "Subject: hi")
+        self.assertEqual(len(selected), 4)
+        self.assertEqual(selected[1], 'fol1')
+        self.assertEqual(sorted(selected[:1] + selected[2:]),
+                         ['fol1', 'fol2', 'fol3'])
+
     def test_folder_removed_on_server(self):
         account = _account_for_test()
 
@@ -151,7 +254,7 @@ class AccountUpdateTest(unittest.TestCase):
         self.assertEqual([f.name for f in account.list_folders()], ['fol1'])
 
     def test_trust_uidvalidity(self):
-        account = _account_for_test()
+        account = _account_for_test(db=mock_db())
         msg13_bis_data = (13, set([r'\Seen']), "Subject: another message")
         with mock_worker(fol1={13: msg13_data}):
             account.perform_update()
@@ -164,17 +267,23 @@ class AccountUpdateTest(unittest.TestCase):
                          [msg13_data[2]])
 
     def test_uidvalidity_changed(self):
-        account = _account_for_test()
+        from tinymail.account import folder_updated
+        account = _account_for_test(db=mock_db())
         msg13_bis_data = (13, set([r'\Seen']), "Subject: another message")
         with mock_worker(fol1={13: msg13_data, 'UIDVALIDITY': 1234}):
             account.perform_update()
 
         with mock_worker(fol1={13: msg13_bis_data, 'UIDVALIDITY': 1239}):
-            account.perform_update()
+            with listen_for(folder_updated) as caught_signals:
+                account.perform_update()
 
         fol1 = account.get_folder('fol1')
         self.assertEqual([m.raw_headers for m in fol1.list_messages()],
                          [msg13_bis_data[2]])
+        self.assertEqual(caught_signals, [
+            (fol1, {'added': [], 'removed': [13], 'flags_changed': []}),
+            (fol1, {'added': [13], 'removed': [], 'flags_changed': []}),
+        ])
 
     def test_message_flags_changed(self):
         from tinymail.account import folder_updated
@@ -201,6 +310,294 @@ class AccountUpdateTest(unittest.TestCase):
 
         worker.close_mailbox.assert_called_once_with()
 
+    def test_reuse_connection(self):
+        account = _account_for_test()
+
+        with mock_worker(fol1={6: None}) as worker:
+            account.perform_update()
+            account.perform_update()
+
+        worker.connect.assert_called_once_with(**account.get_imap_config())
+        self.assertFalse(worker.disconnect.called)
+        self.assertEqual(worker.noop.call_count, 1)
+
+
+class ParallelUpdateTest(unittest.TestCase):
+    def setUp(self):
+        self.config = {
+            'name': 'my test account',
+            'host': 'test_host',
+            'login_name': 'test_username',
+            'login_pass': 'test_password',
+            'max_connections': 2,
+        }
+
+    def test_update_with_two_connections(self):
+        from monocle.callback import Callback
+        account = _account_for_test(config=self.config)
+        selected = []
+
+        with mock_worker(fol1={6: None}, fol2={8: None}, fol3={}) as worker:
+            # the first folder takes a while to select
+            select_mailbox = worker.select_mailbox
+            slow_select = Callback()
+            def select_slowly(name, readonly=True):
+                selected.append(name)
+                if len(selected) == 1:
+                    return slow_select
+                return select_mailbox(name, readonly)
+            worker.select_mailbox = select_slowly
+
+            account.perform_update()
+
+            # meanwhile, the other folders are updated on a second connection
+            self.assertEqual(len(selected), 3)
+            self.assertEqual(worker.connect.call_count, 2)
+            self.assertIsNotNone(account._sync_job)
+
+            slow_select(select_mailbox(selected[0]).result)
+
+        self.assertIsNone(account._sync_job)
+        self.assertEqual(sorted(f.name for f in account.list_folders()),
+                         ['fol1', 'fol2', 'fol3'])
+        self.assertEqual(list(account.get_folder('fol1')._messages), [6])
+        self.assertEqual(list(account.get_folder('fol2')._messages), [8])
+
+    def test_locked_folder_is_updated_later(self):
+        from tinymail.account import folder_updated
+        account = _account_for_test()
+        with mock_worker(fol1={}, fol2={}):
+            account.perform_update()
+        fol1 = account.get_folder('fol1')
+        fol2 = account.get_folder('fol2')
+        fol1._lock.acquire()
+
+        with mock_worker(fol1={6: None}, fol2={8: None}):
+            with listen_for(folder_updated) as caught_signals:
+                account.perform_update()
+                self.assertEqual([s[0] for s in caught_signals], [fol2])
+                fol1._lock.release()
+
+        self.assertEqual([s[0] for s in caught_signals], [fol2, fol1])
+        self.assertFalse(fol1._lock.locked)
+        self.assertIsNone(account._sync_job)
+
+    def test_flag_change_waits_for_folder_lock(self):
+        account = _account_for_test(config=self.config, db=mock_db())
+        with mock_worker(fol1={6: None}):
+            account.perform_update()
+        fol1 = account.get_folder('fol1')
+        fol1._lock.acquire()
+
+        with mock_worker(fol1={6: None}) as worker:
+            fol1.change_flag([6], 'add', '\\Seen')
+            self.assertFalse(worker.change_flag.called)
+            fol1._lock.release()
+            worker.change_flag.assert_called_once_with([6], 'add', '\\Seen')
+
+
+class CondstoreUpdateTest(unittest.TestCase):
+    def setUp(self):
+        self.db = mock_db()
+        self.account = _account_for_test(db=self.db)
+        with mock_worker(fol1={4: None, 6: None, 'HIGHESTMODSEQ': 10}):
+            self.account.perform_update()
+        self.fol1 = self.account.get_folder('fol1')
+
+    def test_first_update_fetches_all_flags(self):
+        self.assertEqual(self.fol1._highestmodseq, 10)
+        self.assertEqual(sorted(self.fol1._messages), [4, 6])
+
+    def test_nothing_changed(self):
+        with mock_worker(fol1={4: None, 6: None, 'HIGHESTMODSEQ': 10}) \
+                as worker:
+            self.account.perform_update()
+
+        # the empty change set came along with the SELECT; nothing more
+        worker.get_changed_flags.assert_called_once_with(10)
+        self.assertFalse(worker.get_message_flags.called)
+        self.assertFalse(worker.get_message_uids.called)
+        self.assertEqual(self.fol1._highestmodseq, 10)
+
+    def test_qresync_changes(self):
+        from tinymail.account import folder_updated
+        imap_fol1 = {
+            6: (6, set([r'\Seen']), "PLACEHOLDER HEADER", 11),
+            8: (8, set(), "Subject: new", 12),
+            'HIGHESTMODSEQ': 12,
+            'VANISHED': [4],
+        }
+
+        with mock_worker(fol1=imap_fol1) as worker:
+            with listen_for(folder_updated) as caught_signals:
+                self.account.perform_update()
+
+        self.assertFalse(worker.get_message_flags.called)
+        self.assertFalse(worker.get_message_uids.called)
+        worker.get_changed_flags.assert_called_once_with(10)
+        self.assertEqual(sorted(self.fol1._messages), [6, 8])
+        self.assertEqual(self.fol1.get_message(6).flags, set([r'\Seen']))
+        self.assertEqual(caught_signals, [
+            (self.fol1, {'added': [], 'removed': [4], 'flags_changed': [6]}),
+            (self.fol1, {'added': [8], 'removed': [], 'flags_changed': []}),
+        ])
+        self.assertEqual(self.fol1._highestmodseq, 12)
+
+    def test_condstore_without_qresync(self):
+        imap_fol1 = {6: None, 8: (8, set(), "Subject: new", 12),
+                     'HIGHESTMODSEQ': 12}
+
+        with mock_worker(fol1=imap_fol1) as worker:
+            self.account.perform_update()
+
+        worker.get_changed_flags.assert_called_once_with(10)
+        worker.get_message_uids.assert_called_once_with()
+        self.assertEqual(sorted(self.fol1._messages), [6, 8])
+
+    def test_condstore_without_qresync_no_removals(self):
+        imap_fol1 = {4: None, 6: None, 8: (8, set(), "Subject: new", 12),
+                     'HIGHESTMODSEQ': 12}
+
+        with mock_worker(fol1=imap_fol1) as worker:
+            self.account.perform_update()
+
+        self.assertFalse(worker.get_message_uids.called)
+        self.assertEqual(sorted(self.fol1._messages), [4, 6, 8])
+
+    def test_highestmodseq_persisted(self):
+        with mock_worker(fol1={4: None, 6: None, 'HIGHESTMODSEQ': 15}):
+            self.account.perform_update()
+
+        account2 = _account_for_test(db=self.db)
+        self.assertEqual(account2.get_folder('fol1')._highestmodseq, 15)
+
+    def test_uidvalidity_change_forgets_highestmodseq(self):
+        from tinymail.account import folder_updated
+        imap_fol1 = {13: msg13_data, 'HIGHESTMODSEQ': 3, 'UIDVALIDITY': 99}
+
+        with mock_worker(fol1=imap_fol1) as worker:
+            with listen_for(folder_updated) as caught_signals:
+                # the old messages are reported gone before we go back to
+                # the server; a message list may redraw in the meantime
+                get_message_flags = worker.get_message_flags.side_effect
+                def get_flags():
+                    self.assertEqual(caught_signals, [(self.fol1, {
+                        'added': [], 'removed': [4, 6], 'flags_changed': []
+                    })])
+                    return get_message_flags()
+                worker.get_message_flags.side_effect = get_flags
+                self.account.perform_update()
+
+        # changes since modseq 10 mean nothing now; all flags are fetched
+        worker.get_message_flags.assert_called_once_with()
+        self.assertEqual(sorted(self.fol1._messages), [13])
+        self.assertEqual(self.fol1._highestmodseq, 3)
+
+
+class IdleTest(unittest.TestCase):
+    def setUp(self):
+        self.db = mock_db()
+        self.account = _account_for_test(db=self.db)
+        with mock_worker(INBOX={6: None}, fol2={}):
+            self.account.perform_update()
+
+    def mock_idle(self, worker):
+        from monocle.callback import Callback
+        idle_calls = []
+        def idle(timeout):
+            idle_calls.append(Callback())
+            return idle_calls[-1]
+        worker.has_idle.return_value = defer(True)
+        worker.idle.side_effect = idle
+        return idle_calls
+
+    def test_no_idle_support(self):
+        with mock_worker(INBOX={6: None}, fol2={}) as worker:
+            self.account.start_push()
+
+            self.assertFalse(self.account.push_active())
+            self.assertFalse(worker.idle.called)
+            worker.disconnect.assert_called_once_with()
+
+            worker.get_mailbox_names.reset_mock()
+            self.account.auto_sync()
+            self.assertEqual(worker.get_mailbox_names.call_count, 1)
+            self.assertEqual(worker.has_idle.call_count, 1)
+
+    def test_auto_sync_skips_idle_folders(self):
+        with mock_worker(INBOX={6: None}, fol2={}) as worker:
+            idle_calls = self.mock_idle(worker)
+            self.account.start_push()
+
+            self.assertTrue(self.account.push_active())
+            self.assertEqual(len(idle_calls), 1)
+
+        with mock_worker(INBOX={6: None, 7: None}, fol2={8: None}) as worker:
+            selected = []
+            select_and_get_flags = worker.select_and_get_flags
+            def record_select(name, modseq=None):
+                selected.append(name)
+                return select_and_get_flags(name, modseq)
+            worker.select_and_get_flags = record_select
+
+            self.account.auto_sync()
+
+        # the other folders are still polled; INBOX is left to IDLE
+        self.assertEqual(worker.get_mailbox_names.call_count, 1)
+        self.assertEqual(selected, ['fol2'])
+        self.assertEqual(self.account.get_folder('fol2').list_uids(), [8])
+        self.assertEqual(self.account.get_folder('INBOX').list_uids(), [6])
+
+    def test_idle_notification_updates_folder(self):
+        from tinymail.account import folder_updated
+        inbox = self.account.get_folder('INBOX')
+
+        with mock_worker(INBOX={6: None}, fol2={}) as worker:
+            idle_calls = self.mock_idle(worker)
+            self.account.start_push()
+
+        with mock_worker(INBOX={6: None, 8: None}, fol2={}) as worker2:
+            with listen_for(folder_updated) as caught_signals:
+                idle_calls[0]([('EXISTS', '2')])
+
+        self.assertEqual(caught_signals, [(inbox, {'added': [8],
+                                                   'removed': [],
+                                                   'flags_changed': []})])
+        self.assertEqual(set(m.uid for m in inbox.list_messages()),
+                         set([6, 8]))
+        # only INBOX was updated, and the watcher is IDLE again
+        self.assertFalse(worker2.get_mailbox_names.called)
+        self.assertEqual(len(idle_calls), 2)
+        self.assertTrue(self.account.push_active())
+
+    def test_stop_push(self):
+        from tinymail.imap_worker import ImapWorkerError
+        with mock_worker(INBOX={6: None}, fol2={}) as worker:
+            idle_calls = self.mock_idle(worker)
+            self.account.start_push()
+
+            self.account.stop_push()
+            worker.interrupt.assert_called_once_with()
+            idle_calls[0](ImapWorkerError("connection closed"))
+
+            self.assertFalse(self.account.push_active())
+            self.assertEqual(self.account._idle_jobs, {})
+            worker.done.assert_called_once_with()
+
+    def test_poll_and_restart_after_connection_failure(self):
+        from tinymail.imap_worker import ImapWorkerError
+        with mock_worker(INBOX={6: None}, fol2={}) as worker:
+            idle_calls = self.mock_idle(worker)
+            self.account.start_push()
+            idle_calls[0](ImapWorkerError("connection lost"))
+            self.assertFalse(self.account.push_active())
+
+            worker.get_mailbox_names.reset_mock()
+            self.account.auto_sync()
+
+            self.assertEqual(worker.get_mailbox_names.call_count, 1)
+            self.assertTrue(self.account.push_active())
+            self.assertEqual(len(idle_calls), 2)
 
 class PersistenceTest(unittest.TestCase):
     def test_folders(self):
@@ -306,6 +703,212 @@ class PersistenceTest(unittest.TestCase):
                          [set(['\\Flagged'])])
 
 
+class LazyFolderTest(unittest.TestCase):
+    def setUp(self):
+        self.db = mock_db()
+        self.imap_data = {'fol1': {
+            6: (6, set(), "Subject: six"),
+            8: (8, set([r'\Seen']), "Subject: eight"),
+            13: (13, set(), "Subject: thirteen"),
+        }}
+        with mock_worker(**self.imap_data):
+            _account_for_test(db=self.db).perform_update()
+        self.account = _account_for_test(db=self.db)
+        self.fol1 = self.account.get_folder('fol1')
+
+    def test_messages_not_loaded_at_startup(self):
+        self.assertFalse(self.fol1._all_loaded)
+        self.assertEqual(self.fol1._message_cache, {})
+        self.assertEqual(self.fol1.count_messages(), 3)
+
+    def test_load_on_first_access(self):
+        uids = sorted(m.uid for m in self.fol1.list_messages())
+        self.assertEqual(uids, [6, 8, 13])
+        self.assertTrue(self.fol1._all_loaded)
+
+    def test_list_messages_page(self):
+        page = self.fol1.list_messages_page(1, 2)
+
+        self.assertEqual([(m.uid, m.raw_headers) for m in page],
+                         [(8, "Subject: eight"), (13, "Subject: thirteen")])
+        self.assertTrue(self.fol1.get_message(8) is page[0])
+        self.assertEqual(sorted(self.fol1._message_cache), [8, 13])
+        self.assertFalse(self.fol1._all_loaded)
+
+        self.assertEqual([m.uid for m in self.fol1.list_messages_page(2, 5)],
+                         [13])
+
+    def test_message_summary(self):
+        message = self.fol1.list_messages_page(0, 1)[0]
+        self.assertEqual((message.subject, message.sender, message.date),
+                         (u"six", u"", u""))
+
+    def test_get_message_not_loaded(self):
+        message = self.fol1.get_message(6)
+        self.assertEqual(message.raw_headers, "Subject: six")
+        self.assertRaises(KeyError, self.fol1.get_message, 7)
+        self.assertFalse(self.fol1._all_loaded)
+
+    def test_compact_messages(self):
+        message = self.fol1.get_message(6)
+        self.assertFalse(hasattr(message, '__dict__'))
+        self.assertTrue(isinstance(message._flag_bits, int))
+
+        message.flags = set([r'\Seen'])
+        self.assertEqual(message.flags, set([r'\Seen']))
+        self.assertIs(self.fol1.get_message(8).flags, message.flags)
+
+    def test_update_without_loading(self):
+        from tinymail.account import folder_updated
+        msg8 = self.fol1.get_message(8)
+        self.imap_data['fol1'].pop(6)
+        self.imap_data['fol1'][8] = (8, set(), "Subject: eight")
+        self.imap_data['fol1'][15] = (15, set(), "Subject: fifteen")
+
+        with mock_worker(**self.imap_data):
+            with listen_for(folder_updated) as caught_signals:
+                self.account.perform_update()
+
+        self.assertEqual(caught_signals, [
+            (self.fol1, {'added': [], 'removed': [6], 'flags_changed': [8]}),
+            (self.fol1, {'added': [15], 'removed': [], 'flags_changed': []}),
+        ])
+        self.assertFalse(self.fol1._all_loaded)
+        self.assertEqual(msg8.flags, set())
+        self.assertEqual(self.fol1.count_messages(), 3)
+        self.assertEqual(sorted((m.uid, m.flags)
+                                for m in self.fol1.list_messages()),
+                         [(8, set()), (13, set()), (15, set())])
+
+    def test_change_flag_without_loading(self):
+        msg8 = self.fol1.get_message(8)
+
+        with mock_worker(**self.imap_data):
+            self.fol1.change_flag([8, 13], 'add', r'\Flagged')
+
+        self.assertEqual(msg8.flags, set([r'\Seen', r'\Flagged']))
+        self.assertEqual(sorted(self.fol1._message_cache), [8])
+        db_folder = self.db.get_account(self.account.name).get_folder('fol1')
+        self.assertEqual(db_folder.get_message_flags([8, 13]),
+                         {8: set([r'\Seen', r'\Flagged']),
+                          13: set([r'\Flagged'])})
+
+class BodyCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.db = mock_db()
+        self.imap_data = {'fol1': {6: None, 8: None, 13: None}}
+        with mock_worker(**self.imap_data):
+            _account_for_test(db=self.db).perform_update()
+
+    def load_full(self, account, uid, body="the body"):
+        message = account.get_folder('fol1').get_message(uid)
+        with mock_worker(**self.imap_data) as worker:
+            worker.get_message_body.return_value = defer(body)
+            cb = message.load_full()
+        return message, cb.result, worker
+
+    def test_body_cached_on_disk(self):
+        self.load_full(_account_for_test(db=self.db), 6)
+
+        account2 = _account_for_test(db=self.db)
+        message, body, worker = self.load_full(account2, 6)
+
+        self.assertEqual(body, "the body")
+        self.assertEqual(message.raw_full, "the body")
+        self.assertFalse(worker.connect.called)
+
+    def test_bodies_in_memory_are_bounded(self):
+        config = {'name': 'my test account', 'host': 'test_host',
+                  'login_name': 'test_username',
+                  'login_pass': 'test_password', 'bodies_in_memory': 2}
+        account = _account_for_test(config=config, db=self.db)
+
+        msg6 = self.load_full(account, 6, "six")[0]
+        msg8 = self.load_full(account, 8, "eight")[0]
+        self.load_full(account, 6)
+        msg13 = self.load_full(account, 13, "thirteen")[0]
+
+        self.assertEqual([m.raw_full for m in (msg6, msg8, msg13)],
+                         ["six", None, "thirteen"])
+
+        message, body, worker = self.load_full(account, 8)
+        self.assertEqual(body, "eight")
+        self.assertFalse(worker.get_message_body.called)
+
+class SearchTest(unittest.TestCase):
+    def setUp(self):
+        self.db = mock_db()
+        self.imap_data = {
+            'fol1': {6: (6, set(), "Subject: lunch\r\n\r\n"),
+                     8: (8, set(), "Subject: minutes\r\n\r\n"),
+                     13: (13, set(), "Subject: other\r\n\r\n")},
+            'fol2': {4: (4, set(), "Subject: lunch again\r\n\r\n")},
+        }
+        self.account = _account_for_test(db=self.db)
+        with mock_worker(**self.imap_data):
+            self.account.perform_update()
+
+    def test_search_local(self):
+        fol1 = self.account.get_folder('fol1')
+        fol2 = self.account.get_folder('fol2')
+        self.assertEqual(fol1.search_messages(u"lunch"), [6])
+        self.assertEqual(sorted(self.account.search_messages(u"lunch")),
+                         sorted([(fol1, 6), (fol2, 4)]))
+
+    def test_search_asks_server_for_bodies_not_cached(self):
+        fol1 = self.account.get_folder('fol1')
+        with mock_worker(**self.imap_data) as worker:
+            worker.search_text.return_value = defer([6, 8, 13, 99])
+            cb = fol1.search("lunch")
+
+        worker.search_text.assert_called_once_with([u"lunch"])
+        self.assertEqual(cb.result, [6, 13, 8])
+
+    def test_search_page(self):
+        fol1 = self.account.get_folder('fol1')
+        with mock_worker(**self.imap_data) as worker:
+            worker.search_text.return_value = defer([6, 8, 13])
+            cb = fol1.search(u"lunch", offset=1, limit=1)
+        self.assertEqual(cb.result, [13])
+
+    def test_search_offline(self):
+        from tinymail.imap_worker import ImapWorkerError
+        fol1 = self.account.get_folder('fol1')
+        with mock_worker(**self.imap_data) as worker:
+            worker.search_text.return_value = \
+                defer(ImapWorkerError("offline"))
+            cb = fol1.search(u"lunch")
+        self.assertEqual(cb.result, [6])
+
+    def test_search_all_bodies_cached(self):
+        fol2 = self.account.get_folder('fol2')
+        with mock_worker(**self.imap_data) as worker:
+            worker.get_message_body.return_value = defer("\r\nbody")
+            fol2.get_message(4).load_full()
+            cb = fol2.search(u"body")
+
+        self.assertFalse(worker.search_text.called)
+        self.assertEqual(cb.result, [4])
+
+class ThreadsTest(unittest.TestCase):
+    def test_threads_follow_updates(self):
+        imap_data = {'fol1': {
+            6: (6, set(), "Message-ID: <a@x>\r\n\r\n"),
+            8: (8, set(), "Message-ID: <b@x>\r\n\r\n"),
+        }}
+        account = _account_for_test(db=mock_db())
+        with mock_worker(**imap_data):
+            account.perform_update()
+        fol1 = account.get_folder('fol1')
+
+        imap_data['fol1'][13] = (13, set(), "In-Reply-To: <a@x>\r\n\r\n")
+        del imap_data['fol1'][8]
+        with mock_worker(**imap_data):
+            account.perform_update()
+
+        msg6, msg13 = fol1.get_message(6), fol1.get_message(13)
+        self.assertEqual(fol1.list_threads(), [[(msg6, 0), (msg13, 1)]])
+
 class ModifyFlagsTest(unittest.TestCase):
     def setUp(self):
         self.db = mock_db()
@@ -362,8 +965,149 @@ class ModifyFlagsTest(unittest.TestCase):
         self.assertEqual(fol1B.get_message(4).flags, set())
         self.assertEqual(fol1B.get_message(15).flags, set(['\\Flagged']))
 
+    def test_merge_flag_changes(self):
+        from tinymail.account import _merge_flag_changes
+        changes = [([4, 15], 'add', '\\Seen'),
+                   ([22], 'add', '\\Flagged'),
+                   ([15, 22], 'del', '\\Seen'),
+                   ([4], 'add', '\\Flagged')]
+
+        self.assertEqual(_merge_flag_changes(changes), [
+            ([4], 'add', '\\Seen'),
+            ([4, 22], 'add', '\\Flagged'),
+            ([15, 22], 'del', '\\Seen'),
+        ])
+
+    def test_coalesce_flag_changes(self):
+        from tinymail.account import folder_updated
+        fol1 = self.account.get_folder('fol1')
+        fol1._lock.acquire()
+
+        with mock_worker(**self.imap_data) as worker:
+            worker.select_mailbox = Mock(wraps=worker.select_mailbox)
+            with listen_for(folder_updated) as caught_signals:
+                fol1.change_flag([4], 'del', '\\Seen')
+                fol1.change_flag([15], 'add', '\\Seen')
+                fol1.change_flag([4], 'add', '\\Seen')
+                fol1.change_flag([22], 'del', '\\Seen')
+                self.assertFalse(worker.change_flag.called)
+                fol1._lock.release()
+
+        worker.select_mailbox.assert_called_once_with('fol1', readonly=False)
+        self.assertEqual(worker.change_flag.call_args_list, [
+            (([4, 15], 'add', '\\Seen'), {}),
+            (([22], 'del', '\\Seen'), {}),
+        ])
+        # the changes were shown right away, one at a time
+        self.assertEqual([s[1]['flags_changed'] for s in caught_signals],
+                         [[4], [15], [4], [22]])
+        self.assertEqual(fol1.get_message(4).flags, set(['\\Seen']))
+        self.assertEqual(fol1.get_message(22).flags, set(['\\Answered']))
+        self.assertIsNone(fol1._replay_job)
+
+    def test_flag_change_after_failure(self):
+        from tinymail.imap_worker import ImapWorkerError
+        fol1 = self.account.get_folder('fol1')
+
+        with mock_worker(**self.imap_data) as worker:
+            worker.change_flag.return_value = \
+                defer(ImapWorkerError("STORE failed"))
+            fol1.change_flag([4], 'del', '\\Seen')
+            # applied locally even though the server didn't get it
+            self.assertEqual(fol1.get_message(4).flags, set())
+
+            worker.change_flag.return_value = defer(None)
+            fol1.change_flag([15], 'add', '\\Seen')
+
+        self.assertEqual(worker.change_flag.call_args_list[1:], [
+            (([4], 'del', '\\Seen'), {}),
+            (([15], 'add', '\\Seen'), {}),
+        ])
+        self.assertEqual(fol1.get_message(15).flags,
+                         set(['\\Seen', '\\Flagged']))
+        db_folder = self.db.get_account(self.account.name).get_folder('fol1')
+        self.assertEqual(db_folder.list_operations('flag'), [])
+
+    def test_offline_flag_change_survives_restart(self):
+        from tinymail.imap_worker import ImapWorkerError
+        fol1 = self.account.get_folder('fol1')
+        with mock_worker(**self.imap_data) as worker:
+            worker.select_mailbox = Mock(
+                return_value=defer(ImapWorkerError("offline")))
+            fol1.change_flag([22], 'del', '\\Seen')
+
+        accountB = _account_for_test(db=self.db)
+        with mock_worker(**self.imap_data) as worker:
+            accountB.perform_update()
+
+        worker.change_flag.assert_called_once_with([22], 'del', '\\Seen')
+        fol1B = accountB.get_folder('fol1')
+        self.assertEqual(fol1B.get_message(22).flags, set(['\\Answered']))
+        db_folder = self.db.get_account(self.account.name).get_folder('fol1')
+        self.assertEqual(db_folder.list_operations('flag'), [])
+
+    def test_rejected_flag_change_is_undone(self):
+        from tinymail.account import folder_updated
+        from tinymail.imap_worker import ImapWorkerError, ImapCommandRejected
+        fol1 = self.account.get_folder('fol1')
+        with mock_worker(**self.imap_data) as worker:
+            worker.change_flag.return_value = \
+                defer(ImapWorkerError("offline"))
+            fol1.change_flag([4], 'del', '\\Seen')
+
+        self.imap_data['fol1'][9] = (9, set(), "Subject: new")
+        with mock_worker(**self.imap_data) as worker:
+            worker.change_flag.side_effect = \
+                lambda *args: defer(ImapCommandRejected("read-only"))
+            with listen_for(folder_updated) as caught_signals:
+                self.account.perform_update()
+
+        # the change is undone and dropped, and the sync goes on
+        self.assertEqual(caught_signals[0], (fol1, {
+            'added': [], 'removed': [], 'flags_changed': [4]}))
+        self.assertEqual(fol1.get_message(4).flags, set(['\\Seen']))
+        self.assertEqual(fol1.list_uids(), [4, 9, 15, 22])
+        db_folder = self.db.get_account(self.account.name).get_folder('fol1')
+        self.assertEqual(db_folder.list_operations('flag'), [])
+        self.assertEqual(db_folder.get_message_flags([4]),
+                         {4: set(['\\Seen'])})
+
+    def test_journal_dropped_on_uidvalidity_change(self):
+        from tinymail.imap_worker import ImapWorkerError
+        fol1 = self.account.get_folder('fol1')
+        with mock_worker(**self.imap_data) as worker:
+            worker.change_flag.return_value = \
+                defer(ImapWorkerError("offline"))
+            fol1.change_flag([22], 'del', '\\Seen')
+
+        self.imap_data['fol1']['UIDVALIDITY'] = 99
+        with mock_worker(**self.imap_data) as worker:
+            self.account.perform_update()
+
+        self.assertFalse(worker.change_flag.called)
+        self.assertEqual(fol1.get_message(22).flags,
+                         set(['\\Seen', '\\Answered']))
+        db_folder = self.db.get_account(self.account.name).get_folder('fol1')
+        self.assertEqual(db_folder.list_operations('flag'), [])
+
+    def test_flag_change_during_update_wins(self):
+        fol1 = self.account.get_folder('fol1')
+        with mock_worker(**self.imap_data) as worker:
+            get_message_flags = worker.get_message_flags.side_effect
+            def get_flags_then_click():
+                result = get_message_flags()
+                fol1.change_flag([4], 'add', '\\Flagged')
+                return result
+            worker.get_message_flags.side_effect = get_flags_then_click
+
+            self.account.perform_update()
+
+        self.assertEqual(fol1.get_message(4).flags,
+                         set(['\\Seen', '\\Flagged']))
+        self.assertEqual(worker.change_flag.call_count, 1)
+
     def test_close_mailbox_after_changing_flags(self):
-        account = _account_for_test()
+        account = _account_for_test(db=mock_db())
         with mock_worker(fol1={13: msg13_data}) as worker:
             account.perform_update()
             worker.close_mailbox.reset_mock()
@@ -405,6 +1149,74 @@ class MessagesCopyTest(unittest.TestCase):
         self.assertEqual(msgB.flags, msg13_data[1])
         self.assertEqual(msgB.raw_headers, msg13_data[2])
 
+    def test_copy_while_offline(self):
+        from tinymail.imap_worker import ImapWorkerError
+        with mock_worker(**self.imap_data) as worker:
+            worker.copy_messages.side_effect = \
+                lambda *args: defer(ImapWorkerError("offline"))
+            self.fol1.copy_messages([13], self.fol2)
+        self.assertEqual(len(list(self.fol2.list_messages())), 1)
+
+        accountB = _account_for_test(db=self.db)
+        with mock_worker(**self.imap_data) as worker:
+            accountB.perform_update()
+
+        worker.copy_messages.assert_called_once_with([13], 'fol2')
+        fol2B = accountB.get_folder('fol2')
+        self.assertEqual(len(list(fol2B.list_messages())), 2)
+        db_folder = self.db.get_account(self.account.name).get_folder('fol1')
+        self.assertEqual(db_folder.list_operations('copy'), [])
+        self.assertEqual(accountB._copy_jobs, set())
+
+    def test_copy_without_copyuid(self):
+        with mock_worker(**self.imap_data) as worker:
+            copy_messages = worker.copy_messages.side_effect
+            def copy_without_copyuid(*args):
+                copy_messages(*args)
+                return defer({'UIDVALIDITY': None, 'uid_map': {}})
+            worker.copy_messages.side_effect = copy_without_copyuid
+            self.fol1.copy_messages([13], self.fol2)
+
+        # the update that follows the copy finds it
+        self.assertEqual(len(list(self.fol2.list_messages())), 2)
+        db_folder = self.db.get_account(self.account.name).get_folder('fol1')
+        self.assertEqual(db_folder.list_operations('copy'), [])
+        self.assertEqual(self.account._copy_jobs, set())
+
+    def test_copy_with_copyuid_skips_update(self):
+        from mock import patch
+        with mock_worker(**self.imap_data) as worker:
+            with patch.object(self.account, 'update_folder') as update:
+                self.fol1.copy_messages([13], self.fol2)
+
+        self.assertFalse(update.called)
+        self.assertEqual(len(list(self.fol2.list_messages())), 2)
+
+    def test_copy_into_changed_uidvalidity(self):
+        from mock import patch
+        with mock_worker(**self.imap_data) as worker:
+            copy_messages = worker.copy_messages.side_effect
+            def copy_with_other_uidvalidity(*args):
+                result = copy_messages(*args).result
+                return defer(dict(result, UIDVALIDITY=999))
+            worker.copy_messages.side_effect = copy_with_other_uidvalidity
+            with patch.object(self.account, 'update_folder') as update:
+                self.fol1.copy_messages([13], self.fol2)
+
+        # the server's uids are not ours to use; an update finds the copy
+        self.assertEqual(len(list(self.fol2.list_messages())), 1)
+        update.assert_called_once_with('fol2')
+        db_folder = self.db.get_account(self.account.name).get_folder('fol1')
+        self.assertEqual(db_folder.list_operations('copy'), [])
+
+    def test_copy_no_messages(self):
+        with mock_worker(**self.imap_data) as worker:
+            self.fol1.copy_messages([], self.fol2)
+
+        self.assertFalse(worker.copy_messages.called)
+        db_folder = self.db.get_account(self.account.name).get_folder('fol1')
+        self.assertEqual(db_folder.list_operations('copy'), [])
+
     def test_copy_event(self):
         from tinymail.account import folder_updated
         with mock_worker(**self.imap_data) as worker:
@@ -34,13 +34,37 @@ class AsyncJobTest(unittest.TestCase):
 class AsyncWorkerTest(unittest.TestCase):
     def setUp(self):
         from tinymail import async
-        self._patch = patch.object(async, 'call_on_main_thread')
-        m = self._patch.start()
-        m.side_effect = lambda callback, result: callback(result)
+        self._patch = patch.object(async, 'dispatcher',
+                                   async.SyncDispatcher())
+        self._patch.start()
 
     def tearDown(self):
         self._patch.stop()
 
+    def test_no_dispatcher(self):
+        from tinymail import async
+        with patch.object(async, 'dispatcher', None):
+            self.assertRaises(RuntimeError, async.start_worker, object())
+
+    def test_results_go_to_the_dispatcher_at_start(self):
+        import threading
+        from tinymail import async
+        from tinymail.async import start_worker
+        go = threading.Event()
+        class MyWorker(object):
+            def get(self):
+                go.wait()
+                return 'result'
+
+        results = []
+        worker = start_worker(MyWorker())
+        worker.get().add(results.append)
+        with patch.object(async, 'dispatcher', None):
+            go.set()
+            worker.done()
+
+        self.assertEqual(results, ['result'])
+
     def test_input_queue(self):
         called = []
         from tinymail.async import start_worker
@@ -85,6 +109,77 @@ class AsyncWorkerTest(unittest.TestCase):
         self.assertTrue(isinstance(d.result, ValueError))
         self.assertEqual(d.result.args, ('hi',))
 
+    def test_interrupt(self):
+        import threading
+        from tinymail.async import start_worker
+        class MyWorker(object):
+            def __init__(self):
+                self.event = threading.Event()
+            def wait(self):
+                self.event.wait(5)
+                return self.event.is_set()
+            def interrupt(self):
+                self.event.set()
+
+        try:
+            worker = start_worker(MyWorker())
+            d = worker.wait()
+            worker.interrupt()
+        finally:
+            worker.done()
+
+        self.assertEqual(d.result, True)
+
+class DispatcherTest(unittest.TestCase):
+    def test_results_are_batched(self):
+        from tinymail.async import LoopDispatcher
+        wake_ups = []
+        dispatcher = LoopDispatcher(wake_ups.append)
+        calls = []
+
+        for n in range(3):
+            dispatcher.post(calls.append, n)
+
+        self.assertEqual(wake_ups, [dispatcher.deliver])
+        self.assertEqual(dispatcher.queue_depth, 3)
+        self.assertEqual(calls, [])
+
+        wake_ups.pop()()
+
+        self.assertEqual(calls, [0, 1, 2])
+        self.assertEqual(dispatcher.queue_depth, 0)
+        self.assertEqual((dispatcher.wakeups, dispatcher.delivered,
+                          dispatcher.max_depth), (1, 3, 3))
+
+        dispatcher.post(calls.append, 3)
+        self.assertEqual(wake_ups, [dispatcher.deliver])
+
+    def test_latency(self):
+        from tinymail.async import LoopDispatcher
+        wake_ups = []
+        dispatcher = LoopDispatcher(wake_ups.append)
+        dispatcher.clock = Mock(return_value=10.0)
+        dispatcher.post(lambda: None)
+        dispatcher.clock.return_value = 10.5
+        dispatcher.post(lambda: None)
+
+        dispatcher.clock.return_value = 11.0
+        dispatcher.deliver()
+
+        self.assertEqual(dispatcher.max_latency, 1.0)
+        self.assertEqual(dispatcher.total_latency, 1.5)
+
+    def test_error_in_callback(self):
+        from tinymail.async import SyncDispatcher
+        dispatcher = SyncDispatcher()
+        calls = []
+
+        dispatcher.post(lambda: 1/0)
+        dispatcher.post(calls.append, 'next')
+
+        self.assertEqual(calls, ['next'])
+        self.assertEqual(dispatcher.wakeups, 2)
+
 class SimpleWorkerManagerTest(unittest.TestCase):
     def setUp(self):
         from tinymail.async import SimpleWorkerManager
@@ -155,3 +250,174 @@ class SimpleWorkerManagerTest(unittest.TestCase):
 
         self.assertEqual(results1, [worker1])
         self.assertEqual(results2, [worker2])
+
+class PooledWorkerManagerTest(unittest.TestCase):
+    def setUp(self):
+        from tinymail.async import PooledWorkerManager
+        self.now = 1000
+        self.create_worker = Mock()
+        self.destroy_worker = Mock()
+        self.ping_worker = Mock(return_value=monocle.callback.defer(None))
+        self.wm = PooledWorkerManager(self.create_worker, self.destroy_worker,
+                                      self.ping_worker, max_workers=2,
+                                      idle_timeout=60,
+                                      clock=lambda: self.now)
+
+    def get_worker(self):
+        results = []
+        self.wm.get_worker().add(results.append)
+        return results
+
+    def test_reuse_worker(self):
+        worker = object()
+        self.create_worker.return_value = monocle.callback.defer(worker)
+        [worker1] = self.get_worker()
+        self.wm.hand_back_worker(worker1)
+
+        [worker2] = self.get_worker()
+
+        self.assertIs(worker2, worker)
+        self.assertEqual(self.create_worker.call_count, 1)
+        # handed back just now; no health check needed
+        self.assertFalse(self.ping_worker.called)
+        self.assertFalse(self.destroy_worker.called)
+
+    def test_ping_worker_idle_for_a_while(self):
+        worker = object()
+        self.create_worker.return_value = monocle.callback.defer(worker)
+        [worker1] = self.get_worker()
+        self.wm.hand_back_worker(worker1)
+
+        self.now += 5
+        [worker2] = self.get_worker()
+
+        self.assertIs(worker2, worker)
+        self.ping_worker.assert_called_once_with(worker)
+
+    def test_max_workers(self):
+        self.create_worker.side_effect = lambda: \
+            monocle.callback.defer(object())
+        [worker1] = self.get_worker()
+        [worker2] = self.get_worker()
+        results3 = self.get_worker()
+
+        self.assertIsNot(worker1, worker2)
+        self.assertEqual(results3, [])
+
+        self.wm.hand_back_worker(worker2)
+
+        self.assertEqual(results3, [worker2])
+        self.assertEqual(self.create_worker.call_count, 2)
+
+    def test_idle_timeout(self):
+        self.create_worker.side_effect = lambda: \
+            monocle.callback.defer(object())
+        [worker1] = self.get_worker()
+        self.wm.hand_back_worker(worker1)
+
+        self.now += 61
+        [worker2] = self.get_worker()
+
+        self.assertIsNot(worker2, worker1)
+        self.destroy_worker.assert_called_once_with(worker1)
+        self.assertFalse(self.ping_worker.called)
+
+    def test_reconnect_after_failed_ping(self):
+        self.create_worker.side_effect = lambda: \
+            monocle.callback.defer(object())
+        [worker1] = self.get_worker()
+        self.wm.hand_back_worker(worker1)
+
+        self.ping_worker.return_value = \
+            monocle.callback.defer(ValueError('connection lost'))
+        self.now += 5
+        [worker2] = self.get_worker()
+
+        self.assertIsNot(worker2, worker1)
+        self.destroy_worker.assert_called_once_with(worker1)
+        self.assertEqual(self.wm._n_workers, 1)
+
+    def test_close_idle_workers(self):
+        self.create_worker.side_effect = lambda: \
+            monocle.callback.defer(object())
+        [worker1] = self.get_worker()
+        [worker2] = self.get_worker()
+        self.wm.hand_back_worker(worker1)
+        self.wm.hand_back_worker(worker2)
+
+        self.wm.close_idle_workers()
+
+        self.assertEqual(self.destroy_worker.call_count, 2)
+        self.assertEqual(self.wm._n_workers, 0)
+
+    def test_priority(self):
+        from tinymail.async import PRIORITY_INTERACTIVE, PRIORITY_USER
+        from tinymail.async import PRIORITY_BACKGROUND
+        self.create_worker.side_effect = lambda: \
+            monocle.callback.defer(object())
+        [worker1] = self.get_worker()
+        [worker2] = self.get_worker()
+        order = []
+        self.wm.get_worker().add(lambda w: order.append('sync'))
+        self.wm.get_worker(PRIORITY_USER).add(lambda w: order.append('flag'))
+        self.now += 3
+        self.wm.get_worker(PRIORITY_INTERACTIVE).add(
+                lambda w: order.append('read'))
+
+        self.assertTrue(self.wm.has_waiting_clients(PRIORITY_BACKGROUND))
+        self.assertTrue(self.wm.has_waiting_clients(PRIORITY_USER))
+        self.assertFalse(self.wm.has_waiting_clients(PRIORITY_INTERACTIVE))
+
+        self.now += 2
+        self.wm.hand_back_worker(worker1)
+        self.wm.hand_back_worker(worker2)
+        self.assertEqual(order, ['read', 'flag'])
+        self.assertTrue(self.wm.has_waiting_clients(PRIORITY_BACKGROUND + 1))
+        self.assertFalse(self.wm.has_waiting_clients(PRIORITY_BACKGROUND))
+
+        self.assertEqual(self.wm.wait_stats, {PRIORITY_INTERACTIVE: (1, 2, 2),
+                                              PRIORITY_USER: (1, 5, 5),
+                                              PRIORITY_BACKGROUND: (2, 0, 0)})
+
+    def test_create_failure_frees_slot(self):
+        self.create_worker.return_value = \
+            monocle.callback.defer(ValueError('no route to host'))
+        [error] = self.get_worker()
+        self.assertTrue(isinstance(error, ValueError))
+
+        self.create_worker.return_value = monocle.callback.defer(object())
+        self.assertEqual(len(self.get_worker()), 1)
+        self.assertEqual(self.wm._n_workers, 1)
+
+class AsyncLockTest(unittest.TestCase):
+    def test_acquire_free_lock(self):
+        from tinymail.async import AsyncLock
+        lock = AsyncLock()
+        results = []
+        lock.acquire().add(results.append)
+        self.assertEqual(results, [None])
+        self.assertTrue(lock.locked)
+
+    def test_waiters_are_served_in_order(self):
+        from tinymail.async import AsyncLock
+        lock = AsyncLock()
+        order = []
+        lock.acquire()
+        lock.acquire().add(lambda r: order.append('a'))
+        lock.acquire().add(lambda r: order.append('b'))
+        self.assertEqual(order, [])
+
+        lock.release()
+        self.assertEqual(order, ['a'])
+        lock.release()
+        self.assertEqual(order, ['a', 'b'])
+        lock.release()
+        self.assertFalse(lock.locked)
+
+    def test_try_acquire(self):
+        from tinymail.async import AsyncLock
+        lock = AsyncLock()
+        self.assertTrue(lock.try_acquire())
+        self.assertFalse(lock.try_acquire())
+        lock.release()
+        self.assertTrue(lock.try_acquire())
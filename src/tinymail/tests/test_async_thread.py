@@ -0,0 +1,78 @@
+import unittest2 as unittest
+import threading
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class MainLoopTest(unittest.TestCase):
+    def test_callbacks_from_other_threads(self):
+        from tinymail.async_thread import MainLoop
+        loop = MainLoop()
+        calls = []
+
+        thread = threading.Thread(target=loop.call_on_main_thread,
+                                  args=(calls.append, 'hello'))
+        thread.start()
+        thread.join()
+        loop.run_once()
+
+        self.assertEqual(calls, ['hello'])
+
+    def test_timers(self):
+        from tinymail.async_thread import MainLoop
+        loop = MainLoop()
+        loop.clock = FakeClock()
+        calls = []
+        loop.timer_with_callback(60, True, calls.append, 'repeat')
+        loop.timer_with_callback(90, False, calls.append, 'once')
+
+        loop.run_once(timeout=0)
+        self.assertEqual(calls, [])
+
+        loop.clock.now += 60
+        loop.run_once(timeout=0)
+        self.assertEqual(calls, ['repeat'])
+
+        loop.clock.now += 60
+        loop.run_once(timeout=0)
+        self.assertEqual(calls, ['repeat', 'once', 'repeat'])
+
+    def test_error_in_callback(self):
+        from tinymail.async_thread import MainLoop
+        loop = MainLoop()
+        calls = []
+        loop.call_on_main_thread(lambda: 1/0)
+        loop.call_on_main_thread(calls.append, 'next')
+
+        loop.run_once()
+        loop.run_once()
+
+        self.assertEqual(calls, ['next'])
+
+    def test_run_until_stopped(self):
+        from tinymail.async_thread import MainLoop
+        loop = MainLoop()
+        calls = []
+        loop.call_on_main_thread(calls.append, 1)
+        loop.call_on_main_thread(loop.stop)
+        loop.call_on_main_thread(calls.append, 2)
+
+        loop.run()
+
+        self.assertEqual(calls, [1])
+
+    def test_installed(self):
+        from tinymail import async
+        from tinymail.async_thread import MainLoop
+        loop = MainLoop()
+        orig = async.dispatcher
+        calls = []
+        with loop.installed():
+            async.dispatcher.post(calls.append, 'result')
+            loop.run_once()
+        self.assertEqual(calls, ['result'])
+        self.assertIs(async.dispatcher, orig)
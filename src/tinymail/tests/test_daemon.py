@@ -0,0 +1,114 @@
+import unittest2 as unittest
+from mock import Mock
+from monocle.callback import defer
+from helpers import mock_db, mock_worker
+
+def _daemon_for_test(db, interval=None):
+    from tinymail.async_thread import MainLoop
+    from tinymail.daemon import SyncDaemon
+    configuration = Mock()
+    configuration.settings = {'accounts': [
+        {'name': 'one', 'host': 'one_host', 'login_name': 'one',
+         'login_pass': 'pw', 'ping_after': 0},
+        {'name': 'two', 'host': 'two_host', 'login_name': 'two',
+         'login_pass': 'pw', 'ping_after': 0},
+    ], 'auto_sync': 5}
+    return SyncDaemon(configuration, db, MainLoop(), interval)
+
+class SyncDaemonTest(unittest.TestCase):
+    def test_sync_once(self):
+        db = mock_db()
+        daemon = _daemon_for_test(db)
+        with mock_worker(fol1={6: None, 8: None}):
+            daemon.sync_once()
+
+        self.assertEqual(sorted(daemon.progress), ['one', 'two'])
+        for name in ['one', 'two']:
+            progress = daemon.progress[name]
+            self.assertEqual(progress['state'], 'idle')
+            self.assertEqual(progress['added'], 2)
+            self.assertIs(progress['error'], None)
+        db_folder = db.get_account('two').get_folder('fol1')
+        self.assertEqual(db_folder.list_uids(), [6, 8])
+
+    def test_sync_failed(self):
+        from tinymail.imap_worker import ImapWorkerError
+        daemon = _daemon_for_test(mock_db())
+        with mock_worker(fol1={6: None}) as worker:
+            worker.get_mailbox_names.return_value = \
+                defer(ImapWorkerError("no way"))
+            daemon.sync_once()
+
+        progress = daemon.progress['one']
+        self.assertEqual(progress['state'], 'failed')
+        self.assertTrue(isinstance(progress['error'], ImapWorkerError))
+        self.assertFalse(daemon.is_syncing())
+
+    def test_schedule(self):
+        daemon = _daemon_for_test(mock_db())
+        self.assertEqual(daemon.interval, 5)
+        self.assertEqual(_daemon_for_test(mock_db(), 0.5).interval, 0.5)
+
+        daemon.auto_sync = Mock()
+        daemon.loop.clock = Mock(return_value=1000.0)
+        with mock_worker(fol1={}):
+            daemon.start()
+
+        daemon.loop.clock.return_value = 1299.0
+        daemon.loop.run_once(timeout=0)
+        self.assertEqual(daemon.auto_sync.call_count, 0)
+
+        daemon.loop.clock.return_value = 1300.0
+        daemon.loop.run_once(timeout=0)
+        self.assertEqual(daemon.auto_sync.call_count, 1)
+
+    def test_scheduled_sync_with_idle(self):
+        from monocle.callback import Callback
+        db = mock_db()
+        daemon = _daemon_for_test(db)
+        with mock_worker(INBOX={6: None}, fol2={}) as worker:
+            worker.has_idle.return_value = defer(True)
+            idle_calls = []
+            def idle(timeout):
+                idle_calls.append(Callback())
+                return idle_calls[-1]
+            worker.idle.side_effect = idle
+            daemon.start()
+            while daemon.is_syncing():
+                daemon.loop.run_once()
+
+        for account in daemon.accounts.itervalues():
+            self.assertTrue(account.push_active())
+
+        with mock_worker(INBOX={6: None}, fol2={8: None}):
+            daemon.auto_sync()
+            while daemon.is_syncing():
+                daemon.loop.run_once()
+
+        # IDLE watches INBOX; the schedule still syncs the other folders
+        for name in ['one', 'two']:
+            db_folder = db.get_account(name).get_folder('fol2')
+            self.assertEqual(db_folder.list_uids(), [8])
+
+    def test_idle_connections_closed_on_timer(self):
+        daemon = _daemon_for_test(mock_db())
+        daemon.auto_sync = Mock()
+        daemon.loop.clock = Mock(return_value=1000.0)
+        for account in daemon.accounts.itervalues():
+            account.worker_manager._clock = daemon.loop.clock
+        with mock_worker(fol1={6: None}) as worker:
+            daemon.start()
+            while daemon.is_syncing():
+                daemon.loop.run_once(timeout=0)
+            n_disconnects = worker.disconnect.call_count
+
+            daemon.loop.clock.return_value = 1000.0 + 300
+            daemon.loop.run_once(timeout=0)
+            self.assertEqual(worker.disconnect.call_count, n_disconnects)
+
+            # no job comes along; the timer closes the pooled connections
+            daemon.loop.clock.return_value = 1000.0 + 300 + 30
+            daemon.loop.run_once(timeout=0)
+            self.assertEqual(worker.disconnect.call_count, n_disconnects + 2)
+            for account in daemon.accounts.itervalues():
+                self.assertEqual(account.worker_manager._n_workers, 0)
@@ -0,0 +1,23 @@
+import unittest2 as unittest
+
+class FlagTableTest(unittest.TestCase):
+    def test_round_trip(self):
+        from tinymail.flags import FlagTable
+        table = FlagTable()
+
+        bits = table.bits_for([r'\Seen', r'\Flagged'])
+
+        self.assertEqual(table.flags_for(bits), set([r'\Seen', r'\Flagged']))
+        self.assertEqual(table.bits_for([r'\Seen']) | bits, bits)
+        self.assertEqual(table.flags_for(0), set())
+
+    def test_shared_flag_sets(self):
+        from tinymail.flags import FlagTable
+        table = FlagTable()
+
+        bits1 = table.bits_for(set([r'\Seen', 'custom']))
+        bits2 = table.bits_for([u'custom', u'\\Seen'])
+
+        self.assertEqual(bits1, bits2)
+        self.assertIs(table.flags_for(bits1), table.flags_for(bits2))
+        self.assertTrue(isinstance(table.flags_for(bits1), frozenset))
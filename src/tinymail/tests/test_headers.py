@@ -0,0 +1,94 @@
+import unittest2 as unittest
+
+class ParseSummaryTest(unittest.TestCase):
+    def test_plain_headers(self):
+        from tinymail.headers import parse_summary
+        raw_headers = ("From: somebody@example.com\r\n"
+                       "Subject: One test message!\r\n"
+                       "Date: Mon, 14 Mar 2011 10:00:00 +0000\r\n"
+                       "\r\n")
+
+        self.assertEqual(parse_summary(raw_headers),
+                         (u"One test message!", u"somebody@example.com",
+                          u"Mon, 14 Mar 2011 10:00:00 +0000"))
+
+    def test_missing_headers(self):
+        from tinymail.headers import parse_summary
+        self.assertEqual(parse_summary("X-Foo: bar\r\n\r\n"), (u"", u"", u""))
+
+    def test_encoded_words(self):
+        from tinymail.headers import parse_summary
+        raw_headers = ("From: =?iso-8859-1?q?J=F6rg?= <j@example.com>\r\n"
+                       "Subject: =?utf-8?q?h=C3=A9llo?= world\r\n"
+                       "\r\n")
+
+        subject, sender, date = parse_summary(raw_headers)
+
+        self.assertEqual(subject, u"h\xe9llo world")
+        self.assertEqual(sender, u"J\xf6rg <j@example.com>")
+
+    def test_folded_header(self):
+        from tinymail.headers import parse_summary
+        raw_headers = "Subject: a long\r\n\tsubject line\r\n\r\n"
+        self.assertEqual(parse_summary(raw_headers)[0],
+                         u"a long subject line")
+
+    def test_undecodable_header(self):
+        from tinymail.headers import decode_header_value
+        self.assertEqual(decode_header_value("caf\xe9"), u"caf\xe9")
+        self.assertEqual(decode_header_value("=?x-unknown?q?abc?="),
+                         u"=?x-unknown?q?abc?=")
+
+class SearchFieldsTest(unittest.TestCase):
+    def test_search_fields(self):
+        from tinymail.headers import parse_search_fields
+        raw_headers = ("From: somebody@example.com\r\n"
+                       "To: =?utf-8?q?Ren=C3=A9?= <r@example.com>\r\n"
+                       "Cc: other@example.com\r\n"
+                       "Subject: hello\r\n"
+                       "\r\n")
+
+        self.assertEqual(parse_search_fields(raw_headers),
+                         (u"hello", u"somebody@example.com",
+                          u"Ren\xe9 <r@example.com> other@example.com", u""))
+
+    def test_body_text(self):
+        from tinymail.headers import body_text
+        raw_full = ("Content-Type: multipart/alternative; boundary=XX\r\n"
+                    "\r\n"
+                    "--XX\r\n"
+                    "Content-Type: text/plain; charset=utf-8\r\n"
+                    "Content-Transfer-Encoding: quoted-printable\r\n"
+                    "\r\n"
+                    "caf=C3=A9\r\n"
+                    "--XX\r\n"
+                    "Content-Type: text/html\r\n"
+                    "\r\n"
+                    "<p>cafe</p>\r\n"
+                    "--XX--\r\n")
+
+        self.assertEqual(body_text(raw_full).strip(), u"caf\xe9")
+
+    def test_body_text_html(self):
+        from tinymail.headers import body_text
+        raw_full = "Content-Type: text/html\r\n\r\n<p>hi <b>there</b></p>"
+        self.assertEqual(body_text(raw_full).split(), [u"hi", u"there"])
+
+class ThreadFieldsTest(unittest.TestCase):
+    def test_thread_fields(self):
+        from tinymail.headers import parse_thread_fields
+        raw_headers = ("Message-ID: <c@example.com>\r\n"
+                       "References: <a@example.com>\r\n"
+                       "  <b@example.com>\r\n"
+                       "In-Reply-To: <b@example.com> (Some One)\r\n"
+                       "\r\n")
+
+        self.assertEqual(parse_thread_fields(raw_headers),
+                         (u"<c@example.com>",
+                          [u"<a@example.com>", u"<b@example.com>"]))
+
+    def test_in_reply_to_only(self):
+        from tinymail.headers import parse_thread_fields
+        raw_headers = "In-Reply-To: <a@example.com>\r\n\r\n"
+        self.assertEqual(parse_thread_fields(raw_headers),
+                         (None, [u"<a@example.com>"]))
@@ -0,0 +1,81 @@
+import unittest2 as unittest
+
+def read_all(raw):
+    from cStringIO import StringIO
+    from tinymail.imap_parser import ResponseReader
+    stream = StringIO(raw)
+    reader = ResponseReader(stream.readline, stream.read)
+    responses = []
+    while stream.tell() < len(raw):
+        responses.append(reader.read_response())
+    return responses
+
+class ParseResponseTest(unittest.TestCase):
+    def test_fetch_flags(self):
+        from tinymail.imap_parser import FetchRecord
+        [record] = read_all('* 3 FETCH (UID 13 MODSEQ (14) '
+                            'FLAGS (\\Seen $Junk))\r\n')
+
+        flags = [r'\Seen', '$Junk']
+        self.assertEqual(record, FetchRecord(3, {'UID': 13, 'MODSEQ': 14,
+                                                 'FLAGS': flags}))
+        self.assertEqual((record.uid, record.flags, record.modseq),
+                         (13, flags, 14))
+
+    def test_fetch_literals(self):
+        hdr = 'Subject: (nested) "quotes"\r\n\r\n'
+        raw = ('* 1 FETCH (BODY[HEADER] {%d}\r\n%s '
+               'BODY[HEADER.FIELDS (TO)] {0}\r\n'
+               ' UID 31 INTERNALDATE "14-Mar-2011 10:00:00 +0000")\r\n'
+               % (len(hdr), hdr))
+
+        [record] = read_all(raw)
+
+        self.assertEqual(record.uid, 31)
+        self.assertEqual(record.attrs['BODY[HEADER]'], hdr)
+        self.assertEqual(record.attrs['BODY[HEADER.FIELDS (TO)]'], '')
+        self.assertEqual(record.attrs['INTERNALDATE'],
+                         '14-Mar-2011 10:00:00 +0000')
+
+    def test_fetch_nested_lists(self):
+        [record] = read_all('* 2 FETCH (UID 8 ENVELOPE (NIL "a \\"b\\"" '
+                            '((NIL NIL "x" "example.com"))))\r\n')
+
+        self.assertEqual(record.attrs['ENVELOPE'],
+                         [None, 'a "b"', [[None, None, 'x', 'example.com']]])
+
+    def test_list_and_status(self):
+        from tinymail.imap_parser import ListRecord, StatusRecord
+        responses = read_all('* LIST (\\HasNoChildren) "." INBOX\r\n'
+                             '* LIST () NIL {5}\r\nf)o"o\r\n'
+                             '* STATUS "fol 1" (MESSAGES 3 UIDNEXT 14)\r\n')
+
+        self.assertEqual(responses, [
+            ListRecord([r'\HasNoChildren'], '.', 'INBOX'),
+            ListRecord([], None, 'f)o"o'),
+            StatusRecord('fol 1', {'MESSAGES': 3, 'UIDNEXT': 14}),
+        ])
+
+    def test_other_responses(self):
+        from tinymail.imap_parser import Untagged, Tagged, Continuation
+        responses = read_all('* 4 EXISTS\r\n'
+                             '* VANISHED (EARLIER) 3:5\r\n'
+                             '* OK [UIDVALIDITY 1234] ok\r\n'
+                             '+ idling\r\n'
+                             'A12 ok [READ-ONLY] done\r\n')
+
+        self.assertEqual(responses, [
+            Untagged('EXISTS', '4'),
+            Untagged('VANISHED', '(EARLIER) 3:5'),
+            Untagged('OK', '[UIDVALIDITY 1234] ok'),
+            Continuation('idling'),
+            Tagged('A12', 'OK', '[READ-ONLY] done'),
+        ])
+
+    def test_errors(self):
+        from tinymail.imap_parser import ImapParseError
+        self.assertRaises(ImapParseError, read_all, '* 1 FETCH (UID 6\r\n')
+        self.assertRaises(ImapParseError, read_all, '* 1 FETCH (UID x)\r\n')
+        self.assertRaises(ImapParseError, read_all, '* LIST () "."\r\n')
+        self.assertRaises(ImapParseError, read_all,
+                          '* 1 FETCH (BODY[] {10}\r\nshort')
@@ -7,8 +7,26 @@ def worker_with_fake_imap():
     worker = ImapWorker()
     imap_conn = Mock(spec=imaplib.IMAP4)
     worker.conn = ConnectionErrorWrapper(imap_conn)
+    imap_conn.tagged_commands = {}
     return worker, imap_conn
 
+def serve(imap_conn, *replies):
+    """
+    Answer the commands sent with `_command`, one reply each: the lines of
+    a reply, then a tagged OK, are read back with `readline` and `read`.
+    """
+    from cStringIO import StringIO
+    tags = ['A%d' % n for n in range(len(replies))]
+    stream = StringIO(''.join(''.join(line + '\r\n' for line in reply) +
+                              '%s OK done\r\n' % tag
+                              for reply, tag in zip(replies, tags)))
+    imap_conn._command.side_effect = tags
+    imap_conn.readline.side_effect = stream.readline
+    imap_conn.read.side_effect = stream.read
+
+def status_reply(status):
+    return ['* STATUS "fol1" (%s)' % status]
+
 class ImapWorkerTest(unittest.TestCase):
     @patch('tinymail.imap_worker.imaplib')
     def test_connect(self, mock_imaplib):
@@ -25,40 +43,81 @@ class ImapWorkerTest(unittest.TestCase):
         mock_conn.login.assert_called_once_with('test_login', 'test_pass')
         self.assertEqual(worker.capabilities, ["A", "B", "C"])
 
+    @patch('tinymail.imap_worker.imaplib')
+    def test_connect_plain_with_port(self, mock_imaplib):
+        mock_conn = Mock(spec=imaplib.IMAP4)
+        mock_imaplib.IMAP4.return_value = mock_conn
+        mock_conn.login.return_value = ('OK', [])
+        mock_conn.capability.return_value = ('OK', ["A B C"])
+
+        from tinymail.imap_worker import ImapWorker
+        worker = ImapWorker()
+        worker.connect('test_host', 'test_login', 'test_pass',
+                       port=1143, ssl=False)
+
+        mock_imaplib.IMAP4.assert_called_once_with('test_host', 1143)
+        self.assertFalse(mock_imaplib.IMAP4_SSL.called)
+
+    def test_noop(self):
+        worker, imap_conn = worker_with_fake_imap()
+        imap_conn.noop.return_value = ('OK', [])
+
+        worker.noop()
+
+        imap_conn.noop.assert_called_once_with()
+
+    @patch('tinymail.imap_worker.imaplib')
+    def test_connect_enables_qresync(self, mock_imaplib):
+        mock_conn = Mock(spec=imaplib.IMAP4)
+        mock_imaplib.IMAP4_SSL.return_value = mock_conn
+        mock_conn.login.return_value = ('OK', [])
+        mock_conn.capability.return_value = ('OK', ["IMAP4rev1 QRESYNC"])
+        mock_conn._simple_command.return_value = ('OK', [])
+
+        from tinymail.imap_worker import ImapWorker
+        worker = ImapWorker()
+        worker.connect('test_host', 'test_login', 'test_pass')
+
+        mock_conn._simple_command.assert_called_once_with('ENABLE', 'QRESYNC')
+        self.assertTrue(worker.qresync_enabled)
+        self.assertTrue(worker.has_condstore())
+
     def test_get_mailbox_names(self):
         worker, imap_conn = worker_with_fake_imap()
-        imap_conn.list.return_value = ('OK', [
-            r'(\HasNoChildren) "." INBOX',
-            r'(\HasNoChildren) "." "fol1"',
-            r'(\HasChildren) "." "fol2"',
-            r'(\HasNoChildren) "." "fol2.sub"',
+        serve(imap_conn, [
+            r'* LIST (\HasNoChildren) "." INBOX',
+            r'* LIST (\HasNoChildren) "." "fol1"',
+            r'* LIST (\HasChildren) "." "fol2"',
+            r'* LIST (\HasNoChildren) "." "fol2.sub"',
         ])
 
         names = worker.get_mailbox_names()
 
+        imap_conn._command.assert_called_once_with('LIST', '""', '*')
         self.assertEqual(sorted(names), ['INBOX', 'fol1', 'fol2', 'fol2.sub'])
 
     def test_crash_on_non_ascii_folder(self):
         from tinymail.imap_worker import ImapWorkerError
         worker, imap_conn = worker_with_fake_imap()
-        imap_conn.list.return_value = ('OK', ['(\\HasNoChildren) "." "f\xb3"'])
+        serve(imap_conn, ['* LIST (\\HasNoChildren) "." "f\xb3"'])
 
         msg = "Non-ascii mailbox names not supported"
         self.assertRaisesRegexp(ImapWorkerError, msg, worker.get_mailbox_names)
 
     def test_open_mailbox(self):
         worker, imap_conn = worker_with_fake_imap()
-        imap_conn.select.return_value = ('OK', [])
-        imap_conn.status.return_value = ('OK', [
-            '"fol1" (MESSAGES 0 RECENT 1 UIDNEXT 14 '
-                    'UIDVALIDITY 1300189203 UNSEEN 1)'])
-        imap_conn.fetch.return_value = ('OK', [])
+        serve(imap_conn, ['* 0 EXISTS'],
+              status_reply('MESSAGES 0 RECENT 1 UIDNEXT 14 '
+                           'UIDVALIDITY 1300189203 UNSEEN 1'))
 
         mailbox_status = worker.select_mailbox('fol1')
 
-        imap_conn.select.assert_called_once_with('fol1', readonly=True)
-        imap_conn.status.assert_called_once_with(
-            'fol1', '(MESSAGES UIDNEXT UIDVALIDITY)')
+        self.assertEqual(imap_conn._command.call_args_list, [
+            (('EXAMINE', 'fol1'),),
+            (('STATUS', 'fol1', '(MESSAGES UIDNEXT UIDVALIDITY)'),),
+        ])
+        self.assertEqual(imap_conn.state, 'SELECTED')
+        imap_conn._append_untagged.assert_called_once_with('EXISTS', '0')
         self.assertEqual(mailbox_status, {
             'UIDNEXT': 14,
             'UIDVALIDITY': 1300189203,
@@ -67,119 +126,558 @@ class ImapWorkerTest(unittest.TestCase):
             'RECENT': 1,
         })
 
-    def test_map_uids(self):
+    def test_open_mailbox_condstore(self):
         worker, imap_conn = worker_with_fake_imap()
-        _status_data = ['"fol1" (MESSAGES 3 RECENT 1 UIDNEXT 14 '
-                        'UIDVALIDITY 1300189203 UNSEEN 1)']
-        _fetch_data = ['1 (UID 6)', '2 (UID 8)', '3 (UID 13)']
-        imap_conn.select.return_value = ('OK', [])
-        imap_conn.status.return_value = ('OK', _status_data)
-        imap_conn.fetch.return_value = ('OK', _fetch_data)
+        worker.capabilities = ['IMAP4rev1', 'CONDSTORE']
+        serve(imap_conn, [], status_reply('MESSAGES 0 UIDNEXT 14 '
+                                          'UIDVALIDITY 1300189203 '
+                                          'HIGHESTMODSEQ 715194045007'))
+
+        mailbox_status = worker.select_mailbox('fol1')
+
+        imap_conn._command.assert_called_with(
+            'STATUS', 'fol1', '(MESSAGES UIDNEXT UIDVALIDITY HIGHESTMODSEQ)')
+        self.assertEqual(mailbox_status['HIGHESTMODSEQ'], 715194045007)
+
+    def test_get_changed_flags_qresync(self):
+        worker, imap_conn = worker_with_fake_imap()
+        worker.qresync_enabled = True
+        serve(imap_conn, [
+            '* VANISHED (EARLIER) 3:5,7',
+            '* 2 FETCH (UID 8 MODSEQ (12) FLAGS (\\Seen))',
+            '* 3 FETCH (FLAGS () UID 13 MODSEQ (14))',
+        ])
+
+        changes = worker.get_changed_flags(10)
+
+        imap_conn._command.assert_called_once_with(
+            'UID', 'FETCH', '1:*', '(FLAGS) (CHANGEDSINCE 10 VANISHED)')
+        imap_conn._append_untagged.assert_called_once_with(
+            'VANISHED', '(EARLIER) 3:5,7')
+        self.assertEqual(changes, {'flags': {8: [r'\Seen'], 13: []},
+                                   'vanished': [3, 4, 5, 7]})
+
+    def test_get_changed_flags_condstore(self):
+        worker, imap_conn = worker_with_fake_imap()
+        serve(imap_conn, [])
+
+        changes = worker.get_changed_flags(10)
+
+        imap_conn._command.assert_called_once_with(
+            'UID', 'FETCH', '1:*', '(FLAGS) (CHANGEDSINCE 10)')
+        self.assertEqual(changes, {'flags': {}, 'vanished': None})
+        self.assertFalse(imap_conn.response.called)
+
+    def test_get_message_uids(self):
+        worker, imap_conn = worker_with_fake_imap()
+        imap_conn.uid.return_value = ('OK', ['6 8 13'])
+
+        self.assertEqual(worker.get_message_uids(), [6, 8, 13])
+        imap_conn.uid.assert_called_once_with('SEARCH', 'ALL')
+
+    def test_search_text(self):
+        worker, imap_conn = worker_with_fake_imap()
+        imap_conn.uid.return_value = ('OK', ['13 6'])
+
+        self.assertEqual(worker.search_text([u'hello', u'world']), [6, 13])
+        imap_conn.uid.assert_called_once_with('SEARCH', 'TEXT', '"hello"',
+                                              'TEXT', '"world"')
+
+    def test_search_text_non_ascii(self):
+        worker, imap_conn = worker_with_fake_imap()
+        def uid(*args):
+            # imaplib sends the literal, if any, then forgets it
+            literal, imap_conn.literal = imap_conn.literal, None
+            return {'caf\xc3\xa9': ('OK', ['6 8 13']),
+                    None: ('OK', ['8 13 15'])}[literal]
+        imap_conn.uid.side_effect = uid
+        imap_conn.literal = None
+
+        self.assertEqual(worker.search_text([u'caf\xe9', u'menu']), [8, 13])
+        self.assertEqual(imap_conn.uid.call_args_list, [
+            (('SEARCH', 'CHARSET', 'UTF-8', 'TEXT'),),
+            (('SEARCH', 'TEXT', '"menu"'),),
+        ])
+
+    def test_open_mailbox_does_not_map_uids(self):
+        worker, imap_conn = worker_with_fake_imap()
+        serve(imap_conn, [], status_reply('MESSAGES 3 UIDNEXT 14 '
+                                          'UIDVALIDITY 1300189203'))
 
         worker.select_mailbox('fol1')
 
+        self.assertEqual(imap_conn._command.call_count, 2)
+        self.assertFalse(imap_conn.uid.called)
+        self.assertEqual(worker.message_count, 3)
+
+    def test_map_sequence_numbers(self):
+        worker, imap_conn = worker_with_fake_imap()
+        worker.message_count = 3
+        serve(imap_conn, ['* 1 FETCH (UID 6)', '* 2 FETCH (UID 8)',
+                          '* 3 FETCH (UID 13)'])
+
+        worker.map_sequence_numbers()
+
         self.assertEqual(worker.message_index, {6:1, 8:2, 13:3})
-        imap_conn.fetch.assert_called_once_with('1:*', '(UID)')
+        self.assertEqual(worker.message_uid, {1:6, 2:8, 3:13})
+        imap_conn._command.assert_called_once_with('FETCH', '1:*', '(UID)')
 
     def test_open_mailbox_for_writing(self):
         worker, imap_conn = worker_with_fake_imap()
-        imap_conn.select.return_value = ('OK', [])
-        imap_conn.status.return_value = ('OK', [
-            '"fol1" (MESSAGES 0 RECENT 1 UIDNEXT 14 '
-                    'UIDVALIDITY 1300189203 UNSEEN 1)'])
+        serve(imap_conn, [], status_reply('MESSAGES 0 RECENT 1 UIDNEXT 14 '
+                                          'UIDVALIDITY 1300189203 UNSEEN 1'))
 
         mailbox_status = worker.select_mailbox('fol1', readonly=False)
 
-        imap_conn.select.assert_called_once_with('fol1', readonly=False)
+        self.assertEqual(imap_conn._command.call_args_list[0],
+                         (('SELECT', 'fol1'),))
+        self.assertFalse(imap_conn.is_readonly)
 
     def test_get_message_flags(self):
         worker, imap_conn = worker_with_fake_imap()
-        worker.message_uid = {1:6, 2:8, 3:13}
+        worker.message_count = 3
         _flags = {6: [r'\Seen'], 8: [r'\Answered', r'\Seen'], 13: []}
-        imap_conn.fetch.return_value = ('OK', [
-            '1 (FLAGS (\\Seen))',
-            '2 (FLAGS (\\Answered \\Seen))',
-            '3 (FLAGS ())',
+        serve(imap_conn, [
+            '* 1 FETCH (UID 6 FLAGS (\\Seen))',
+            '* 2 FETCH (UID 8 FLAGS (\\Answered \\Seen))',
+            '* 3 FETCH (FLAGS () UID 13)',
         ])
 
         message_flags = worker.get_message_flags()
 
-        imap_conn.fetch.assert_called_once_with('1:*', '(FLAGS)')
+        imap_conn._command.assert_called_once_with('UID', 'FETCH', '1:*',
+                                                   '(FLAGS)')
         self.assertEqual(message_flags, _flags)
 
     def test_get_message_flags_empty_mailbox(self):
         worker, imap_conn = worker_with_fake_imap()
-        worker.message_uid = {}
+        worker.message_count = 0
 
         message_flags = worker.get_message_flags()
 
         self.assertEqual(message_flags, {})
-        self.assertFalse(imap_conn.fetch.called)
+        self.assertFalse(imap_conn._command.called)
 
     def test_get_message_headers(self):
         worker, imap_conn = worker_with_fake_imap()
-        worker.message_index = {31: 1, 32: 2, 35: 5}
         hdr = ('From: somebody@example.com\r\n'
                'To: somebody_else@example.com\r\n'
                'Subject: One test message!\r\n'
                '\r\n')
-        imap_conn.fetch.return_value = ('OK', [
-            ('1 (BODY[HEADER] {%s} FLAGS (\\Seen)' % len(hdr), hdr), ')',
-            ('2 (BODY[HEADER] {%s} FLAGS (\\Seen)' % len(hdr), hdr), ')',
-            ('5 (BODY[HEADER] {%s} FLAGS (\\Seen)' % len(hdr), hdr), ')',
+        serve(imap_conn, [
+            '* 1 FETCH (UID 31 BODY[HEADER] {%s}' % len(hdr),
+                hdr + ' FLAGS (\\Seen))',
+            '* 2 FETCH (UID 32 BODY[HEADER] {%s}' % len(hdr), hdr + ')',
+            '* 4 FETCH (FLAGS (\\Deleted))',
+            '* 5 FETCH (BODY[HEADER] {%s}' % len(hdr), hdr + ' UID 35)',
         ])
 
-        header_by_index = worker.get_message_headers([31, 32, 35])
+        header_by_uid = worker.get_message_headers([35, 31, 32])
 
-        imap_conn.fetch.assert_called_once_with('1,2,5',
-                                                '(FLAGS BODY.PEEK[HEADER])')
-        self.assertEqual(header_by_index, {31: hdr, 32: hdr, 35: hdr})
+        imap_conn._command.assert_called_once_with(
+            'UID', 'FETCH', '31:32,35', '(FLAGS BODY.PEEK[HEADER])')
+        self.assertEqual(header_by_uid, {31: hdr, 32: hdr, 35: hdr})
 
     def test_get_message_body(self):
         worker, imap_conn = worker_with_fake_imap()
-        worker.message_index = {22: 5}
-        response_data = [('5 (RFC822 {7}', 'ZE BODY'), ')']
-        imap_conn.fetch.return_value = ('OK', response_data)
+        serve(imap_conn, ['* 5 FETCH (UID 22 BODY[] {7}', 'ZE BODY)'])
 
         message_body = worker.get_message_body(22)
 
-        imap_conn.fetch.assert_called_once_with('5', '(RFC822)')
+        imap_conn._command.assert_called_once_with('UID', 'FETCH', '22',
+                                                   '(BODY.PEEK[])')
         self.assertEqual(message_body, 'ZE BODY')
 
+    def test_fetch_error(self):
+        from tinymail.imap_worker import ImapWorkerError
+        worker, imap_conn = worker_with_fake_imap()
+        worker.message_count = 3
+        imap_conn._command.return_value = 'A0'
+        imap_conn.tagged_commands['A0'] = None
+        imap_conn.readline.side_effect = ['* 1 FETCH (UID 6 FLAGS ())\r\n',
+                                          'A0 NO [SERVERBUG] oops\r\n']
+
+        self.assertRaisesRegexp(ImapWorkerError, "SERVERBUG",
+                                worker.get_message_flags)
+        self.assertEqual(imap_conn.tagged_commands, {})
+
     def test_add_flag(self):
         worker, imap_conn = worker_with_fake_imap()
-        worker.message_index = {31: 1, 32: 2, 35: 5}
-        imap_conn.store.return_value = ('OK', [])
+        imap_conn.uid.return_value = ('OK', [])
 
         worker.change_flag([31, 32, 35], 'add', '\\Seen')
 
-        imap_conn.store.assert_called_once_with('1,2,5', '+FLAGS', '\\Seen')
+        imap_conn.uid.assert_called_once_with('STORE', '31:32,35',
+                                              '+FLAGS', '(\\Seen)')
 
     def test_remove_flag(self):
         worker, imap_conn = worker_with_fake_imap()
-        worker.message_index = {31: 1, 32: 2, 35: 5}
-        imap_conn.store.return_value = ('OK', [])
+        imap_conn.uid.return_value = ('OK', [])
 
         worker.change_flag([31, 32, 35], 'del', '\\Flagged')
 
-        imap_conn.store.assert_called_once_with('1,2,5', '-FLAGS', '\\Flagged')
+        imap_conn.uid.assert_called_once_with('STORE', '31:32,35',
+                                              '-FLAGS', '(\\Flagged)')
+
+    def test_change_flag_rejected(self):
+        from tinymail.imap_worker import ImapCommandRejected
+        worker, imap_conn = worker_with_fake_imap()
+        imap_conn.uid.return_value = ('NO', ['[READ-ONLY] no way'])
+
+        self.assertRaises(ImapCommandRejected, worker.change_flag,
+                          [31], 'add', '\\Seen')
 
     def test_copy_messages(self):
         worker, imap_conn = worker_with_fake_imap()
-        worker.message_index = {31: 1, 32: 2, 35: 5}
+        # imaplib's `uid` returns the untagged data, which is nothing for
+        # a COPY; the tagged OK carries COPYUID
+        imap_conn.uid.return_value = ('OK', [None])
         _copy_msg = '[COPYUID 1234 31,35 67:68] Copy completed.'
-        imap_conn.copy.return_value = ('OK', [_copy_msg])
+        imap_conn._simple_command.return_value = ('OK', [_copy_msg])
 
-        result = worker.copy_messages([31, 35], 'someplace-else')
+        result = worker.copy_messages([35, 31], 'someplace-else')
 
-        imap_conn.copy.assert_called_once_with('1,5', 'someplace-else')
+        imap_conn._simple_command.assert_called_once_with(
+            'UID', 'COPY', '31,35', 'someplace-else')
+        self.assertFalse(imap_conn.uid.called)
         self.assertEqual(result, {'UIDVALIDITY': 1234,
                                   'uid_map': {31:67, 35:68}})
 
-    def test_close(self):
+    def test_split_long_commands(self):
         worker, imap_conn = worker_with_fake_imap()
-        imap_conn.close.return_value = ('OK', [])
+        worker.max_command_length = 60
+        imap_conn.uid.return_value = ('OK', [])
+        uid_list = range(1, 10) + range(100, 200, 2)
+
+        worker.change_flag(uid_list, 'add', '\\Seen')
+
+        uid_sets = [call[0][1] for call in imap_conn.uid.call_args_list]
+        self.assertTrue(len(uid_sets) > 1)
+        self.assertEqual(uid_sets[0], '1:9,100')
+        overhead = len('a001 UID STORE  +FLAGS (\\Seen)\r\n')
+        for uid_set in uid_sets:
+            self.assertTrue(len(uid_set) + overhead <= 60)
+        from tinymail.imap_worker import array_from_imap_str
+        self.assertEqual(sum(map(array_from_imap_str, uid_sets), []),
+                         uid_list)
+
+    def test_copy_messages_split(self):
+        worker, imap_conn = worker_with_fake_imap()
+        worker.max_command_length = 55
+        imap_conn._simple_command.side_effect = [
+            ('OK', ['[COPYUID 1234 31,35 67:68] Copy completed.']),
+            ('OK', ['[COPYUID 1234 37 69] Copy completed.']),
+        ]
+
+        result = worker.copy_messages([35, 31, 37], 'someplace-else')
+
+        calls = imap_conn._simple_command.call_args_list
+        self.assertEqual([call[0][2] for call in calls], ['31,35', '37'])
+        self.assertEqual(result, {'UIDVALIDITY': 1234,
+                                  'uid_map': {31:67, 35:68, 37:69}})
+
+    def test_copy_messages_without_copyuid(self):
+        worker, imap_conn = worker_with_fake_imap()
+        imap_conn._simple_command.return_value = ('OK', ['Copy completed.'])
+
+        result = worker.copy_messages([35, 31], 'someplace-else')
 
+        self.assertEqual(result, {'UIDVALIDITY': None, 'uid_map': {}})
+
+        imap_conn._simple_command.reset_mock()
+        result = worker.copy_messages([], 'someplace-else')
+
+        self.assertFalse(imap_conn._simple_command.called)
+        self.assertEqual(result, {'UIDVALIDITY': None, 'uid_map': {}})
+
+    def test_close_keeps_mailbox_selected(self):
+        worker, imap_conn = worker_with_fake_imap()
+        reply = status_reply('MESSAGES 3 UIDNEXT 14 UIDVALIDITY 1300189203')
+        serve(imap_conn, [], reply, [], reply)
+
+        worker.select_mailbox('fol1')
         worker.close_mailbox()
+        mailbox_status = worker.select_mailbox('fol1')
+
+        self.assertFalse(imap_conn.close.called)
+        self.assertEqual([c[0][0] for c in imap_conn._command.call_args_list],
+                         ['EXAMINE', 'STATUS', 'NOOP', 'STATUS'])
+        self.assertEqual(mailbox_status['MESSAGES'], 3)
+        self.assertEqual(worker.selects_saved, 1)
+
+    def test_select_for_writing_after_readonly(self):
+        worker, imap_conn = worker_with_fake_imap()
+        reply = status_reply('MESSAGES 3 UIDNEXT 14 UIDVALIDITY 1300189203')
+        serve(imap_conn, *[[], reply] * 4)
+
+        worker.select_mailbox('fol1')
+        worker.select_mailbox('fol1', readonly=False)
+        # a writable mailbox will do for reading
+        worker.select_mailbox('fol1')
+        worker.close_mailbox()
+        worker.select_mailbox('fol1', readonly=False)
+
+        calls = imap_conn._command.call_args_list
+        self.assertEqual([c[0][0] for c in calls[::2]],
+                         ['EXAMINE', 'SELECT', 'NOOP', 'NOOP'])
+        self.assertEqual(worker.selects_saved, 2)
+
+    def test_select_error(self):
+        from tinymail.imap_worker import ImapWorkerError
+        worker, imap_conn = worker_with_fake_imap()
+        worker.selected_mailbox = 'fol0'
+        imap_conn._command.side_effect = ['A0', 'A1']
+        imap_conn.readline.side_effect = [
+            'A0 NO [NONEXISTENT] no such mailbox\r\n',
+            '* STATUS "fol1" (MESSAGES 0)\r\n',
+            'A1 OK done\r\n',
+        ]
+
+        self.assertRaisesRegexp(ImapWorkerError, "NONEXISTENT",
+                                worker.select_mailbox, 'fol1')
+        # the STATUS reply was read too, the next command can go ahead
+        self.assertEqual(imap_conn.readline.call_count, 3)
+        self.assertEqual(imap_conn.state, 'AUTH')
+        self.assertIsNone(worker.selected_mailbox)
+
+    def test_select_and_get_flags(self):
+        worker, imap_conn = worker_with_fake_imap()
+        serve(imap_conn, ['* 2 EXISTS'],
+              status_reply('MESSAGES 2 UIDNEXT 14 UIDVALIDITY 1300189203'),
+              ['* 1 FETCH (UID 6 FLAGS (\\Seen))',
+               '* 2 FETCH (FLAGS () UID 13)'])
+
+        # without CONDSTORE, the modseq is no use
+        mailbox_status, changes = worker.select_and_get_flags('fol1', 10)
+
+        # all three commands go out before any reply is read
+        self.assertEqual(imap_conn._command.call_args_list, [
+            (('EXAMINE', 'fol1'),),
+            (('STATUS', 'fol1', '(MESSAGES UIDNEXT UIDVALIDITY)'),),
+            (('UID', 'FETCH', '1:*', '(FLAGS)'),),
+        ])
+        self.assertEqual(mailbox_status['MESSAGES'], 2)
+        self.assertEqual(changes, {'flags': {6: [r'\Seen'], 13: []},
+                                   'vanished': None, 'since': None})
+        self.assertEqual(worker.selected_mailbox, 'fol1')
+        self.assertEqual(imap_conn.tagged_commands, {})
+
+    def test_select_and_get_changed_flags(self):
+        worker, imap_conn = worker_with_fake_imap()
+        worker.capabilities = ['IMAP4rev1', 'QRESYNC']
+        worker.qresync_enabled = True
+        serve(imap_conn, ['* VANISHED 2'],
+              status_reply('MESSAGES 2 UIDNEXT 14 UIDVALIDITY 1300189203 '
+                           'HIGHESTMODSEQ 14'),
+              ['* VANISHED (EARLIER) 3:5',
+               '* 2 FETCH (UID 13 MODSEQ (14) FLAGS ())'])
+
+        mailbox_status, changes = worker.select_and_get_flags('fol1', 10)
+
+        imap_conn._command.assert_called_with(
+            'UID', 'FETCH', '1:*', '(FLAGS) (CHANGEDSINCE 10 VANISHED)')
+        # the VANISHED that came with the SELECT isn't taken for the FETCH's
+        self.assertEqual(changes, {'flags': {13: []}, 'vanished': [3, 4, 5],
+                                   'since': 10})
+
+    def test_select_and_get_flags_empty_mailbox(self):
+        worker, imap_conn = worker_with_fake_imap()
+        imap_conn._command.side_effect = ['A0', 'A1', 'A2']
+        imap_conn.readline.side_effect = [
+            'A0 OK done\r\n',
+            '* STATUS "fol1" (MESSAGES 0 UIDNEXT 1 UIDVALIDITY 7)\r\n',
+            'A1 OK done\r\n',
+            'A2 BAD invalid message sequence\r\n',
+        ]
+
+        mailbox_status, changes = worker.select_and_get_flags('fol1')
+
+        self.assertEqual(changes, {'flags': {}, 'vanished': None,
+                                   'since': None})
+
+    def test_close_now(self):
+        worker, imap_conn = worker_with_fake_imap()
+        worker.selected_mailbox = 'fol1'
+        imap_conn.close.return_value = ('OK', [])
+
+        worker.close_mailbox(now=True)
 
         imap_conn.close.assert_called_once_with()
+        self.assertIsNone(worker.selected_mailbox)
+
+    def test_close_now_with_unselect(self):
+        worker, imap_conn = worker_with_fake_imap()
+        worker.capabilities = ['IMAP4rev1', 'UNSELECT']
+        worker.selected_mailbox = 'fol1'
+        imap_conn._simple_command.return_value = ('OK', [])
+
+        worker.close_mailbox(now=True)
+
+        imap_conn._simple_command.assert_called_once_with('UNSELECT')
+        self.assertFalse(imap_conn.close.called)
+        self.assertIsNone(worker.selected_mailbox)
+
+class DeflateSocketTest(unittest.TestCase):
+    def test_round_trip(self):
+        import socket
+        from tinymail.imap_worker import DeflateSocket
+        a, b = socket.socketpair()
+        sender, receiver = DeflateSocket(a), DeflateSocket(b)
+        data = ''.join('* %d FETCH (UID %d FLAGS (\\Seen))\r\n' % (i, i)
+                       for i in range(1, 101))
+
+        sender.sendall(data[:1000])
+        sender.sendall(data[1000:])
+        received = []
+        while sum(map(len, received)) < len(data):
+            chunk = receiver.recv(100)
+            self.assertTrue(0 < len(chunk) <= 100)
+            received.append(chunk)
+
+        self.assertEqual(''.join(received), data)
+        self.assertEqual(receiver.received, len(data))
+        self.assertEqual(receiver.received_compressed, sender.sent_compressed)
+        self.assertTrue(sender.sent_compressed < len(data) / 4)
+        a.close()
+        self.assertEqual(receiver.recv(100), '')
+
+class ImapWorkerIdleTest(unittest.TestCase):
+    capabilities = ('IMAP4rev1', 'UIDPLUS', 'IDLE', 'UNSELECT')
+
+    def setUp(self):
+        from tinymail.bench.fake_imap import single_mailbox_server
+        from tinymail.imap_worker import ImapWorker
+        self.server = single_mailbox_server(
+            2, capabilities=self.capabilities).start()
+        self.mbox = self.server.mailboxes['INBOX']
+        self.worker = ImapWorker()
+        self.worker.connect('127.0.0.1', 'user', 'pass',
+                            port=self.server.port, ssl=False)
+        self.worker.select_mailbox('INBOX')
+
+    def tearDown(self):
+        try:
+            self.worker.disconnect()
+        except Exception:
+            # the connection was interrupted
+            self.worker.conn.conn.sock.close()
+        self.server.stop()
+
+    def test_has_idle(self):
+        self.assertTrue(self.worker.has_idle())
+
+    def test_idle_timeout(self):
+        self.assertEqual(self.worker.idle(.1), [])
+        # the connection is still usable afterwards
+        self.assertEqual(self.worker.get_message_uids(), [1, 2])
+
+    def test_idle_new_message(self):
+        import threading
+        from tinymail.bench.fake_imap import make_message
+        threading.Timer(.1, self.mbox.add_message,
+                        [make_message(3)]).start()
+
+        notifications = self.worker.idle(5)
+
+        self.assertEqual(notifications, [('EXISTS', '3')])
+        self.assertEqual(self.worker.get_message_uids(), [1, 2, 3])
+
+    def test_interrupt(self):
+        import threading
+        import time
+        threading.Timer(.1, self.worker.interrupt).start()
+
+        t0 = time.time()
+        self.assertRaises(Exception, self.worker.idle, 5)
+        self.assertTrue(time.time() - t0 < 2)
+
+    def test_copy_messages(self):
+        from tinymail.bench.fake_imap import FakeMailbox
+        other = self.server.mailboxes['other'] = FakeMailbox(uidvalidity=99)
+
+        result = self.worker.copy_messages([1, 2], 'other')
+
+        self.assertEqual(result, {'UIDVALIDITY': 99, 'uid_map': {1: 1, 2: 2}})
+        self.assertEqual(len(other.messages), 2)
+
+class ImapWorkerCompressTest(ImapWorkerIdleTest):
+    """ The IDLE tests again, over COMPRESS=DEFLATE, and some more. """
+
+    capabilities = ImapWorkerIdleTest.capabilities + ('COMPRESS=DEFLATE',)
+
+    def test_compression_on(self):
+        from tinymail.bench.fake_imap import make_message
+        deflate = self.worker.deflate
+        self.assertIsNotNone(deflate)
+
+        headers = self.worker.get_message_headers([1, 2])
+
+        self.assertEqual(headers[2], make_message(2).split('\r\n\r\n')[0]
+                                     + '\r\n\r\n')
+        self.assertTrue(0 < deflate.received_compressed < deflate.received)
+        # short commands don't shrink, but they all go through zlib
+        self.assertTrue(self.server.stats['bytes_received'] >
+                        deflate.sent_compressed > 0)
+
+    def test_compress_off(self):
+        from tinymail.imap_worker import ImapWorker
+        worker = ImapWorker()
+        worker.connect('127.0.0.1', 'user', 'pass', port=self.server.port,
+                       ssl=False, compress=False)
+
+        self.assertIsNone(worker.deflate)
+        self.assertEqual(worker.get_mailbox_names(), ['INBOX'])
+        worker.disconnect()
+
+class ImapWorkerPipelineTest(unittest.TestCase):
+    def setUp(self):
+        from tinymail.bench.fake_imap import single_mailbox_server
+        from tinymail.imap_worker import ImapWorker
+        # with some latency, the server sees pipelined commands arrive
+        # together, as it would over a real link
+        self.server = single_mailbox_server(3, latency=.05).start()
+        self.worker = ImapWorker()
+        self.worker.connect('127.0.0.1', 'user', 'pass',
+                            port=self.server.port, ssl=False)
+
+    def tearDown(self):
+        self.worker.disconnect()
+        self.server.stop()
+
+    def round_trips(self, func, *args):
+        stats = self.server.stats
+        before = stats['round_trips'], stats['commands']
+        result = func(*args)
+        return (stats['round_trips'] - before[0],
+                stats['commands'] - before[1]), result
+
+    def test_select_and_get_flags(self):
+        self.server.mailboxes['INBOX'].messages[1][1].add('\\Seen')
+
+        counts, (mailbox_status, changes) = \
+            self.round_trips(self.worker.select_and_get_flags, 'INBOX')
+
+        self.assertEqual(counts, (1, 3))
+        self.assertEqual(mailbox_status['MESSAGES'], 3)
+        self.assertEqual(changes['flags'], {1: [], 2: ['\\Seen'], 3: []})
+        # the connection is in step with the server afterwards
+        self.assertEqual(self.worker.get_message_uids(), [1, 2, 3])
+
+    def test_select_mailbox(self):
+        counts, mailbox_status = \
+            self.round_trips(self.worker.select_mailbox, 'INBOX')
+        self.assertEqual(counts, (1, 2))
+
+        counts, mailbox_status = \
+            self.round_trips(self.worker.select_mailbox, 'INBOX')
+        self.assertEqual(counts, (1, 2)) # NOOP and STATUS
+
+    def test_select_missing_mailbox(self):
+        from tinymail.imap_worker import ImapWorkerError
+        self.worker.select_mailbox('INBOX')
+
+        self.assertRaises(ImapWorkerError, self.worker.select_and_get_flags,
+                          'nonexistent')
+
+        self.assertIsNone(self.worker.selected_mailbox)
+        self.assertEqual(self.worker.get_mailbox_names(), ['INBOX'])
@@ -39,6 +39,38 @@ class ImapIndexTranscodingTest(unittest.TestCase):
             self.assertEqual(array_from_imap_str(str_value), arr_value)
             self.assertEqual(imap_str_from_sequence(arr_value), str_value)
 
+    def test_reversed_range(self):
+        from tinymail.imap_worker import array_from_imap_str
+        self.assertEqual(array_from_imap_str('5:3'), [3, 4, 5])
+
+    def test_empty_sequence(self):
+        from tinymail.imap_worker import imap_str_from_sequence
+        self.assertEqual(imap_str_from_sequence([]), '')
+
+    def test_large_sequence(self):
+        from tinymail.imap_worker import imap_str_from_sequence
+        seq = range(1, 5001) + [5002] + range(5004, 100000, 2)
+        imap_str = imap_str_from_sequence(seq)
+        self.assertTrue(imap_str.startswith('1:5000,5002,5004,5006,'))
+        self.assertTrue(imap_str.endswith(',99998'))
+
+    def test_split(self):
+        from tinymail.imap_worker import split_imap_str
+        from tinymail.imap_worker import array_from_imap_str
+
+        seq = [1, 2, 3, 5, 7, 8, 100, 102, 103, 104]
+        chunks = list(split_imap_str(seq, 8))
+
+        self.assertEqual(chunks, ['1:3,5', '7:8,100', '102:104'])
+        self.assertEqual(sum(map(array_from_imap_str, chunks), []), seq)
+
+    def test_split_long_range(self):
+        from tinymail.imap_worker import split_imap_str
+        # a single range can't be split, even if it's over the limit
+        self.assertEqual(list(split_imap_str(range(1000, 2000), 5)),
+                         ['1000:1999'])
+        self.assertEqual(list(split_imap_str([], 5)), [])
+
 
 class IndexSetConversionTest(unittest.TestCase):
 
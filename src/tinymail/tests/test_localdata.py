@@ -78,6 +78,197 @@ class LocalDataTest(unittest.TestCase):
 
         self.assertEqual(db_folder.get_uidvalidity(), 1234)
 
+    def test_folder_highestmodseq(self):
+        db = mock_db()
+        db_folder = db_account_folder(db, 'my account', 'archive')
+        self.assertIs(db_folder.get_highestmodseq(), None)
+
+        with db.transaction():
+            db_folder.set_highestmodseq(715194045007)
+
+        self.assertEqual(db_folder.get_highestmodseq(), 715194045007)
+
+    def test_upgrade_schema_without_highestmodseq(self):
+        import sqlite3
+        from tinymail.localdata import create_db_schema, LocalDataDB
+        connection = sqlite3.connect(':memory:')
+        connection.execute("create table folder (account varchar, "
+                           "name varchar, uidvalidity integer)")
+        connection.execute("insert into folder values ('A', 'fol', 5)")
+
+        create_db_schema(connection)
+
+        db_folder = LocalDataDB(connection).get_account('A').get_folder('fol')
+        self.assertEqual(db_folder.get_uidvalidity(), 5)
+        self.assertIs(db_folder.get_highestmodseq(), None)
+
+    def test_upgrade_unversioned_schema(self):
+        import sqlite3
+        from tinymail.localdata import (create_db_schema, LocalDataDB,
+                                        SCHEMA_VERSION, single_result)
+        connection = sqlite3.connect(':memory:')
+        connection.execute("create table folder (account varchar, "
+                           "name varchar, uidvalidity integer, "
+                           "highestmodseq integer)")
+        connection.execute("create table message (account varchar, "
+                           "folder varchar, uid integer, flags varchar, "
+                           "headers text)")
+        connection.execute("insert into folder values ('A', 'fol', 5, 9)")
+        connection.execute("insert into folder values ('B', 'fol', 6, 3)")
+        connection.execute("insert into message values "
+                           "('A', 'fol', 13, '\\Seen', 'Subject: hi!')")
+        connection.execute("insert into message values "
+                           "('B', 'fol', 15, '', 'Subject: message 2')")
+        connection.commit()
+
+        create_db_schema(connection)
+
+        version = single_result(connection.execute("pragma user_version"))
+        self.assertEqual(version, SCHEMA_VERSION)
+        db = LocalDataDB(connection)
+        A_fol = db.get_account('A').get_folder('fol')
+        self.assertEqual(A_fol.get_uidvalidity(), 5)
+        self.assertEqual(A_fol.get_highestmodseq(), 9)
+        self.assertEqual(list(A_fol.list_messages()), [msg1])
+        B_fol = db.get_account('B').get_folder('fol')
+        self.assertEqual(list(B_fol.list_messages()), [msg2])
+
+    def test_upgrade_schema_version_1(self):
+        import sqlite3
+        from tinymail.localdata import (create_db_schema, LocalDataDB,
+                                        schema_v1, SCHEMA_VERSION,
+                                        single_result)
+        connection = sqlite3.connect(':memory:')
+        connection.executescript(schema_v1 + "pragma user_version = 1;")
+        connection.execute("insert into folder(account, name) "
+                           "values ('A', 'fol')")
+        connection.commit()
+
+        create_db_schema(connection)
+
+        version = single_result(connection.execute("pragma user_version"))
+        self.assertEqual(version, SCHEMA_VERSION)
+        db = LocalDataDB(connection)
+        db_folder = db.get_account('A').get_folder('fol')
+        with db.transaction():
+            self.assertIs(db_folder.get_message_body(13), None)
+
+    def test_upgrade_schema_version_2(self):
+        import sqlite3
+        from tinymail.localdata import (create_db_schema, LocalDataDB,
+                                        schema_v1, schema_updates)
+        connection = sqlite3.connect(':memory:')
+        connection.executescript(schema_v1 + schema_updates[2] +
+                                 "pragma user_version = 2;")
+        connection.execute("insert into folder(account, name) "
+                           "values ('A', 'fol')")
+        connection.execute("insert into message(folder_id, uid, flags, "
+                           "headers) values (1, 13, '', ?)",
+                           (u"Subject: hi!\r\nFrom: me\r\n\r\n",))
+        connection.commit()
+
+        create_db_schema(connection)
+
+        db_folder = LocalDataDB(connection).get_account('A').get_folder('fol')
+        [message] = db_folder.list_messages(summary=True)
+        self.assertEqual(message[3], (u"hi!", u"me", u""))
+
+    def test_upgrade_schema_indexes_messages(self):
+        import sqlite3
+        from tinymail.localdata import (create_db_schema, LocalDataDB,
+                                        schema_v1, schema_updates)
+        connection = sqlite3.connect(':memory:')
+        connection.executescript(schema_v1 + schema_updates[2] +
+                                 "pragma user_version = 2;")
+        connection.execute("insert into folder(account, name) "
+                           "values ('A', 'fol')")
+        connection.execute("insert into message(folder_id, uid, flags, "
+                           "headers) values (1, 13, '', ?)",
+                           (u"Subject: hi!\r\nFrom: me\r\n\r\n",))
+        connection.execute("insert into body(folder_id, uid, data, size, "
+                           "last_access) values (1, 13, ?, 9, 0)",
+                           (sqlite3.Binary("\r\nlunch?\r\n"),))
+        connection.commit()
+
+        create_db_schema(connection)
+
+        db_folder = LocalDataDB(connection).get_account('A').get_folder('fol')
+        self.assertEqual(db_folder.list_threads(), [[(13, 0)]])
+        self.assertEqual(db_folder.search_messages(u"hi"), [13])
+        self.assertEqual(db_folder.search_messages(u"lunch"), [13])
+
+    def test_upgrade_schema_after_interrupted_threading(self):
+        import sqlite3
+        from tinymail.localdata import (create_db_schema, LocalDataDB,
+                                        SCHEMA_VERSION, single_result)
+        connection = sqlite3.connect(':memory:')
+        create_db_schema(connection)
+        db = LocalDataDB(connection)
+        db_folder = db_account_folder(db, 'A', 'fol')
+        with db.transaction():
+            db_folder.add_message(*msg1)
+        # the thread tables were created, but the version never recorded
+        connection.execute("insert into thread_member values "
+                           "(1, '<stale@example.com>', 99)")
+        connection.execute("pragma user_version = 5")
+        connection.commit()
+
+        create_db_schema(connection)
+
+        version = single_result(connection.execute("pragma user_version"))
+        self.assertEqual(version, SCHEMA_VERSION)
+        self.assertEqual(db_folder.list_threads(), [[(13, 0)]])
+        self.assertFalse(list(connection.execute(
+            "select * from thread_member where thread_id = 99")))
+
+    def test_failed_upgrade_is_rolled_back(self):
+        import sqlite3
+        from mock import patch
+        from tinymail import localdata
+        connection = sqlite3.connect(':memory:')
+        localdata.create_db_schema(connection)
+        def update(connection):
+            connection.execute("create table new_table (x integer)")
+            connection.execute("alter table message add column y integer")
+            raise RuntimeError("interrupted")
+        updates = dict(localdata.schema_updates)
+        updates[localdata.SCHEMA_VERSION + 1] = update
+
+        with patch.object(localdata, 'schema_updates', updates):
+            with patch.object(localdata, 'SCHEMA_VERSION',
+                              localdata.SCHEMA_VERSION + 1):
+                self.assertRaises(RuntimeError,
+                                  localdata.create_db_schema, connection)
+
+        version = localdata.single_result(
+            connection.execute("pragma user_version"))
+        self.assertEqual(version, localdata.SCHEMA_VERSION)
+        tables = [name for (name,) in connection.execute(
+                  "select name from sqlite_master where type = 'table'")]
+        self.assertNotIn('new_table', tables)
+        columns = [row[1] for row in
+                   connection.execute("pragma table_info(message)")]
+        self.assertNotIn('y', columns)
+
+    def test_flags_lookup_uses_index(self):
+        db = mock_db()
+        plan = db._connection.execute("explain query plan "
+                                      "select uid, flags from message "
+                                      "where folder_id = 1").fetchall()
+        self.assertIn('COVERING INDEX message_flags', str(plan))
+
+    def test_remove_folder_removes_messages(self):
+        db = mock_db()
+        db_folder = db_account_folder(db, 'my account', 'archive')
+        with db.transaction():
+            db_folder.add_message(*msg1)
+
+        with db.transaction():
+            db.get_account('my account').del_folder('archive')
+        db_folder = db_account_folder(db, 'my account', 'archive')
+
+        self.assertEqual(list(db_folder.list_messages()), [])
+
     def test_messages(self):
         db = mock_db()
         db_folder = db_account_folder(db, 'my account', 'archive')
@@ -207,6 +398,263 @@ class LocalDataTest(unittest.TestCase):
             self.assertRaises(KeyError, db_folder.set_message_flags,
                               13, set([r'\Seen', r'\Answered']))
 
+    def test_bulk_set_message_flags(self):
+        db = mock_db()
+        db_folder = db_account_folder(db, 'my account', 'archive')
+        with db.transaction():
+            db_folder.bulk_add_messages([msg1, msg2, msg3])
+
+        with db.transaction():
+            db_folder.bulk_set_message_flags({13: set(),
+                                              19: set([r'\Flagged'])})
+
+        messages = sorted(db_folder.list_messages())
+        self.assertEqual(messages, [
+            (13, set(), "Subject: hi!"),
+            msg2,
+            (19, set([r'\Flagged']), "Subject: another"),
+        ])
+
+    def test_bulk_set_message_flags_nonexistent(self):
+        db = mock_db()
+        db_folder = db_account_folder(db, 'my account', 'archive')
+        with db.transaction():
+            db_folder.bulk_add_messages([msg1])
+
+        with db.transaction():
+            self.assertRaises(KeyError, db_folder.bulk_set_message_flags,
+                              {13: set(), 19: set()})
+
+        self.assertEqual(list(db_folder.list_messages()), [msg1])
+
+    def test_message_window(self):
+        db = mock_db()
+        db_folder = db_account_folder(db, 'my account', 'archive')
+        with db.transaction():
+            db_folder.bulk_add_messages([msg3, msg1, msg2])
+
+        self.assertEqual(db_folder.count_messages(), 3)
+        self.assertEqual(db_folder.list_uids(), [13, 15, 19])
+        self.assertEqual(list(db_folder.list_messages(1, 1)), [msg2])
+        self.assertEqual(list(db_folder.list_messages(1)), [msg2, msg3])
+        self.assertEqual(db_folder.get_message(15), msg2)
+        self.assertRaises(KeyError, db_folder.get_message, 14)
+        self.assertEqual(db_folder.get_message_flags(),
+                         {13: set([r'\Seen']), 15: set(), 19: set()})
+        self.assertEqual(db_folder.get_message_flags([13]),
+                         {13: set([r'\Seen'])})
+
+    def test_message_body(self):
+        db = mock_db()
+        db_folder = db_account_folder(db, 'my account', 'archive')
+        body = "Subject: hi!\r\n\r\n\xff\x00 binary"
+        with db.transaction():
+            db_folder.add_message(*msg1)
+            self.assertIs(db_folder.get_message_body(13), None)
+            db_folder.set_message_body(13, body)
+
+        with db.transaction():
+            self.assertEqual(db_folder.get_message_body(13), body)
+
+        with db.transaction():
+            db_folder.del_message(13)
+            self.assertIs(db_folder.get_message_body(13), None)
+
+    def test_operations(self):
+        db = mock_db()
+        db_account = db.get_account('my account')
+        with db.transaction():
+            db_folder = db_account.add_folder('archive')
+            db_folder.set_uidvalidity(1234)
+            op1 = db_folder.add_operation('flag', [4, 15], 'add', r'\Seen')
+            op2 = db_folder.add_operation('copy', [4], None, 'other')
+            op3 = db_folder.add_operation('flag', [22], 'del', r'\Seen')
+
+        self.assertEqual(db_folder.list_operations('flag'), [
+            (op1, 1234, [4, 15], 'add', r'\Seen'),
+            (op3, 1234, [22], 'del', r'\Seen'),
+        ])
+        self.assertEqual(db_account.list_folders_with_operations('copy'),
+                         ['archive'])
+
+        with db.transaction():
+            db_folder.del_operations([op1, op2])
+        self.assertEqual(db_folder.list_operations('copy'), [])
+        self.assertEqual([op[0] for op in db_folder.list_operations('flag')],
+                         [op3])
+
+        with db.transaction():
+            db_account.del_folder('archive')
+        self.assertEqual(db_account.list_folders_with_operations('flag'), [])
+
+    def test_body_cache_eviction(self):
+        db = mock_db()
+        db.body_cache_size = 25
+        db.clock = iter(range(100)).next
+        db_folder = db_account_folder(db, 'my account', 'archive')
+        with db.transaction():
+            db_folder.bulk_add_messages([msg1, msg2, msg3])
+            db_folder.set_message_body(13, "a" * 10)
+            db_folder.set_message_body(15, "b" * 10)
+            db_folder.get_message_body(13)
+            db_folder.set_message_body(19, "c" * 10)
+
+            self.assertEqual(db_folder.get_message_body(13), "a" * 10)
+            self.assertIs(db_folder.get_message_body(15), None)
+            self.assertEqual(db_folder.get_message_body(19), "c" * 10)
+
+    def test_body_cache_counted_only_near_limit(self):
+        from mock import Mock
+        db = mock_db()
+        db.body_cache_size = 25
+        db_folder = db_account_folder(db, 'my account', 'archive')
+        db._execute = Mock(wraps=db._execute)
+        def sums():
+            return sum(1 for call in db._execute.call_args_list
+                       if 'sum(size)' in call[0][0])
+        with db.transaction():
+            db_folder.bulk_add_messages([msg1, msg2, msg3])
+            db_folder.set_message_body(13, "a" * 10)
+            db_folder.set_message_body(15, "b" * 10)
+            self.assertEqual(sums(), 1)
+
+            db_folder.set_message_body(19, "c" * 10)
+            self.assertEqual(sums(), 2)
+            self.assertEqual(db_folder.count_message_bodies(), 2)
+
+        # the sizes are read from an index, not from the rows
+        plan = list(db._connection.execute("explain query plan "
+                                           "select sum(size) from body"))
+        self.assertIn('COVERING INDEX', plan[0][-1])
+
+    def test_search_messages(self):
+        db = mock_db()
+        db_folder = db_account_folder(db, 'my account', 'archive')
+        with db.transaction():
+            db_folder.bulk_add_messages([
+                (13, set(), "Subject: lunch plans\r\nFrom: ann\r\n\r\n"),
+                (15, set(), "Subject: =?utf-8?q?caf=C3=A9?=\r\n"
+                            "To: bob@example.com\r\n\r\n"),
+                (19, set(), "Subject: minutes\r\nCc: ann\r\n\r\n"),
+            ])
+            db_folder.set_message_body(19, "Subject: minutes\r\n\r\n"
+                                           "Lunch is at noon.\r\n")
+
+        self.assertEqual(db_folder.search_messages(u"lunch"), [13, 19])
+        self.assertEqual(db_folder.search_messages(u"lun"), [13, 19])
+        self.assertEqual(db_folder.search_messages(u"lunch noon"), [19])
+        self.assertEqual(db_folder.search_messages(u"cafe"), [15])
+        self.assertEqual(db_folder.search_messages(u"bob@example"), [15])
+        self.assertEqual(db_folder.search_messages(u"ann"), [13, 19])
+        self.assertEqual(db_folder.search_messages(u"lunch", 1, 1), [19])
+        self.assertEqual(db_folder.search_messages(u'"'), [])
+        self.assertEqual(db_folder.search_messages(u"  "), [])
+
+        with db.transaction():
+            db_folder.del_message(13)
+        self.assertEqual(db_folder.search_messages(u"lunch"), [19])
+
+        with db.transaction():
+            db_folder.del_all_messages()
+        self.assertEqual(db_folder.search_messages(u"minutes"), [])
+
+    def test_search_evicted_body(self):
+        db = mock_db()
+        db.body_cache_size = 25
+        db_folder = db_account_folder(db, 'my account', 'archive')
+        with db.transaction():
+            db_folder.bulk_add_messages([msg1, msg2])
+            db_folder.set_message_body(13, "\r\nfirst body\r\n")
+            db_folder.set_message_body(15, "\r\nsecond body\r\n")
+
+        self.assertEqual(db_folder.search_messages(u"body"), [15])
+        self.assertEqual(db_folder.count_message_bodies(), 1)
+
+    def test_search_account(self):
+        db = mock_db()
+        db_account = db.get_account('my account')
+        with db.transaction():
+            db_folder1 = db_account.add_folder('archive')
+            db_folder1.bulk_add_messages([msg1, msg2])
+            db_folder2 = db_account.add_folder('sent')
+            db_folder2.add_message(15, set(), "Subject: re: message 2")
+            other = db.get_account('other account').add_folder('archive')
+            other.add_message(*msg2)
+
+        self.assertEqual(sorted(db_account.search_messages(u"message")),
+                         [('archive', 15), ('sent', 15)])
+
+        with db.transaction():
+            db_account.del_folder('archive')
+        self.assertEqual(db_account.search_messages(u"message"),
+                         [('sent', 15)])
+
+    def test_threads(self):
+        db = mock_db()
+        db_folder = db_account_folder(db, 'my account', 'archive')
+        with db.transaction():
+            db_folder.bulk_add_messages([
+                (1, set(), "Message-ID: <a@x>\r\n\r\n"),
+                (2, set(), "Message-ID: <b@x>\r\n\r\n"),
+                (3, set(), "Message-ID: <c@x>\r\n"
+                           "In-Reply-To: <a@x>\r\n\r\n"),
+                (4, set(), "Subject: no message id\r\n\r\n"),
+            ])
+            # a reply to a message we don't have, then the message itself
+            db_folder.add_message(5, set(), "Message-ID: <e@x>\r\n"
+                                            "References: <d@x>\r\n\r\n")
+            db_folder.add_message(6, set(), "Message-ID: <f@x>\r\n"
+                                            "References: <a@x> <c@x>\r\n"
+                                            "\r\n")
+
+        self.assertEqual(db_folder.list_threads(), [
+            [(1, 0), (3, 1), (6, 2)],
+            [(5, 0)],
+            [(4, 0)],
+            [(2, 0)],
+        ])
+        self.assertEqual(db_folder.list_threads(1, 2), [[(5, 0)], [(4, 0)]])
+
+        with db.transaction():
+            db_folder.add_message(7, set(), "Message-ID: <d@x>\r\n"
+                                            "References: <b@x>\r\n\r\n")
+            db_folder.del_message(3)
+
+        self.assertEqual(db_folder.list_threads(), [
+            [(2, 0), (7, 1), (5, 2)],
+            [(1, 0), (6, 1)],
+            [(4, 0)],
+        ])
+
+        with db.transaction():
+            db_folder.del_all_messages()
+            db_folder.add_message(3, set(), "Message-ID: <c@x>\r\n\r\n")
+        self.assertEqual(db_folder.list_threads(), [[(3, 0)]])
+
+    def test_thread_reference_loop(self):
+        db = mock_db()
+        db_folder = db_account_folder(db, 'my account', 'archive')
+        with db.transaction():
+            db_folder.bulk_add_messages([
+                (1, set(), "Message-ID: <a@x>\r\nReferences: <b@x>\r\n"),
+                (2, set(), "Message-ID: <b@x>\r\nReferences: <a@x>\r\n"),
+            ])
+        self.assertEqual(db_folder.list_threads(), [[(1, 0), (2, 1)]])
+
+    def test_message_summary(self):
+        db = mock_db()
+        db_folder = db_account_folder(db, 'my account', 'archive')
+        with db.transaction():
+            db_folder.add_message(13, set(), "Subject: =?utf-8?q?h=C3=A9?=\r\n"
+                                             "From: me@example.com\r\n"
+                                             "Date: today\r\n\r\n")
+
+        summary = (u"h\xe9", u"me@example.com", u"today")
+        [message] = db_folder.list_messages(summary=True)
+        self.assertEqual(message[0], 13)
+        self.assertEqual(message[3], summary)
+        self.assertEqual(db_folder.get_message(13, summary=True)[3], summary)
+
     def test_require_transactions(self):
         db = mock_db()
         db_account = db.get_account('my account')
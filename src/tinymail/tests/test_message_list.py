@@ -0,0 +1,85 @@
+import unittest2 as unittest
+
+class MessageIndexTest(unittest.TestCase):
+    def test_rows(self):
+        from tinymail.message_list import MessageIndex
+        index = MessageIndex([13, 4, 8])
+
+        self.assertEqual(len(index), 3)
+        self.assertEqual([index[row] for row in range(3)], [4, 8, 13])
+        self.assertEqual(index.row_for_uid(8), 1)
+        self.assertRaises(KeyError, index.row_for_uid, 5)
+        self.assertTrue(13 in index)
+        self.assertFalse(14 in index)
+
+    def test_add(self):
+        from tinymail.message_list import MessageIndex
+        index = MessageIndex([4, 8, 13])
+
+        changes = index.apply(added=[15, 6, 1])
+
+        self.assertEqual(index.uids, [1, 4, 6, 8, 13, 15])
+        self.assertEqual(changes.inserted, [0, 2, 5])
+        self.assertEqual(changes.removed, [])
+        self.assertEqual(changes.changed, [])
+
+    def test_add_batches(self):
+        from tinymail.message_list import MessageIndex
+        index = MessageIndex([10, 20, 30])
+
+        # newest first, then a batch that straddles existing rows
+        self.assertEqual(index.apply(added=[42, 41, 40]).inserted, [3, 4, 5])
+        self.assertEqual(index.apply(added=[5, 25, 15]).inserted, [0, 2, 4])
+
+        self.assertEqual(index.uids, [5, 10, 15, 20, 25, 30, 40, 41, 42])
+
+    def test_remove(self):
+        from tinymail.message_list import MessageIndex
+        index = MessageIndex([4, 8, 13, 15])
+
+        changes = index.apply(removed=[13, 4, 99])
+
+        self.assertEqual(index.uids, [8, 15])
+        self.assertEqual(changes.removed, [0, 2])
+        self.assertEqual(changes.inserted, [])
+
+    def test_flags_changed(self):
+        from tinymail.message_list import MessageIndex
+        index = MessageIndex([4, 8, 13])
+
+        changes = index.apply(flags_changed=[13, 8])
+
+        self.assertEqual(index.uids, [4, 8, 13])
+        self.assertEqual(changes.changed, [1, 2])
+
+    def test_mixed_changes(self):
+        from tinymail.message_list import MessageIndex
+        index = MessageIndex([4, 8, 13, 15])
+
+        changes = index.apply(added=[10, 20], removed=[4, 15],
+                              flags_changed=[13, 20])
+
+        self.assertEqual(index.uids, [8, 10, 13, 20])
+        # removed rows are numbered as before the update, the others after
+        self.assertEqual(changes.removed, [0, 3])
+        self.assertEqual(changes.inserted, [1, 3])
+        self.assertEqual(changes.changed, [2])
+
+    def test_replaced_uid(self):
+        from tinymail.message_list import MessageIndex
+        index = MessageIndex([4, 8])
+
+        changes = index.apply(added=[8, 9], removed=[4, 8])
+
+        self.assertEqual(index.uids, [8, 9])
+        self.assertEqual(changes.removed, [0, 1])
+        self.assertEqual(changes.inserted, [0, 1])
+
+    def test_add_existing_uid(self):
+        from tinymail.message_list import MessageIndex
+        index = MessageIndex([4, 8])
+
+        changes = index.apply(added=[8])
+
+        self.assertEqual(index.uids, [4, 8])
+        self.assertEqual(changes.inserted, [])
@@ -16,6 +16,7 @@ def _account_for_test(config=None):
             'host': 'test_host',
             'login_name': 'test_username',
             'login_pass': 'test_password',
+            'ping_after': 0,
         }
     return Account(config, mock_db())
 
@@ -34,6 +35,12 @@ def setup_folder_controller(folder):
     app_delegate.setFolderController_(folder_controller)
     return messages_pane
 
+def empty_folder():
+    from tinymail.account import Folder
+    folder = Folder(None, 'f')
+    folder._messages = {}
+    return folder
+
 def objc_index_set(values):
     from Foundation import NSMutableIndexSet
     mutable_index_set = NSMutableIndexSet.new()
@@ -96,8 +103,7 @@ class MessageListingTest(AsyncTestCase):
         self.messages_pane = setup_folder_controller(fol1)
 
     def tearDown(self):
-        from tinymail.account import Folder
-        setup_folder_controller(Folder(None, 'f'))
+        setup_folder_controller(empty_folder())
 
     def test_show_messages(self):
         sender1 = self.messages_pane.preparedCellAtColumn_row_(0, 0)
@@ -118,6 +124,18 @@ class MessageListingTest(AsyncTestCase):
         subject1 = self.messages_pane.preparedCellAtColumn_row_(1, 2)
         self.assertEqual(subject1.objectValue(), "hi")
 
+    def test_update_keeps_selection(self):
+        self.messages_pane.selectRowIndexes_byExtendingSelection_(
+                objc_index_set([1]), False)
+        self.imap_data['fol1'][4] = (4, [], "From: other\nSubject: hi")
+        with mock_worker(**self.imap_data):
+            self.account.perform_update()
+
+        fol1 = self.account.get_folder('fol1')
+        folder_controller = self.messages_pane.delegate()
+        self.assertEqual(list(folder_controller.get_selected_messages()),
+                         [fol1.get_message(8)])
+
     def test_select_message(self):
         from tinymail.ui_delegates import message_selected
 
@@ -178,8 +196,7 @@ class MessageDraggingTest(AsyncTestCase):
 
     def tearDown(self):
         get_app_delegate().controllers['mailboxes'].remove_account(self.account)
-        from tinymail.account import Folder
-        setup_folder_controller(Folder(None, 'f'))
+        setup_folder_controller(empty_folder())
 
     def test_full_drag(self):
         import AppKit
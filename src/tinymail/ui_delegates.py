@@ -1,15 +1,16 @@
 import sys
 import os, os.path
 import logging
-import email
 import objc
 from Foundation import NSObject, NSURL, NSString, NSISOLatin1StringEncoding
-from Foundation import NSIndexSet
+from Foundation import NSIndexSet, NSMutableIndexSet
 import AppKit
 from PyObjCTools import Debugging
 from blinker import Signal
-from tinymail.account import Account
+from tinymail.account import Account, POOL_CHECK_INTERVAL
 from tinymail.account import account_opened, account_updated, folder_updated
+from tinymail.message_list import MessageIndex
+from tinymail.configuration import Configuration, open_db
 
 log = logging.getLogger(__name__)
 
@@ -47,6 +48,12 @@ def array_from_index_set(index_set):
     temp_array = AppKit.NSArray.arrayWithArray_(range(size + 1))
     return temp_array.objectsAtIndexes_(index_set)
 
+def index_set_from_array(rows):
+    index_set = NSMutableIndexSet.indexSet()
+    for row in rows:
+        index_set.addIndex_(row)
+    return index_set
+
 
 class MailboxesController(NSObject):
     def init(self):
@@ -207,7 +214,8 @@ class MailboxesFolderItem(NSObject):
 class FolderController(NSObject):
     def init(self):
         self = super(FolderController, self).init()
-        self.messages = []
+        self.folder = None
+        self.index = MessageIndex()
         self.table_view = None
         return self
 
@@ -219,8 +227,8 @@ class FolderController(NSObject):
     def controllerWithFolder_(cls, folder):
         self = cls.alloc().init()
         self.folder = folder
+        self.index = MessageIndex(folder.list_uids())
         folder_updated.connect(objc_callback(self.folder_updated), folder)
-        self.folder_updated(folder, [], [], [])
         return self
 
     def setView_(self, table_view):
@@ -235,15 +243,44 @@ class FolderController(NSObject):
         table_view.reloadData()
 
     def folder_updated(self, folder, added, removed, flags_changed):
-        self.messages = [msg for (uid, msg) in
-                         sorted(folder._messages.iteritems())]
-        if self.table_view is not None:
-            self.table_view.reloadData()
+        changes = self.index.apply(added, removed, flags_changed)
+        table_view = self.table_view
+        if table_view is None:
+            return
+
+        # only touch the rows that changed, so the selection and scroll
+        # position survive the update
+        table_view.beginUpdates()
+        if changes.removed:
+            table_view.removeRowsAtIndexes_withAnimation_(
+                    index_set_from_array(changes.removed), 0)
+        if changes.inserted:
+            table_view.insertRowsAtIndexes_withAnimation_(
+                    index_set_from_array(changes.inserted), 0)
+        table_view.endUpdates()
+
+        if changes.changed:
+            columns = NSIndexSet.indexSetWithIndexesInRange_(
+                    (0, table_view.numberOfColumns()))
+            table_view.reloadDataForRowIndexes_columnIndexes_(
+                    index_set_from_array(changes.changed), columns)
+
+    def message_at_row(self, row):
+        """
+        The message shown at `row`, or `None` if it was removed and the
+        `folder_updated` event that tells us so hasn't arrived yet.
+        """
+        try:
+            return self.folder.get_message(self.index[row])
+        except KeyError:
+            return None
 
     def get_selected_messages(self):
         selected = self.table_view.selectedRowIndexes()
         for idx in array_from_index_set(selected):
-            yield self.messages[idx]
+            message = self.message_at_row(idx)
+            if message is not None:
+                yield message
 
     def selected_toggle_flag(self, flag):
         flagged = []
@@ -263,21 +300,22 @@ class FolderController(NSObject):
         self.folder.copy_messages(message_uid_list, target_folder)
 
     def numberOfRowsInTableView_(self, table_view):
-        return len(self.messages)
+        return len(self.index)
 
     def tableView_objectValueForTableColumn_row_(self, table_view, col, row):
-        msg = self.messages[row]
+        msg = self.message_at_row(row)
+        if msg is None:
+            return ""
         name = col.identifier()
-        headers = email.message_from_string(msg.raw_headers)
 
         if name == 'Subject':
-            return headers['Subject']
+            return msg.subject
 
         elif name == 'From':
-            return headers['From']
+            return msg.sender
 
         elif name == 'Date':
-            return headers['Date']
+            return msg.date
 
         elif name == 'Unread':
             if '\\Seen' in msg.flags:
@@ -300,14 +338,16 @@ class FolderController(NSObject):
     def tableViewSelectionDidChange_(self, notification):
         table_view = notification.object()
         row = table_view.selectedRow()
-        new_value = (None if row == -1 else self.messages[row])
+        new_value = (None if row == -1 else self.message_at_row(row))
 
         message_selected.send(self, message=new_value)
 
     def tableView_writeRowsWithIndexes_toPasteboard_(self,
             table_view, indices, pasteboard):
-        pasteboard_data = ','.join(str(self.messages[idx].uid) for idx in
-                                   array_from_index_set(indices))
+        messages = [self.message_at_row(idx)
+                    for idx in array_from_index_set(indices)]
+        pasteboard_data = ','.join(str(message.uid) for message in messages
+                                   if message is not None)
         pasteboard.setString_forType_(pasteboard_data, "TinyMailMessages")
         return True
 
@@ -456,17 +496,27 @@ class TinymailAppDelegate(NSObject):
             account = Account(account_config, self.the_db)
             self.accounts[account.name] = account
             account.perform_update()
+            account.start_push()
 
+        from async_cocoa import timer_with_callback
         auto_sync_interval = settings.get('auto_sync', None)
         if auto_sync_interval is not None:
-            from async_cocoa import timer_with_callback
             timer_with_callback(auto_sync_interval * 60, True, self.auto_sync)
+        timer_with_callback(POOL_CHECK_INTERVAL, True,
+                            self.close_idle_connections)
 
     def auto_sync(self):
         for account in self.accounts.values():
-            account.perform_update()
+            account.auto_sync()
+
+    def close_idle_connections(self):
+        for account in self.accounts.values():
+            account.close_idle_connections()
 
     def applicationWillTerminate_(self, notification):
+        for account in self.accounts.values():
+            account.stop_push()
+            account.worker_manager.close_idle_workers()
         if hasattr(self, 'the_db'):
             self.the_db.close()
 
@@ -504,19 +554,6 @@ class TinymailAppDelegate(NSObject):
     def markFlaggedUnflagged_(self, sender):
         self.controllers['folder'].selected_toggle_flag('\\Flagged')
 
-class Configuration(object):
-    def __init__(self, home):
-        self.home = home
-        cfg_path = os.path.join(self.home, 'account.json')
-        import json
-        with open(cfg_path, 'rb') as f:
-            self.settings = json.loads(f.read())
-
-def open_db(configuration):
-    from tinymail.localdata import open_local_db
-    db_path = os.path.join(configuration.home, 'db.sqlite3')
-    return open_local_db(db_path)
-
 def develop():
     from PyObjCTools import Debugging
     Debugging.installPythonExceptionHandler()